@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+""" Benchmark of bulk landmark import
+
+Generate a CSV file of random hands over a few images, then import it into
+temporary SQLite databases with each pragma profile and report throughput.
+
+Usage: python benchmark_landmarks.py [number of hands] [chunk size]
+"""
+
+__author__ = 'Benjamin Pillot'
+__copyright__ = 'Copyright 2019, Benjamin Pillot'
+__email__ = 'benjaminpillot@riseup.net'
+
+import csv
+import os
+import sys
+import tempfile
+
+import numpy as np
+from sqlalchemy import create_engine
+
+from kalimain.database import Base, Project, Cave, Image
+from kalimain.features import NB_LANDMARKS
+from kalimain.importer import import_landmarks
+from kalimain.sqlite import PRAGMA_PROFILES, tune_engine
+
+NB_HANDS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+CHUNK_SIZE = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+NB_IMAGES = 100
+
+directory = tempfile.mkdtemp()
+filename = os.path.join(directory, "landmarks.csv")
+
+# Landmarks of a right hand, randomly moved, scaled and shifted
+template = np.array([[0, 60], [20, 100], [30, 60], [45, 120], [55, 60], [65, 125], [75, 60], [85, 115], [95, 60],
+                     [110, 90], [115, 50], [60, 0]], dtype=float)
+rng = np.random.default_rng(0)
+landmarks = template * rng.uniform(5, 10, (NB_HANDS, 1, 1)) + rng.normal(0, 5, (NB_HANDS, NB_LANDMARKS, 2)) + \
+    rng.uniform(0, 2000, (NB_HANDS, 1, 2))
+
+with open(filename, "w", newline="") as file:
+    writer = csv.writer(file)
+    writer.writerow(["cave", "image"] + [axis + str(i) for i in range(1, NB_LANDMARKS + 1) for axis in "xy"])
+    for i, points in enumerate(landmarks):
+        writer.writerow(["cave %d" % (i % 10), "image %d" % (i % NB_IMAGES)] + points.ravel().round(2).tolist())
+
+for profile in [None] + sorted(PRAGMA_PROFILES):
+    engine = create_engine("sqlite:///%s" % os.path.join(directory, "%s.db" % profile))
+    if profile is not None:
+        tune_engine(engine, profile)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(Project.__table__.insert(), [dict(id=1, name="benchmark")])
+        connection.execute(Cave.__table__.insert(), [dict(id=i + 1, project_id=1, name="cave %d" % i)
+                                                     for i in range(10)])
+        connection.execute(Image.__table__.insert(), [dict(id=i + 1, cave_id=i % 10 + 1, name="image %d" % i)
+                                                      for i in range(NB_IMAGES)])
+
+    report = import_landmarks(engine, filename, CHUNK_SIZE)
+    print("%-8s %d hands inserted in %.1f s - %.0f hands/s (%.0f points/s)" % (
+        profile or "none", report.inserted, report.elapsed, report.inserted / report.elapsed,
+        report.inserted * NB_LANDMARKS / report.elapsed))
+    engine.dispose()
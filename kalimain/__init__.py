@@ -10,18 +10,10 @@ __copyright__ = 'Copyright © 2019, Benjamin Pillot - Jean Michel Chazine'
 __email__ = 'benjaminpillot@riseup.net'
 __version__ = '2.0'
 
-import base64
 import os
 import pathlib
 import sqlite3
 
-from cryptography.fernet import Fernet
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-
 
 def create_database(db_file):
     """ Create sqlite database
@@ -40,6 +32,12 @@ def create_database(db_file):
             conn.close()
 
 
+# import base64
+# from cryptography.fernet import Fernet
+# from cryptography.hazmat.backends import default_backend
+# from cryptography.hazmat.primitives import hashes
+# from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+#
 # _kdf = PBKDF2HMAC(
 #     algorithm=hashes.SHA256(),
 #     length=32,
@@ -64,7 +62,40 @@ try:
 except FileExistsError:
     pass
 
-create_database(path_to_sqlite_db)
-ENGINE = create_engine("sqlite:///%s" % path_to_sqlite_db, echo=True)
 
-SESSION = sessionmaker(ENGINE)
+def create_kalimain_engine(url=None, echo=False):
+    """ Create engine of Kalimain database
+
+    SQLite connections get the default pragma profile (foreign keys enforced,
+    write-ahead log, see kalimain.sqlite)
+    :param url: database URL (default: SQLite database in Kalimain home directory)
+    :param echo: if True, log all statements
+    :return:
+    """
+    from sqlalchemy import create_engine
+    from kalimain.sqlite import tune_engine
+
+    if url is None:
+        create_database(path_to_sqlite_db)
+        url = "sqlite:///%s" % path_to_sqlite_db
+
+    return tune_engine(create_engine(url, echo=echo))
+
+
+def __getattr__(name):
+    """ Create ENGINE and SESSION on first use
+
+    SQLAlchemy is only imported when the database is needed, so that the
+    package (and command line interface) starts fast
+    """
+    global ENGINE, SESSION
+
+    if name in ("ENGINE", "SESSION"):
+        from sqlalchemy.orm import sessionmaker
+
+        ENGINE = create_kalimain_engine(echo=True)
+        SESSION = sessionmaker(ENGINE)
+
+        return globals()[name]
+
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+
+""" Run Kalimain command line interface (python -m kalimain)
+
+"""
+from kalimain.cli import main
+
+main()
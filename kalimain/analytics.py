@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+
+""" Grouped analytics of hands
+
+Summaries and distributions (quantiles and histograms) of the Manning index
+and finger lengths, overall or per project, cave, country or continent.
+Summaries are combined from the statistics stored per cave (see
+kalimain.summary), distributions are computed from hand values read as plain
+columns. Caves are mapped to their group with vectorized NumPy operations.
+
+Results are cached per group: invalidating a group (e.g. when a hand is
+added to or deleted from one of its images) only recomputes that group on
+next access. Cached results are also checked against the stored statistics
+of all hands and the caves table (see data_version), so that changes made
+elsewhere (landmark import, feature recomputation, geocoding, other
+processes) are never served from a stale cache.
+"""
+from collections import namedtuple
+
+import numpy as np
+from sqlalchemy import select, func, literal
+
+import kalimain
+from kalimain.database import Hand, Image, Cave, Project, HandStat
+from kalimain.dataset import read_chunks
+
+GROUPS = ("project", "cave", "country", "continent")
+VARIABLES = ("manning", "D1", "D2", "D3", "D4", "D5")
+
+# Default quantiles and number of histogram bins of distributions
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+NB_BINS = 20
+
+Summary = namedtuple("Summary", ["group", "label", "hands", "left", "count", "mean", "std", "min", "max"])
+Distribution = namedtuple("Distribution", ["group", "label", "count", "mean", "std", "quantiles", "bin_edges",
+                                           "bin_counts"])
+Statistics = namedtuple("Statistics", ["variable", "by", "quantiles", "summaries", "distributions"])
+
+# Cave id of hands without image or cave
+NO_CAVE = -1
+
+
+def cave_groups(connection):
+    """ Group key and label of every cave, for each grouping
+
+    Groups of caves without project, country or continent are None. Hands
+    which do not belong to a cave (NO_CAVE) only belong to the overall group
+    :param connection: SQLAlchemy connection
+    :return: dict of grouping -> ({cave id: group key}, {group key: label})
+    """
+    rows = connection.execute(select(Cave.id, Cave.project_id, Project.name, Cave.name, Cave.country,
+                                     Cave.continent).outerjoin(Project, Cave.project_id == Project.id)).all()
+    groups = {None: ({row[0]: None for row in rows}, {None: "all"})}
+    groups[None][0][NO_CAVE] = None
+    groups["project"] = ({row[0]: row[1] for row in rows}, {row[1]: row[2] for row in rows})
+    groups["cave"] = ({row[0]: row[0] for row in rows}, {row[0]: row[3] for row in rows})
+    groups["country"] = ({row[0]: row[4] for row in rows}, {row[4]: row[4] for row in rows})
+    groups["continent"] = ({row[0]: row[5] for row in rows}, {row[5]: row[5] for row in rows})
+
+    return groups
+
+
+def group_codes(cave_ids, cave_keys, keys):
+    """ Index in keys of the group of each cave id (-1 if cave is not in any of keys)
+
+    :param cave_ids: array of cave ids (e.g. of hands)
+    :param cave_keys: dict of cave id -> group key (see cave_groups)
+    :param keys: list of group keys
+    :return: array of indices in keys
+    """
+    index = {key: code for code, key in enumerate(keys)}
+    max_id = max(max(cave_keys, default=0), int(cave_ids.max(initial=0)))
+    lookup = np.full(max_id + 2, -1, dtype=np.int64)
+    for cave_id, key in cave_keys.items():
+        lookup[cave_id] = index.get(key, -1)
+
+    return lookup[cave_ids]
+
+
+def _variable(variable):
+    if variable not in VARIABLES:
+        raise ValueError("Unknown variable '%s' (valid variables: %s)" % (variable, ", ".join(VARIABLES)))
+    return getattr(Hand, variable)
+
+
+def data_version(connection):
+    """ Token of stored hands and caves, which changes when any result may change
+
+    Stored statistics of all hands (number of hands, and count, sum, sum of
+    squares, min and max of every feature) change with hands and their
+    values; number of caves, largest cave id and number of caves with a
+    project, country and continent change with caves and their groups
+    :param connection: SQLAlchemy connection
+    :return: tuple
+    """
+    hands = connection.execute(select(HandStat.__table__).where(HandStat.scope == "all")).first()
+    caves = connection.execute(select(func.count(Cave.id), func.max(Cave.id), func.count(Cave.project_id),
+                                      func.count(Cave.country), func.count(Cave.continent))).first()
+
+    return tuple(hands or ()) + tuple(caves)
+
+
+def stored_statement(variable, by, cave_ids=None):
+    """ Stored statistics of hands per cave, or of all hands when by is None (see kalimain.summary)
+
+    Select cave id (NO_CAVE for all hands), number of hands, number of left
+    hands, and count, sum, sum of squares, min and max of variable
+    :param variable: name of Hand column (see VARIABLES)
+    :param by: None (all hands) or grouping
+    :param cave_ids: if not None, only select statistics of those caves
+    :return:
+    """
+    _variable(variable)
+    columns = [getattr(HandStat, "%s_%s" % (variable, suffix)) for suffix in ("count", "sum", "squares", "min", "max")]
+    if by is None:
+        return select(literal(NO_CAVE), HandStat.hands, HandStat.left, *columns).where(HandStat.scope == "all")
+
+    statement = select(HandStat.scope_id, HandStat.hands, HandStat.left, *columns).where(HandStat.scope == "cave")
+    if cave_ids is not None:
+        statement = statement.where(HandStat.scope_id.in_(cave_ids))
+
+    return statement
+
+
+def values_statement(variable, cave_ids=None):
+    """ Select (cave id, value) of hands whose variable is not null
+
+    :param variable: name of Hand column (see VARIABLES)
+    :param cave_ids: if not None, only select hands of those caves
+    :return:
+    """
+    column = _variable(variable)
+    statement = select(func.coalesce(Image.cave_id, NO_CAVE), column).select_from(Hand).outerjoin(
+        Image, Hand.image_id == Image.id).where(column.isnot(None))
+    if cave_ids is not None:
+        statement = statement.where(Image.cave_id.in_(cave_ids))
+
+    return statement
+
+
+def grouped_quantiles(codes, values, nb_groups, quantiles=QUANTILES):
+    """ Quantiles of values per group (linear interpolation, as numpy.quantile)
+
+    :param codes: group index of each value (0 <= code < nb_groups)
+    :param values: values
+    :param nb_groups: number of groups
+    :param quantiles: sequence of quantiles in [0, 1]
+    :return: (nb_groups, len(quantiles)) array (NaN for empty groups)
+    """
+    order = np.lexsort((values, codes))
+    values = values[order]
+    counts = np.bincount(codes, minlength=nb_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    result = np.full((nb_groups, len(quantiles)), np.nan)
+    nonempty = counts > 0
+
+    position = np.asarray(quantiles)[np.newaxis, :] * (counts[nonempty, np.newaxis] - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, counts[nonempty, np.newaxis] - 1)
+    low_values = values[starts[nonempty, np.newaxis] + lower]
+    high_values = values[starts[nonempty, np.newaxis] + upper]
+    result[nonempty] = low_values + (position - lower) * (high_values - low_values)
+
+    return result
+
+
+def grouped_histograms(codes, values, nb_groups, nb_bins=NB_BINS):
+    """ Histogram of values per group, with nb_bins bins over the group range
+
+    :param codes: group index of each value (0 <= code < nb_groups)
+    :param values: values
+    :param nb_groups: number of groups
+    :param nb_bins: number of bins
+    :return: (nb_groups, nb_bins + 1) bin edges and (nb_groups, nb_bins) counts
+    """
+    minimum = np.full(nb_groups, np.inf)
+    maximum = np.full(nb_groups, -np.inf)
+    np.minimum.at(minimum, codes, values)
+    np.maximum.at(maximum, codes, values)
+    width = np.where(maximum > minimum, maximum - minimum, 1)
+
+    bins = np.clip(((values - minimum[codes]) / width[codes] * nb_bins).astype(np.int64), 0, nb_bins - 1)
+    counts = np.bincount(codes * nb_bins + bins, minlength=nb_groups * nb_bins).reshape(nb_groups, nb_bins)
+    edges = minimum[:, np.newaxis] + width[:, np.newaxis] * np.arange(nb_bins + 1) / nb_bins
+
+    return edges, counts
+
+
+class Analytics:
+    """ Cached summaries and distributions of hands per group
+
+    """
+    def __init__(self, engine=None, quantiles=QUANTILES, nb_bins=NB_BINS, chunk_size=10000):
+        """
+
+        :param engine: SQLAlchemy engine (default: kalimain.ENGINE)
+        :param quantiles: quantiles of distributions
+        :param nb_bins: number of histogram bins of distributions
+        :param chunk_size: number of rows fetched at once
+        """
+        self.engine = engine if engine is not None else kalimain.ENGINE
+        self.quantiles = quantiles
+        self.nb_bins = nb_bins
+        self.chunk_size = chunk_size
+
+        # (kind, variable, grouping) -> {group key: result} and set of stale group keys
+        self._cache = dict()
+        self._stale = dict()
+
+        # Data version of cached results (see data_version)
+        self._version = None
+
+    def _get(self, kind, variable, by):
+        """ Return cached results, recomputing missing or stale groups
+
+        """
+        if by is not None and by not in GROUPS:
+            raise ValueError("Unknown grouping '%s' (valid groupings: %s)" % (by, ", ".join(GROUPS)))
+
+        with self.engine.connect() as connection:
+            version = data_version(connection)
+        if version != self._version:
+            self.invalidate()
+            self._version = version
+
+        entry = (kind, variable, by)
+        compute = self._summaries if kind == "summary" else self._distributions
+        if entry not in self._cache:
+            self._cache[entry] = compute(variable, by)
+        elif self._stale[entry]:
+            stale = self._stale[entry]
+            results = {key: result for key, result in self._cache[entry].items() if key not in stale}
+            results.update(compute(variable, by, stale))
+            self._cache[entry] = results
+        self._stale[entry] = set()
+
+        return sorted(self._cache[entry].values(), key=lambda result: (result.label is None, str(result.label)))
+
+    def _restrict(self, connection, by, keys):
+        """ Cave groups, group keys and ids of caves to read (None = all caves)
+
+        """
+        groups = cave_groups(connection)
+        cave_keys, labels = groups[by]
+        if keys is None or by is None:
+            return cave_keys, labels, sorted(labels, key=str), None
+        else:
+            return cave_keys, labels, sorted(keys, key=str), [cave for cave, key in cave_keys.items() if key in keys]
+
+    def _summaries(self, variable, by, keys=None):
+        with self.engine.connect() as connection:
+            cave_keys, labels, keys, cave_ids = self._restrict(connection, by, keys)
+            rows = connection.execute(stored_statement(variable, by, cave_ids)).all()
+
+        if not rows:
+            return dict()
+
+        caves = np.array([row[0] for row in rows], dtype=np.int64)
+        sums = np.array([[value or 0 for value in row[1:6]] for row in rows], dtype=np.float64)
+        minimum = np.array([row[6] if row[6] is not None else np.inf for row in rows])
+        maximum = np.array([row[7] if row[7] is not None else -np.inf for row in rows])
+
+        codes = group_codes(caves, cave_keys, keys)
+        valid = codes >= 0
+        totals = np.zeros((len(keys), sums.shape[1]))
+        np.add.at(totals, codes[valid], sums[valid])
+        group_min, group_max = np.full(len(keys), np.inf), np.full(len(keys), -np.inf)
+        np.minimum.at(group_min, codes[valid], minimum[valid])
+        np.maximum.at(group_max, codes[valid], maximum[valid])
+
+        results = dict()
+        for code in np.flatnonzero(totals[:, 0]):
+            hands, left, count, total, squares = totals[code]
+            mean = float(total / count) if count else None
+            std = float(max(squares / count - mean ** 2, 0) ** 0.5) if count else None
+            results[keys[code]] = Summary(keys[code], labels.get(keys[code]), int(hands), int(left), int(count),
+                                          mean, std, float(group_min[code]) if count else None,
+                                          float(group_max[code]) if count else None)
+
+        return results
+
+    def _read_values(self, variable, by, keys=None):
+        """ Labels, group keys, and group index (in keys) and value of every hand of groups
+
+        """
+        with self.engine.connect() as connection:
+            cave_keys, labels, keys, cave_ids = self._restrict(connection, by, keys)
+            data = read_chunks(connection, values_statement(variable, cave_ids), np.dtype(np.float64),
+                               self.chunk_size)
+
+        codes = group_codes(data[:, 0].astype(np.int64), cave_keys, keys)
+        valid = codes >= 0
+
+        return labels, keys, codes[valid], data[valid, 1]
+
+    def _distributions(self, variable, by, keys=None):
+        labels, keys, codes, values = self._read_values(variable, by, keys)
+
+        counts = np.bincount(codes, minlength=len(keys))
+        sums = np.bincount(codes, values, minlength=len(keys))
+        squares = np.bincount(codes, values * values, minlength=len(keys))
+        quantiles = grouped_quantiles(codes, values, len(keys), self.quantiles)
+        edges, bin_counts = grouped_histograms(codes, values, len(keys), self.nb_bins)
+
+        results = dict()
+        for code in np.flatnonzero(counts):
+            mean = float(sums[code] / counts[code])
+            results[keys[code]] = Distribution(keys[code], labels.get(keys[code]), int(counts[code]), mean,
+                                               float(max(squares[code] / counts[code] - mean ** 2, 0) ** 0.5),
+                                               quantiles[code], edges[code], bin_counts[code])
+
+        return results
+
+    def distributions(self, variable="manning", by=None):
+        """ Quantiles and histogram of variable per group
+
+        :param variable: Manning index or finger length (see VARIABLES)
+        :param by: None (all hands), "project", "cave", "country" or "continent"
+        :return: list of Distribution, sorted by group label
+        """
+        return self._get("distribution", variable, by)
+
+    def image_groups(self, image_id):
+        """ Group keys of image, for each grouping
+
+        :param image_id:
+        :return: dict of grouping -> group key (empty if image does not exist)
+        """
+        with self.engine.connect() as connection:
+            row = connection.execute(select(Cave.project_id, Cave.id, Cave.country, Cave.continent).select_from(
+                Image).join(Cave, Image.cave_id == Cave.id).where(Image.id == image_id)).first()
+
+        return dict(zip(GROUPS, row)) if row is not None else dict()
+
+    def invalidate(self, groups=None):
+        """ Invalidate cached results of groups
+
+        The overall group (by=None) is always invalidated
+        :param groups: dict of grouping -> group key (None = invalidate all results)
+        :return:
+        """
+        if groups is None:
+            self._cache.clear()
+            self._stale.clear()
+            self._version = None
+            return
+
+        for entry, stale in self._stale.items():
+            by = entry[2]
+            if by is None:
+                stale.add(None)
+            elif by in groups:
+                stale.add(groups[by])
+
+    def invalidate_image(self, image_id):
+        """ Invalidate cached results of groups image belongs to
+
+        Call once hands of image are committed: data version is updated, so
+        that other groups are kept
+        :param image_id:
+        :return:
+        """
+        with self.engine.connect() as connection:
+            version = data_version(connection)
+        self.invalidate(self.image_groups(image_id))
+        if self._version is not None:
+            self._version = version
+
+    def stored_statistics(self, variable, by, keys):
+        """ Current stored count, sum, sum of squares, min and max of variable of groups (not cached)
+
+        Project and cave statistics are single row lookups (see
+        kalimain.summary), country and continent statistics are combined from
+        the statistics of their caves
+        :param variable: Manning index or finger length (see VARIABLES)
+        :param by: "project", "cave", "country" or "continent"
+        :param keys: keys of groups
+        :return: dict of group key -> (count, sum, sum of squares, min, max), for groups with hands
+        """
+        _variable(variable)
+        if by not in GROUPS:
+            raise ValueError("Unknown grouping '%s' (valid groupings: %s)" % (by, ", ".join(GROUPS)))
+        columns = [getattr(HandStat, "%s_%s" % (variable, suffix)) for suffix in ("count", "sum", "squares", "min",
+                                                                                  "max")]
+
+        with self.engine.connect() as connection:
+            if by in ("project", "cave"):
+                rows = connection.execute(select(HandStat.scope_id, *columns).where(
+                    HandStat.scope == by, HandStat.scope_id.in_(list(keys)))).all()
+                return {row[0]: tuple(row[1:]) for row in rows}
+
+            cave_keys, _ = cave_groups(connection)[by]
+            rows = connection.execute(select(HandStat.scope_id, *columns).where(HandStat.scope == "cave").where(
+                HandStat.scope_id.in_([cave for cave, key in cave_keys.items() if key in keys]))).all()
+
+        results = dict()
+        for cave_id, *row in rows:
+            key = cave_keys[cave_id]
+            if not row[0]:
+                continue
+            elif key in results:
+                count, total, squares, minimum, maximum = results[key]
+                results[key] = (count + row[0], total + row[1], squares + row[2], min(minimum, row[3]),
+                                max(maximum, row[4]))
+            else:
+                results[key] = tuple(row)
+
+        return results
+
+    def statistics(self, variable="manning", by=None):
+        """ Summaries and distributions of variable per group
+
+        :param variable: Manning index or finger length (see VARIABLES)
+        :param by: None (all hands), "project", "cave", "country" or "continent"
+        :return: Statistics
+        """
+        return Statistics(variable, by, self.quantiles, self.summaries(variable, by), self.distributions(variable, by))
+
+    def values(self, variable="manning", by=None, keys=None):
+        """ Values of variable of hands of groups (not cached)
+
+        :param variable: Manning index or finger length (see VARIABLES)
+        :param by: None (all hands), "project", "cave", "country" or "continent"
+        :param keys: keys of groups to read (None = all groups)
+        :return: dict of group key -> 1D array of values
+        """
+        labels, keys, codes, values = self._read_values(variable, by, set(keys) if keys is not None else None)
+        counts = np.bincount(codes, minlength=len(keys))
+        groups = np.split(values[np.argsort(codes, kind="stable")], np.cumsum(counts)[:-1])
+
+        return {key: group for key, group, count in zip(keys, groups, counts) if count}
+
+    def summaries(self, variable="manning", by=None):
+        """ Number of hands, number of left hands and summary of variable per group (SQL aggregates)
+
+        :param variable: Manning index or finger length (see VARIABLES)
+        :param by: None (all hands), "project", "cave", "country" or "continent"
+        :return: list of Summary, sorted by group label
+        """
+        return self._get("summary", variable, by)
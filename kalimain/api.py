@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+
+""" Headless Kalimain API
+
+Facade of the model layer for scripts and batch jobs: no Tk, no observers.
+Warnings (duplicates, geocoding errors, etc.) are regular Python warnings.
+Counts, statistics, summaries, comparisons, imports and exports are served
+from the database layer: the model layer (slow to import) is only created
+by operations which need it (e.g. similar hands, duplicates, image ingest).
+"""
+from sqlalchemy import func, select
+from sqlalchemy.orm import sessionmaker
+
+from kalimain import create_kalimain_engine, summary
+from kalimain.database import Project, Cave, Image, Hand
+from kalimain.readmodel import project_view, cave_view
+
+
+class Kalimain:
+    """ Headless access to a Kalimain database
+
+    """
+    def __init__(self, engine=None, reset=False):
+        """
+
+        :param engine: SQLAlchemy engine (default: SQLite database in Kalimain home directory)
+        :param reset: if True, drop all tables first (all data are lost)
+        """
+        self.engine = engine if engine is not None else create_kalimain_engine()
+        summary.create_tables(self.engine, reset)
+        self.session_factory = sessionmaker(self.engine)
+
+        # Model layer and analytics, created on first use
+        self._model = None
+        self._analytics = None
+
+        # Cached group comparisons, per resampling settings
+        self._comparisons = dict()
+
+        # Cached spatial statistics (neighbour graphs), per graph settings
+        self._spatial = dict()
+
+    @property
+    def analytics(self):
+        """ Cached summaries and distributions of hands (see kalimain.analytics)
+
+        """
+        if self._analytics is None:
+            from kalimain.analytics import Analytics
+
+            self._analytics = Analytics(self.engine)
+        return self._analytics
+
+    @property
+    def model(self):
+        """ Model layer (created on first use)
+
+        """
+        if self._model is None:
+            from kalimain.model import KModel
+
+            self._model = KModel(self.engine)
+        return self._model
+
+    @property
+    def unit_of_work(self):
+        return self.model.unit_of_work
+
+    def align_shapes(self, rebuild=False):
+        """ Procrustes alignment of hands without stored shape, and update of mean shapes
+
+        :param rebuild: if True, run generalised Procrustes analysis of all hands again
+        :return: number of aligned hands
+        """
+        from kalimain.shapes import ShapeStore
+
+        return ShapeStore(self.engine).update(rebuild)
+
+    def cluster(self, features="profile", refit=False, nb_clusters=8, seed=None):
+        """ Assign hands without cluster to clusters (mini-batch k-means)
+
+        :param features: "profile", "shape" or "both" (see kalimain.clustering)
+        :param refit: if True, fit k-means on all hands again and reassign all hands
+        :param nb_clusters: number of clusters of new fits
+        :param seed: random seed
+        :return: (hand ids, clusters) of all clustered hands
+        """
+        from kalimain.clustering import ClusterStore
+
+        store = ClusterStore(self.engine, nb_clusters, seed=seed)
+        store.update(features, refit)
+
+        return store.labels(features)
+
+    def compare(self, group_a, group_b, variable="manning", by="cave", statistic="mean", nb_resamples=10000,
+                confidence=0.95, seed=None, processes=None):
+        """ Bootstrap confidence interval and permutation test of difference between two groups
+
+        Comparisons are cached per pair of groups, until either group changes
+
+        :param group_a: key of first group (project or cave id, country or continent name)
+        :param group_b: key of second group
+        :param variable: Manning index or finger length (see kalimain.analytics.VARIABLES)
+        :param by: "project", "cave", "country" or "continent"
+        :param statistic: "mean", "median" or "std"
+        :param nb_resamples: number of bootstrap resamples and of permutations
+        :param confidence: confidence level of bootstrap interval
+        :param seed: random seed (None = unpredictable)
+        :param processes: number of worker processes (None = number of CPUs, 0 = no process pool)
+        :return: kalimain.resampling.Comparison
+        """
+        from kalimain.resampling import GroupComparisons
+
+        settings = (statistic, nb_resamples, confidence, seed, processes)
+        if settings not in self._comparisons:
+            self._comparisons[settings] = GroupComparisons(self.analytics, statistic,
+                                                           nb_resamples, confidence, seed, processes=processes)
+
+        return self._comparisons[settings].compare(variable, by, group_a, group_b)
+
+    def counts(self):
+        """ Number of rows of main tables
+
+        :return: dict
+        """
+        with self.engine.connect() as connection:
+            return {db_class.__tablename__: connection.execute(select(func.count(db_class.id))).scalar()
+                    for db_class in (Project, Cave, Image, Hand)}
+
+    def dbscan(self, eps=0.05, min_samples=10):
+        """ DBSCAN clusters of Procrustes shape coordinates of hands (requires scikit-learn)
+
+        :param eps: maximum Procrustes coordinate distance between neighbours
+        :param min_samples: minimum number of neighbours of core hands
+        :return: (hand ids, clusters), -1 being noise
+        """
+        from kalimain.clustering import ClusterStore, DBSCAN
+
+        store = ClusterStore(self.engine)
+        store.dbscan(eps, min_samples)
+
+        return store.labels(DBSCAN)
+
+    def duplicate_caves(self, tolerance=None):
+        """ Pairs of caves within tolerance of each other
+
+        :param tolerance: distance in km (default: CaveModel.duplicate_tolerance)
+        :return: list of (cave id, cave id, distance in km)
+        """
+        cave_model = self.model.cave_model
+        if tolerance is None:
+            tolerance = cave_model.duplicate_tolerance
+
+        pairs = []
+        for cave_id, (latitude, longitude) in cave_model.cave_index.locations.items():
+            pairs += [(cave_id, other_id, distance) for distance, other_id
+                      in cave_model.cave_index.within(latitude, longitude, tolerance) if other_id > cave_id]
+
+        return sorted(pairs)
+
+    def duplicate_images(self, radius=None):
+        """ Pairs of images whose perceptual hashes are within radius
+
+        :param radius: maximum hamming distance (default: ImageModel.near_duplicate_radius)
+        :return: list of (image id, image id, hamming distance)
+        """
+        image_model = self.model.image_model
+        if radius is None:
+            radius = image_model.near_duplicate_radius
+
+        index = image_model.phash_index
+        pairs = []
+        for image_id, key in index.keys.items():
+            pairs += [(image_id, other_id, distance) for distance, other_id in index.search(key, radius)
+                      if other_id > image_id]
+
+        return sorted(pairs)
+
+    def export(self, target, filename, chunk_size=10000, observer=None, **filters):
+        """ Export table or hands view to CSV or Parquet file
+
+        :param target: table name or "hands_view" (hands with image, cave and project attributes)
+        :param filename: path to CSV or Parquet file
+        :param chunk_size: number of rows written at once
+        :param observer: progress observer
+        :param filters: hands view filters (project_id, cave_id, country, continent)
+        :return: Progress at the end of export
+        """
+        from kalimain.export import Exporter
+
+        exporter = Exporter(self.engine, chunk_size)
+        if observer is not None:
+            exporter.progress_notifier.add_observer(observer)
+
+        if target == "hands_view":
+            return exporter.export_hands(filename, **filters)
+        else:
+            return exporter.export_table(target, filename)
+
+    def get_project(self, name, create=False):
+        """ Return project with given name
+
+        :param name: project name
+        :param create: if True, create project if it does not exist
+        :return: ProjectView (None if not found)
+        """
+        with self.session_factory() as session:
+            project = self._project(session, name, create)
+            return project_view(project) if project is not None else None
+
+    def _project(self, session, name, create=False):
+        project = session.query(Project).filter_by(name=name).first()
+        if project is None and create:
+            project = Project(name=name)
+            session.add(project)
+            session.commit()
+
+        return project
+
+    def import_caves(self, filename, project):
+        """ Import caves from CSV, GPX or KML file
+
+        Caves are reverse geocoded at import, unless the geocoder is rate
+        limited (e.g. Nominatim): those caves are geocoded in the background
+        by the application on next start (see CaveModel.backfill_secondary_attributes)
+        :param filename:
+        :param project: project name (created if necessary)
+        :return: CaveImportReport
+        """
+        from kalimain.importer import import_caves
+
+        with self.session_factory() as session:
+            report = import_caves(session, self._project(session, project, create=True), filename)
+            report = report._replace(caves=[cave_view(cave, images=False) for cave in report.caves])
+            session.commit()
+        if self._model is not None:
+            self._model.cave_model.reset_cave_index()
+
+        return report
+
+    def import_images(self, directory, cave_id, observer=None):
+        """ Add all images of folder tree to cave
+
+        :param directory: path to root folder
+        :param cave_id: id of cave
+        :param observer: progress observer
+        :return: IngestReport
+        """
+        self.model.cave_model.set_object(cave_id)
+        if self.model.cave_model.current_object is None:
+            raise ValueError("No cave with id %d" % cave_id)
+        ingest = self.model.image_model.new_ingest()
+        if observer is not None:
+            ingest.progress_notifier.add_observer(observer)
+
+        return self.model.image_model.ingest_directory(directory, ingest)
+
+    def import_landmarks(self, filename, chunk_size=10000):
+        """ Import hands from CSV or JSON landmark file
+
+        :param filename:
+        :param chunk_size: number of hands per transaction
+        :return: LandmarkImportReport
+        """
+        from kalimain.importer import import_landmarks
+
+        report = import_landmarks(self.engine, filename, chunk_size)
+        if self._model is not None:
+            self._model.hand_model.reset_similarity_index()
+
+        return report
+
+    def mean_shapes(self, by=None):
+        """ Stored mean shapes of hands per group
+
+        :param by: None (all hands), "project", "cave", "country" or "continent"
+        :return: list of kalimain.shapes.GroupShape
+        """
+        from kalimain.shapes import ShapeStore
+
+        return ShapeStore(self.engine).mean_shapes(by)
+
+    def measures(self, names=None, hand_ids=None):
+        """ Table of registered hand measures, computed first when missing (see kalimain.measures)
+
+        :param names: names of measures (None = all registered measures)
+        :param hand_ids: ids of hands (None = all hands with landmarks)
+        :return: kalimain.measures.MeasureTable
+        """
+        from kalimain.measures import MeasureStore
+
+        return MeasureStore(self.engine).table(names, hand_ids)
+
+    def measure_pigments(self, restart=False, project_id=None, processes=None, margin=None, observer=None):
+        """ Measure pigment colour inside and around stored hands (resumable)
+
+        :param restart: if True, ignore previous checkpoint
+        :param project_id: if not None, only measure hands of that project
+        :param processes: number of worker processes
+        :param margin: width of ring around hand outline, relative to hand size (None = default)
+        :param observer: progress observer
+        :return: Progress at the end of job
+        """
+        from kalimain.jobs import PigmentStatisticsJob
+        from kalimain.pigment import MARGIN
+
+        job = PigmentStatisticsJob(self.session_factory, processes=processes, project_id=project_id,
+                                   margin=margin if margin is not None else MARGIN)
+        if observer is not None:
+            job.progress_notifier.add_observer(observer)
+
+        return job.run(restart)
+
+    def recompute(self, restart=False, project_id=None, processes=None, observer=None):
+        """ Recompute features of stored hands (resumable)
+
+        :param restart: if True, ignore previous checkpoint
+        :param project_id: if not None, only recompute hands of that project
+        :param processes: number of worker processes
+        :param observer: progress observer
+        :return: Progress at the end of job
+        """
+        from kalimain.jobs import RecomputeFeaturesJob
+
+        job = RecomputeFeaturesJob(self.session_factory, processes=processes, project_id=project_id)
+        if observer is not None:
+            job.progress_notifier.add_observer(observer)
+
+        progress = job.run(restart)
+        if self._model is not None:
+            self._model.hand_model.reset_similarity_index()
+
+        return progress
+
+    def shape_distances(self, hand_ids=None, filename=None, memory_budget=None):
+        """ Matrix of Procrustes distances between stored hand shapes
+
+        :param hand_ids: ids of hands (None = all hands with stored shape)
+        :param filename: if not None, matrix is written to that .npy file (memory mapped)
+        :param memory_budget: memory used by a block of distances computed at once (bytes)
+        :return: (hand ids, distance matrix)
+        """
+        from kalimain.shapes import ShapeStore, MEMORY_BUDGET
+
+        return ShapeStore(self.engine).distances(hand_ids, filename, memory_budget=memory_budget or MEMORY_BUDGET)
+
+    def similar_hands(self, hand_id, k=10):
+        """ k hands (of all projects) whose finger length profiles are most similar to hand
+
+        :param hand_id:
+        :param k: number of hands
+        :return: list of kalimain.readmodel.SimilarHandView sorted by distance
+        """
+        return self.model.hand_model.similar_hands(hand_id, k)
+
+    def check_summaries(self, rebuild=False):
+        """ Check stored hand statistics against hands table
+
+        :param rebuild: if True, rebuild statistics when inconsistent
+        :return: list of kalimain.summary.Mismatch found before any rebuild
+        """
+        with self.engine.begin() as connection:
+            mismatches = summary.check(connection)
+            if mismatches and rebuild:
+                summary.rebuild(connection)
+
+        return mismatches
+
+    def summary(self, scope="all", scope_id=summary.ALL):
+        """ Summary of hands of image, cave, project or of all hands (stored statistics lookup)
+
+        :param scope: "all", "project", "cave" or "image"
+        :param scope_id: id of image, cave or project
+        :return: kalimain.summary.ScopeSummary (None if scope has no hand)
+        """
+        with self.engine.connect() as connection:
+            return summary.summary(connection, scope, scope_id)
+
+    def spatial_autocorrelation(self, variable="manning", distance=None, k=8, inverse=False, nb_permutations=0,
+                                seed=None):
+        """ Spatial autocorrelation of the mean of variable per cave
+
+        :param variable: Manning index or finger length (see kalimain.analytics.VARIABLES)
+        :param distance: distance band in km (None = k nearest caves)
+        :param k: number of nearest caves (when distance is None)
+        :param inverse: if True, weights are inverse distances (binary weights otherwise)
+        :param nb_permutations: number of permutations of global statistics p-values (0 = none)
+        :param seed: random seed of permutations
+        :return: kalimain.spatial.SpatialAutocorrelation
+        """
+        from kalimain.spatial import SpatialStatistics
+
+        settings = (distance, k if distance is None else None, inverse)
+        if settings not in self._spatial:
+            self._spatial[settings] = SpatialStatistics(self.engine, distance, k, inverse)
+
+        return self._spatial[settings].compute(variable, nb_permutations, seed)
+
+    def statistics(self, variable="manning", by=None):
+        """ Hand count, left hand count and summary of variable, per group
+
+        :param variable: Manning index or finger length (see kalimain.analytics.VARIABLES)
+        :param by: None, "project", "cave", "country" or "continent"
+        :return: list of kalimain.analytics.Summary
+        """
+        return self.analytics.summaries(variable, by)
+
+    def update_measures(self, names=None):
+        """ Compute registered hand measures of hands without (current) value, in batch
+
+        :param names: names of measures (None = all registered measures)
+        :return: dict of number of values computed, by measure name
+        """
+        from kalimain.measures import MeasureStore
+
+        return MeasureStore(self.engine).update(names)
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+""" Kalimain command line interface
+
+Headless commands running on the Kalimain database, without Tk:
+
+    kalimain import caves|landmarks|images ...
+    kalimain export TABLE FILE
+    kalimain recompute
+    kalimain pigment [--margin RATIO]
+    kalimain stats [--by GROUP]
+    kalimain summary [--rebuild]
+    kalimain compare GROUP GROUP [--by GROUP]
+    kalimain cluster [--features SET] [--refit] [--dbscan EPS]
+    kalimain similar HAND [-k K]
+    kalimain spatial [--band KM | -k K]
+    kalimain shapes [--rebuild] [--by GROUP] [--distances FILE]
+    kalimain measures [NAME ...] [--update]
+    kalimain dedupe
+
+Only argparse is imported at start: the database layer is imported by the
+command handlers, so that "kalimain --help" is instant.
+"""
+import argparse
+import sys
+from collections import Counter
+
+
+def _progress(unit):
+    from kalimain.jobs import PrintProgress
+
+    return PrintProgress(unit)
+
+
+def _api(args):
+    from kalimain import create_kalimain_engine
+    from kalimain.api import Kalimain
+
+    return Kalimain(create_kalimain_engine(args.database, args.echo))
+
+
+def import_command(args):
+    api = _api(args)
+    if args.kind == "caves":
+        if args.project is None:
+            raise SystemExit("kalimain import caves: --project is required")
+        for filename in args.files:
+            report = api.import_caves(filename, args.project)
+            print("%s: %d read, %d duplicates, %d geocoded" % (filename, report.read, report.duplicates,
+                                                               report.geocoded))
+    elif args.kind == "landmarks":
+        for filename in args.files:
+            print("%s: %s" % (filename, api.import_landmarks(filename, args.chunk_size)))
+    else:
+        if args.cave is None:
+            raise SystemExit("kalimain import images: --cave is required")
+        for directory in args.files:
+            print("%s: %s" % (directory, api.import_images(directory, args.cave, _progress("images"))))
+
+
+def export_command(args):
+    filters = dict(project_id=args.project, cave_id=args.cave, country=args.country, continent=args.continent)
+    progress = _api(args).export(args.table, args.file, args.chunk_size, _progress("rows"),
+                                 **{key: value for key, value in filters.items() if value is not None})
+    print("%d rows exported to %s" % (progress.done, args.file))
+
+
+def pigment_command(args):
+    progress = _api(args).measure_pigments(args.restart, args.project, args.processes, args.margin,
+                                           _progress("hands"))
+    print("%d hands measured (%d skipped)" % (progress.done, progress.skipped))
+
+
+def recompute_command(args):
+    progress = _api(args).recompute(args.restart, args.project, args.processes, _progress("hands"))
+    print("%d hands recomputed" % progress.done)
+
+
+def spatial_command(args):
+    result = _api(args).spatial_autocorrelation(args.variable, args.band, args.k, args.inverse, args.permutations,
+                                                args.seed)
+    print("%d caves, %d neighbour links" % (len(result.cave_ids), result.neighbours.sum()))
+    for statistic in (result.moran, result.geary):
+        print("%s = %.4f (expected %.4f), z = %.3f, p = %.4g%s" % (
+            statistic.name, statistic.value, statistic.expected, statistic.z_score, statistic.p_value,
+            ", permutation p = %.4g" % statistic.p_permutation if statistic.p_permutation is not None else ""))
+    order = result.hotspots.argsort()
+    for title, caves in (("Hot spots", order[::-1][:args.top]), ("Cold spots", order[:args.top])):
+        print(title)
+        for i in caves:
+            print("  cave %d: mean %.4f (n = %d), Gi* z = %.3f, local I = %.3f" % (
+                result.cave_ids[i], result.values[i], result.counts[i], result.hotspots[i], result.local_moran[i]))
+
+
+def stats_command(args):
+    api = _api(args)
+    if args.by is None:
+        for table, count in api.counts().items():
+            print("%-10s %d" % (table, count))
+
+    print("%-30s %8s %8s %10s %10s %10s %10s" % (args.by or "", "hands", "left", "mean", "std", "min", "max"))
+    for summary in api.statistics(args.variable, args.by):
+        print("%-30s %8d %8d %10s %10s %10s %10s" % (str(summary.label)[:30], summary.hands, summary.left,
+                                                  *("%.4f" % value if value is not None else "-" for value in
+                                                    summary[5:])))
+
+
+def compare_command(args):
+    groups = [int(group) if args.by in ("project", "cave") else group for group in (args.group_a, args.group_b)]
+    comparison = _api(args).compare(*groups, args.variable, args.by, args.statistic, args.resamples,
+                                    args.confidence, args.seed, args.processes)
+    print("%s %s of %s: %s %s (n = %d) - %s %s (n = %d)" % (comparison.statistic, comparison.variable, comparison.by,
+                                                            comparison.by, comparison.group_a, comparison.count_a,
+                                                            comparison.by, comparison.group_b, comparison.count_b))
+    print("difference = %.6f, %g%% CI [%.6f, %.6f], permutation p-value = %.4g (%d resamples)" % (
+        comparison.difference, 100 * comparison.confidence, comparison.low, comparison.high, comparison.p_value,
+        comparison.nb_resamples))
+
+
+def cluster_command(args):
+    api = _api(args)
+    if args.dbscan is not None:
+        hand_ids, clusters = api.dbscan(args.dbscan, args.min_samples)
+    else:
+        hand_ids, clusters = api.cluster(args.features, args.refit, args.k, args.seed)
+    for label, count in sorted(Counter(clusters.tolist()).items()):
+        print("%-10s %8d hands" % ("noise" if label < 0 else "cluster %d" % label, count))
+
+
+def dedupe_command(args):
+    api = _api(args)
+    for image_id, other_id, distance in api.duplicate_images(args.radius):
+        print("image %d ~ image %d (hamming distance %d)" % (image_id, other_id, distance))
+    for cave_id, other_id, distance in api.duplicate_caves(args.tolerance):
+        print("cave %d ~ cave %d (%.3f km)" % (cave_id, other_id, distance))
+
+
+def measures_command(args):
+    from kalimain.measures import get_measures
+
+    api = _api(args)
+    if args.update:
+        for name, count in api.update_measures(args.names or None).items():
+            print("%s: %d values computed" % (name, count))
+    table = api.measures(args.names or None)
+    for measure, column in zip(get_measures(table.names), table.values.T):
+        values = column[column == column]
+        print("%-12s v%-3d %8d hands  mean %12.4f  %s" % (measure.name, measure.version, len(values),
+                                                          values.mean() if len(values) else float("nan"),
+                                                          measure.description))
+
+
+def shapes_command(args):
+    api = _api(args)
+    print("%d hands aligned" % api.align_shapes(args.rebuild))
+    for group in api.mean_shapes(args.by):
+        print("%-30s %8d hands" % (str(group.key or "all")[:30], group.count))
+    if args.distances is not None:
+        hand_ids, matrix = api.shape_distances(filename=args.distances, memory_budget=args.memory * 2 ** 20)
+        print("%d x %d distance matrix written to %s" % (*matrix.shape, args.distances))
+
+
+def similar_command(args):
+    for hand in _api(args).similar_hands(args.hand, args.k):
+        print("hand %d (distance %.4f): image %s, cave %s, project %s" % (hand.id, hand.distance, hand.image,
+                                                                          hand.cave, hand.project))
+
+
+def summary_command(args):
+    api = _api(args)
+    mismatches = api.check_summaries(args.rebuild)
+    for mismatch in mismatches[:args.max_report]:
+        print("%s %s: %s = %s (expected %s)" % mismatch)
+    if not mismatches:
+        print("Hand statistics are consistent")
+    elif args.rebuild:
+        print("%d mismatch(es), hand statistics rebuilt" % len(mismatches))
+    else:
+        print("%d mismatch(es), run with --rebuild to fix" % len(mismatches))
+        sys.exit(1)
+
+
+def parser():
+    """ Command line parser
+
+    :return: argparse.ArgumentParser
+    """
+    main_parser = argparse.ArgumentParser(prog="kalimain", description="Kalimain headless commands")
+    main_parser.add_argument("--database", help="database URL (default: Kalimain SQLite database)")
+    main_parser.add_argument("--echo", action="store_true", help="log SQL statements")
+    subparsers = main_parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="import caves, landmarks or images")
+    import_parser.add_argument("kind", choices=("caves", "landmarks", "images"))
+    import_parser.add_argument("files", nargs="+", help="cave or landmark files, or image folders")
+    import_parser.add_argument("--project", help="project name of imported caves (created if necessary)")
+    import_parser.add_argument("--cave", type=int, help="cave id of imported images")
+    import_parser.add_argument("--chunk-size", type=int, default=10000, help="landmarks: hands per transaction")
+    import_parser.set_defaults(handler=import_command)
+
+    export_parser = subparsers.add_parser("export", help="export table or hands view to CSV or Parquet file")
+    export_parser.add_argument("table", help="table name, or hands_view for hands with image, cave and project")
+    export_parser.add_argument("file", help="output .csv or .parquet file")
+    export_parser.add_argument("--chunk-size", type=int, default=10000)
+    export_parser.add_argument("--project", type=int, help="hands_view: project id")
+    export_parser.add_argument("--cave", type=int, help="hands_view: cave id")
+    export_parser.add_argument("--country", help="hands_view: country")
+    export_parser.add_argument("--continent", help="hands_view: continent")
+    export_parser.set_defaults(handler=export_command)
+
+    recompute_parser = subparsers.add_parser("recompute", help="recompute hand features (resumable)")
+    recompute_parser.add_argument("--restart", action="store_true", help="ignore previous checkpoint")
+    recompute_parser.add_argument("--project", type=int, help="only recompute hands of project id")
+    recompute_parser.add_argument("--processes", type=int, help="number of worker processes (0 = no pool)")
+    recompute_parser.set_defaults(handler=recompute_command)
+
+    pigment_parser = subparsers.add_parser("pigment", help="measure pigment colour of hands (resumable)")
+    pigment_parser.add_argument("--restart", action="store_true", help="ignore previous checkpoint")
+    pigment_parser.add_argument("--project", type=int, help="only measure hands of project id")
+    pigment_parser.add_argument("--processes", type=int, help="number of worker processes (0 = no pool)")
+    pigment_parser.add_argument("--margin", type=float, help="width of ring around hands, relative to hand size")
+    pigment_parser.set_defaults(handler=pigment_command)
+
+    stats_parser = subparsers.add_parser("stats", help="hand counts and Manning index or finger length summary")
+    stats_parser.add_argument("--by", choices=("project", "cave", "country", "continent"))
+    stats_parser.add_argument("--variable", default="manning", choices=("manning", "D1", "D2", "D3", "D4", "D5"))
+    stats_parser.set_defaults(handler=stats_command)
+
+    spatial_parser = subparsers.add_parser("spatial", help="spatial autocorrelation of variable across caves")
+    spatial_parser.add_argument("--variable", default="manning", choices=("manning", "D1", "D2", "D3", "D4", "D5"))
+    spatial_parser.add_argument("--band", type=float, help="neighbours within distance band in km")
+    spatial_parser.add_argument("-k", type=int, default=8, help="number of nearest caves (without --band)")
+    spatial_parser.add_argument("--inverse", action="store_true", help="inverse distance weights")
+    spatial_parser.add_argument("--permutations", type=int, default=0, help="number of permutations of p-values")
+    spatial_parser.add_argument("--seed", type=int, help="random seed of permutations")
+    spatial_parser.add_argument("--top", type=int, default=5, help="number of hot and cold spots printed")
+    spatial_parser.set_defaults(handler=spatial_command)
+
+    summary_parser = subparsers.add_parser("summary", help="check (and rebuild) stored hand statistics")
+    summary_parser.add_argument("--rebuild", action="store_true", help="rebuild statistics when inconsistent")
+    summary_parser.add_argument("--max-report", type=int, default=20, help="maximum number of mismatches printed")
+    summary_parser.set_defaults(handler=summary_command)
+
+    compare_parser = subparsers.add_parser("compare", help="bootstrap interval and permutation test between groups")
+    compare_parser.add_argument("group_a", help="project or cave id, or country or continent name")
+    compare_parser.add_argument("group_b", help="project or cave id, or country or continent name")
+    compare_parser.add_argument("--by", default="cave", choices=("project", "cave", "country", "continent"))
+    compare_parser.add_argument("--variable", default="manning", choices=("manning", "D1", "D2", "D3", "D4", "D5"))
+    compare_parser.add_argument("--statistic", default="mean", choices=("mean", "median", "std"))
+    compare_parser.add_argument("--resamples", type=int, default=10000, help="number of resamples")
+    compare_parser.add_argument("--confidence", type=float, default=0.95, help="confidence level of interval")
+    compare_parser.add_argument("--seed", type=int, help="random seed")
+    compare_parser.add_argument("--processes", type=int, help="number of worker processes (0 = no pool)")
+    compare_parser.set_defaults(handler=compare_command)
+
+    measures_parser = subparsers.add_parser("measures", help="registered hand measures (computed when missing)")
+    measures_parser.add_argument("names", nargs="*", help="names of measures (default: all)")
+    measures_parser.add_argument("--update", action="store_true", help="report number of values computed")
+    measures_parser.set_defaults(handler=measures_command)
+
+    shapes_parser = subparsers.add_parser("shapes", help="Procrustes alignment and mean shapes of hands")
+    shapes_parser.add_argument("--rebuild", action="store_true", help="align all hands again")
+    shapes_parser.add_argument("--by", choices=("project", "cave", "country", "continent"))
+    shapes_parser.add_argument("--distances", help="write matrix of Procrustes distances to .npy file")
+    shapes_parser.add_argument("--memory", type=int, default=64, help="memory budget of distance blocks (MB)")
+    shapes_parser.set_defaults(handler=shapes_command)
+
+    similar_parser = subparsers.add_parser("similar", help="hands whose finger length profiles are most similar")
+    similar_parser.add_argument("hand", type=int, help="hand id")
+    similar_parser.add_argument("-k", type=int, default=10, help="number of similar hands")
+    similar_parser.set_defaults(handler=similar_command)
+
+    cluster_parser = subparsers.add_parser("cluster", help="cluster hands (only hands without cluster unless refit)")
+    cluster_parser.add_argument("--features", default="profile", choices=("profile", "shape", "both"))
+    cluster_parser.add_argument("--refit", action="store_true", help="cluster all hands again")
+    cluster_parser.add_argument("-k", type=int, default=8, help="number of clusters of new fits")
+    cluster_parser.add_argument("--seed", type=int, help="random seed")
+    cluster_parser.add_argument("--dbscan", type=float, metavar="EPS",
+                                help="DBSCAN of shape coordinates instead (requires scikit-learn)")
+    cluster_parser.add_argument("--min-samples", type=int, default=10, help="DBSCAN: minimum number of neighbours")
+    cluster_parser.set_defaults(handler=cluster_command)
+
+    dedupe_parser = subparsers.add_parser("dedupe", help="report near-duplicate images and duplicate caves")
+    dedupe_parser.add_argument("--radius", type=int, help="maximum hamming distance of image perceptual hashes")
+    dedupe_parser.add_argument("--tolerance", type=float, help="maximum distance between caves in km")
+    dedupe_parser.set_defaults(handler=dedupe_command)
+
+    return main_parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
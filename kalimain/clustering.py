@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+
+""" Clustering of hands
+
+Hands are clustered with mini-batch k-means on standardized feature vectors:
+finger length profiles (see kalimain.similarity), Procrustes shape
+coordinates (see kalimain.shapes), or both. The state of k-means (centers,
+number of hands seen by each center and standardization) and the cluster of
+every hand are stored (see database.Clustering and database.HandCluster), so
+that hands annotated later update the centers with one more mini-batch and
+are assigned to a cluster, without fitting all hands again.
+
+DBSCAN of Procrustes shape coordinates is available when scikit-learn is
+installed. It is not incremental: hands added later are not assigned.
+"""
+from collections import namedtuple
+
+import numpy as np
+from sqlalchemy import select, func, delete, insert
+
+import kalimain
+from kalimain.analytics import VARIABLES, NO_CAVE, cave_groups, group_codes
+from kalimain.database import Hand, Image, HandShape, Clustering, HandCluster
+from kalimain.dataset import read_chunks
+from kalimain.features import NB_LANDMARKS
+from kalimain.shapes import ShapeStore, to_landmarks
+from kalimain.similarity import profiles_statement, hand_profiles
+
+FEATURE_SETS = ("profile", "shape", "both")
+
+# Name of stored DBSCAN clusters (see HandCluster)
+DBSCAN = "dbscan"
+
+# Number of rows whose nearest center is computed at once
+ASSIGN_BLOCK = 2 ** 16
+
+ClusterHistogram = namedtuple("ClusterHistogram", ["features", "variable", "by", "group", "bin_edges", "counts"])
+
+
+def kmeans_plusplus(vectors, nb_clusters, rng):
+    """ Initial centers of k-means (k-means++ seeding)
+
+    :param vectors: (N, D) array
+    :param nb_clusters: number of clusters
+    :param rng: numpy.random.Generator
+    :return: (nb_clusters, D) array
+    """
+    if len(vectors) < nb_clusters:
+        raise ValueError("Cannot initialize %d clusters from %d hands" % (nb_clusters, len(vectors)))
+
+    centers = np.empty((nb_clusters, vectors.shape[1]))
+    centers[0] = vectors[rng.integers(len(vectors))]
+    distances = ((vectors - centers[0]) ** 2).sum(axis=1)
+    for i in range(1, nb_clusters):
+        total = distances.sum()
+        centers[i] = vectors[rng.choice(len(vectors), p=distances / total) if total > 0 else
+                             rng.integers(len(vectors))]
+        np.minimum(distances, ((vectors - centers[i]) ** 2).sum(axis=1), out=distances)
+
+    return centers
+
+
+def nearest_centers(vectors, centers):
+    """ Index of nearest center of every vector
+
+    :param vectors: (N, D) array
+    :param centers: (K, D) array
+    :return: (N,) array
+    """
+    labels = np.empty(len(vectors), dtype=np.int64)
+    center_norms = (centers ** 2).sum(axis=1)
+    for start in range(0, len(vectors), ASSIGN_BLOCK):
+        block = vectors[start:start + ASSIGN_BLOCK]
+        labels[start:start + ASSIGN_BLOCK] = np.argmin(center_norms - 2 * block @ centers.T, axis=1)
+
+    return labels
+
+
+def cluster_histogram(values, labels, bin_edges, nb_clusters):
+    """ Histogram of values per cluster
+
+    Values outside of bin edges and hands without cluster (label -1) are left out
+    :param values: (N,) array
+    :param labels: (N,) array of clusters
+    :param bin_edges: (B + 1,) array
+    :param nb_clusters: number of clusters
+    :return: (B, nb_clusters) array of counts
+    """
+    nb_bins = len(bin_edges) - 1
+    keep = (labels >= 0) & (labels < nb_clusters) & (values >= bin_edges[0]) & (values <= bin_edges[-1])
+    bins = np.clip(np.searchsorted(bin_edges, values[keep], side="right") - 1, 0, nb_bins - 1)
+
+    return np.bincount(bins * nb_clusters + labels[keep], minlength=nb_bins * nb_clusters).reshape(nb_bins,
+                                                                                                    nb_clusters)
+
+
+def dbscan(vectors, eps=0.05, min_samples=10):
+    """ DBSCAN clusters of vectors (requires scikit-learn)
+
+    :param vectors: (N, D) array
+    :param eps: maximum distance between neighbours
+    :param min_samples: minimum number of neighbours of core points
+    :return: (N,) array of clusters (-1 = noise)
+    """
+    from sklearn.cluster import DBSCAN as SkDBSCAN
+
+    return SkDBSCAN(eps=eps, min_samples=min_samples).fit_predict(vectors)
+
+
+class MiniBatchKMeans:
+    """ Mini-batch k-means (Sculley, 2010)
+
+    Every center moves towards the mean of its vectors in a batch, with a
+    learning rate of 1 / (number of vectors it has seen)
+    """
+    def __init__(self, nb_clusters=8, batch_size=1024, seed=None, centers=None, counts=None):
+        """
+
+        :param nb_clusters: number of clusters
+        :param batch_size: number of vectors per mini-batch
+        :param seed: random seed (None = unpredictable)
+        :param centers: (nb_clusters, D) array of centers of previous fit (None = not fitted)
+        :param counts: (nb_clusters,) array of number of vectors seen by centers of previous fit
+        """
+        self.nb_clusters = nb_clusters
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+        self.centers = centers
+        self.counts = counts if counts is not None or centers is None else np.zeros(nb_clusters)
+
+    def fit(self, vectors, nb_epochs=2):
+        """ Fit centers with shuffled passes over vectors
+
+        :param vectors: (N, D) array
+        :param nb_epochs: number of passes
+        :return: self
+        """
+        for _ in range(nb_epochs):
+            self.partial_fit(vectors[self.rng.permutation(len(vectors))])
+
+        return self
+
+    def partial_fit(self, vectors):
+        """ Update centers with mini-batches of vectors (centers are initialized on first call)
+
+        :param vectors: (N, D) array
+        :return: self
+        """
+        if self.centers is None:
+            self.centers = kmeans_plusplus(vectors[:max(10 * self.batch_size, self.nb_clusters)], self.nb_clusters,
+                                           self.rng)
+            self.counts = np.zeros(self.nb_clusters)
+
+        for start in range(0, len(vectors), self.batch_size):
+            batch = vectors[start:start + self.batch_size]
+            labels = nearest_centers(batch, self.centers)
+            batch_counts = np.bincount(labels, minlength=self.nb_clusters)
+            sums = np.zeros_like(self.centers)
+            np.add.at(sums, labels, batch)
+            seen = batch_counts > 0
+            self.counts += batch_counts
+            self.centers[seen] += (sums[seen] - batch_counts[seen, np.newaxis] * self.centers[seen]) / \
+                self.counts[seen, np.newaxis]
+
+        return self
+
+    def predict(self, vectors):
+        """ Cluster of every vector
+
+        :param vectors: (N, D) array
+        :return: (N,) array
+        """
+        return nearest_centers(vectors, self.centers)
+
+
+class ClusterStore:
+    """ Stored clusters of hands, per feature set
+
+    """
+    def __init__(self, engine=None, nb_clusters=8, batch_size=1024, nb_epochs=2, seed=None, chunk_size=10000):
+        """
+
+        :param engine: SQLAlchemy engine (default: kalimain.ENGINE)
+        :param nb_clusters: number of clusters of new fits
+        :param batch_size: number of hands per mini-batch
+        :param nb_epochs: number of passes over hands of new fits
+        :param seed: random seed (None = unpredictable)
+        :param chunk_size: number of rows read or written at once
+        """
+        self.engine = engine if engine is not None else kalimain.ENGINE
+        self.nb_clusters = nb_clusters
+        self.batch_size = batch_size
+        self.nb_epochs = nb_epochs
+        self.seed = seed
+        self.chunk_size = chunk_size
+
+        # (features, variable) -> (cave ids, values, clusters) of hands
+        self._values = dict()
+
+    @staticmethod
+    def _check(features):
+        if features not in FEATURE_SETS:
+            raise ValueError("Unknown feature set '%s' (valid sets: %s)" % (features, ", ".join(FEATURE_SETS)))
+
+    def _vectors(self, features, missing_only):
+        """ Hand ids and feature vectors of hands (without cluster if missing_only)
+
+        """
+        assigned = select(HandCluster.hand_id).where(HandCluster.name == features)
+        hand_ids, vectors = [], []
+        if features in ("profile", "both"):
+            statement = profiles_statement()
+            if missing_only:
+                statement = statement.where(Hand.id.notin_(assigned))
+            with self.engine.connect() as connection:
+                rows = read_chunks(connection, statement, np.dtype(np.float64), self.chunk_size)
+            hand_ids.append(rows[:, 0].astype(np.int64))
+            vectors.append(hand_profiles(rows[:, 1:-1], rows[:, -1] > 0))
+        if features in ("shape", "both"):
+            store = ShapeStore(self.engine, chunk_size=self.chunk_size)
+            store.update()
+            shape_ids, shapes = store.shapes(condition=HandShape.hand_id.notin_(assigned) if missing_only else None)
+            hand_ids.append(shape_ids)
+            vectors.append(to_landmarks(shapes).reshape(len(shapes), 2 * NB_LANDMARKS))
+
+        if len(hand_ids) == 1:
+            return hand_ids[0], vectors[0]
+
+        # Both: hands with a profile and a shape (both are sorted by hand id)
+        common, profile_index, shape_index = np.intersect1d(*hand_ids, assume_unique=True, return_indices=True)
+        return common, np.hstack((vectors[0][profile_index], vectors[1][shape_index]))
+
+    def _store_labels(self, connection, features, hand_ids, labels):
+        for start in range(0, len(hand_ids), self.chunk_size):
+            stop = start + self.chunk_size
+            connection.execute(insert(HandCluster), [dict(name=features, hand_id=int(hand_id), cluster=int(label))
+                                                     for hand_id, label in zip(hand_ids[start:stop],
+                                                                               labels[start:stop])])
+
+    def dbscan(self, eps=0.05, min_samples=10):
+        """ DBSCAN clusters of Procrustes shape coordinates of all hands (requires scikit-learn)
+
+        Clusters are stored with name DBSCAN
+        :param eps: maximum Procrustes coordinate distance between neighbours
+        :param min_samples: minimum number of neighbours of core hands
+        :return: number of clusters (noise excluded)
+        """
+        hand_ids, vectors = self._vectors("shape", missing_only=False)
+        labels = dbscan(vectors, eps, min_samples) if len(vectors) else np.empty(0, dtype=np.int64)
+        with self.engine.begin() as connection:
+            connection.execute(delete(HandCluster).where(HandCluster.name == DBSCAN))
+            self._store_labels(connection, DBSCAN, hand_ids, labels)
+        self.invalidate()
+
+        return int(labels.max(initial=-1)) + 1
+
+    def histogram(self, features, variable, bin_edges, by=None, group=None):
+        """ Histogram of variable per cluster, for hands of group
+
+        :param features: "profile", "shape", "both" or DBSCAN
+        :param variable: Manning index or finger length (see kalimain.analytics.VARIABLES)
+        :param bin_edges: (B + 1,) array (e.g. bin edges of kalimain.analytics.Distribution)
+        :param by: None (all hands), "project", "cave", "country" or "continent"
+        :param group: key of group (project or cave id, country or continent name)
+        :return: ClusterHistogram with (B, number of clusters) counts
+        """
+        if variable not in VARIABLES:
+            raise ValueError("Unknown variable '%s' (valid variables: %s)" % (variable, ", ".join(VARIABLES)))
+
+        with self.engine.connect() as connection:
+            if (features, variable) not in self._values:
+                column = getattr(Hand, variable)
+                data = read_chunks(connection, select(func.coalesce(Image.cave_id, NO_CAVE), column,
+                                                      HandCluster.cluster).select_from(HandCluster).join(
+                    Hand, HandCluster.hand_id == Hand.id).outerjoin(Image, Hand.image_id == Image.id).where(
+                    HandCluster.name == features, column.isnot(None)), np.dtype(np.float64), self.chunk_size)
+                self._values[features, variable] = (data[:, 0].astype(np.int64), data[:, 1],
+                                                    data[:, 2].astype(np.int64))
+            cave_ids, values, labels = self._values[features, variable]
+            nb_clusters = connection.execute(select(Clustering.nb_clusters).where(Clustering.name == features)
+                                             ).scalar() or int(labels.max(initial=-1)) + 1
+            if by is not None:
+                in_group = group_codes(cave_ids, cave_groups(connection)[by][0], [group]) == 0
+                values, labels = values[in_group], labels[in_group]
+
+        return ClusterHistogram(features, variable, by, group, np.asarray(bin_edges),
+                                cluster_histogram(values, labels, np.asarray(bin_edges), nb_clusters))
+
+    def invalidate(self):
+        """ Clear cached values and clusters of hands
+
+        :return:
+        """
+        self._values.clear()
+
+    def labels(self, features="profile"):
+        """ Stored clusters of hands
+
+        :param features: "profile", "shape", "both" or DBSCAN
+        :return: (hand ids, clusters), ordered by hand id
+        """
+        with self.engine.connect() as connection:
+            data = read_chunks(connection, select(HandCluster.hand_id, HandCluster.cluster).where(
+                HandCluster.name == features).order_by(HandCluster.hand_id), np.dtype(np.int64), self.chunk_size)
+
+        return data[:, 0], data[:, 1]
+
+    def update(self, features="profile", refit=False):
+        """ Assign hands without cluster, updating k-means centers with their mini-batches
+
+        K-means is fitted on all hands when there is no stored fit, or on refit
+        :param features: "profile", "shape" or "both"
+        :param refit: if True, fit k-means on all hands again and reassign all hands
+        :return: number of assigned hands
+        """
+        self._check(features)
+        with self.engine.begin() as connection:
+            # Clusters of hands deleted by ORM flushes or under enforced foreign keys are already deleted with them
+            connection.execute(delete(HandCluster).where(HandCluster.hand_id.notin_(select(Hand.id))))
+            state = connection.execute(select(Clustering).where(Clustering.name == features)).mappings().first()
+
+        if state is None or refit:
+            hand_ids, vectors = self._vectors(features, missing_only=False)
+            if len(hand_ids) < self.nb_clusters:
+                return 0
+            offsets, scales = vectors.mean(axis=0), vectors.std(axis=0)
+            scales[scales == 0] = 1
+            kmeans = MiniBatchKMeans(self.nb_clusters, self.batch_size, self.seed).fit(
+                (vectors - offsets) / scales, self.nb_epochs)
+        else:
+            hand_ids, vectors = self._vectors(features, missing_only=True)
+            if len(hand_ids) == 0:
+                return 0
+            offsets, scales = (np.frombuffer(state[name]) for name in ("offsets", "scales"))
+            kmeans = MiniBatchKMeans(state["nb_clusters"], self.batch_size, self.seed,
+                                     np.frombuffer(state["centers"]).reshape(state["nb_clusters"], -1).copy(),
+                                     np.frombuffer(state["counts"]).copy())
+            kmeans.partial_fit((vectors - offsets) / scales)
+
+        labels = kmeans.predict((vectors - offsets) / scales)
+        with self.engine.begin() as connection:
+            connection.execute(delete(Clustering).where(Clustering.name == features))
+            connection.execute(insert(Clustering).values(
+                name=features, nb_clusters=kmeans.nb_clusters, centers=kmeans.centers.tobytes(),
+                counts=kmeans.counts.tobytes(), offsets=offsets.tobytes(), scales=scales.tobytes()))
+            if state is None or refit:
+                connection.execute(delete(HandCluster).where(HandCluster.name == features))
+            self._store_labels(connection, features, hand_ids, labels)
+        self.invalidate()
+
+        return len(hand_ids)
@@ -15,7 +15,7 @@ from kalimain import __version__ as __kversion__
 from kalimain import __copyright__ as __kcopyright__
 from kalimain.buttons import ToggleButtonGroup
 from kalimain.controltools import Command, KState
-from kalimain.dialog import CaveDialog, ImageDialog, NewProjectDialog, OpenProjectDialog
+from kalimain.dialog import CaveDialog, ImageDialog, NewProjectDialog, OpenProjectDialog, ProgressWindow
 from kalimain.observer import Observer
 
 
@@ -55,6 +55,9 @@ class MainController(Controller):
     toggle_button_group = None
     mouse_button1 = None
 
+    # Delay between two polls of geocoding results (ms)
+    geocoding_poll_delay = 1000
+
     ##################
     # Observer classes
 
@@ -137,6 +140,7 @@ class MainController(Controller):
         self.view.add_cave_button.config(command=self.on_new_cave)
         self.view.delete_cave_button.config(command=self.on_delete_cave)
         self.view.add_image_button.config(command=self.on_add_image)
+        self.view.add_folder_button.config(command=self.on_add_folder)
         self.view.delete_image_button.config(command=self.on_delete_image)
 
     def _add_update_controls(self):
@@ -170,6 +174,7 @@ class MainController(Controller):
         self.view.left_bar_toggle_buttons[3].kstate = KState(self.view.left_bar_toggle_buttons[3], self.view, handstate)
         self.view.delete_cave_button.kstate = KState(self.view.delete_cave_button, self.view.cave_listbox, cliststate)
         self.view.add_image_button.kstate = KState(self.view.add_image_button, self.view.cave_listbox, cliststate)
+        self.view.add_folder_button.kstate = KState(self.view.add_folder_button, self.view.cave_listbox, cliststate)
         self.view.delete_image_button.kstate = KState(self.view.delete_image_button, self.view.image_listbox,
                                                       imgliststate)
         for scale in self.view.image_enhance_scale:
@@ -198,6 +203,10 @@ class MainController(Controller):
         # Add update controls
         self._add_update_controls()
 
+        # Retrieve secondary attributes of caves saved while offline
+        self.model.cave_model.backfill_secondary_attributes()
+        self.poll_geocoding()
+
     def add_observers_to_notifiers(self):
         """ Add observers to notifiers
 
@@ -216,6 +225,16 @@ class MainController(Controller):
             self.view))
         self.model.hand_model.hand_info_notifier.add_observer(MainController.HandInfoObserver(self.view))
 
+    def poll_geocoding(self):
+        """ Periodically apply geocoding results
+
+        :return:
+        """
+        try:
+            self.model.cave_model.poll_geocoding()
+        finally:
+            self.view.root.after(self.geocoding_poll_delay, self.poll_geocoding)
+
     ##################
     # Callback methods
     def on_left_bar_button0(self):
@@ -277,6 +296,27 @@ class MainController(Controller):
             if meta.result:
                 self.model.image_model.add_image(file.name, **meta.result)
 
+    def on_add_folder(self):
+        """ Add folder button callback
+
+        Ingest all images of folder tree in background
+        :return:
+        """
+        directory = filedialog.askdirectory(title="Import folder")
+        if directory:
+            cave_id = self.model.cave_model.current_object.id
+            ingest = self.model.image_model.new_ingest()
+            window = ProgressWindow(self.view.root, title="Import folder", on_cancel=ingest.cancel, unit="images")
+            ingest.progress_notifier.add_observer(window.observer)
+
+            def on_done(report):
+                self.model.image_model.after_ingest(cave_id)
+                messagebox.showinfo("Import folder", message="%d image(s) imported, %d duplicate(s) and %d unreadable "
+                                                             "file(s) skipped" % (report.inserted, report.duplicates,
+                                                                                  report.errors))
+
+            window.run(lambda: ingest.run(directory, cave_id), on_done)
+
     def on_delete_image(self):
         answer = messagebox.askokcancel("Delete image", "Are you sure you want to delete '%s'?" %
                                         self.view.image_listbox.get_selected_item())
@@ -365,11 +405,66 @@ class MainController(Controller):
 
 class DataDisplayController(Controller):
 
+    # Progress window of clusters updated in background
+    _cluster_window = None
+
+    ##################
+    # Observer classes
+
+    class StatisticsObserver(Controller.AddObserver):
+
+        def _update(self, observable, statistics):
+            self.view.display_statistics(statistics)
+
+    class ClusterHistogramObserver(Controller.AddObserver):
+
+        def _update(self, observable, histogram):
+            self.view.draw_histogram(self.view.selected_distribution, histogram.counts)
+
+    ####################
+    # Controller methods
     def add_controls(self):
-        pass
+        self.view.variable_box.bind("<<ComboboxSelected>>", self.on_select_statistics)
+        self.view.group_box.bind("<<ComboboxSelected>>", self.on_select_statistics)
+        self.view.cluster_box.bind("<<ComboboxSelected>>", self.on_select_group)
+        self.view.table.bind("<<TreeviewSelect>>", self.on_select_group)
+        # Refresh when tab is shown (only groups whose hands changed are recomputed)
+        self.view.root.bind("<Map>", self.on_select_statistics)
 
     def add_observers_to_notifiers(self):
-        pass
+        self.model.analytics_model.statistics_notifier.add_observer(
+            DataDisplayController.StatisticsObserver(self.view))
+        self.model.clustering_model.histogram_notifier.add_observer(
+            DataDisplayController.ClusterHistogramObserver(self.view))
+
+    ##################
+    # Callback methods
+    def on_select_group(self, event):
+        distribution = self.view.selected_distribution
+        if distribution is None or self.view.clusters is None:
+            self.view.draw_histogram(distribution)
+        elif not self.model.clustering_model.is_updated(self.view.clusters):
+            self.update_clusters(self.view.clusters)
+        else:
+            self.model.clustering_model.compute_histogram(self.view.clusters, self.view.variable,
+                                                          distribution.bin_edges, self.view.by, distribution.group)
+
+    def on_select_statistics(self, event):
+        self.model.analytics_model.compute(self.view.variable, self.view.by)
+
+    def update_clusters(self, features):
+        """ Update clusters in background (k-means fit of all hands on first use), then draw selected histogram
+
+        :param features: "profile", "shape" or "both"
+        :return:
+        """
+        if self._cluster_window is not None and self._cluster_window.winfo_exists():
+            return  # Histogram of group selected meanwhile is drawn once done
+
+        self._cluster_window = ProgressWindow(self.view.root, title="Clusters",
+                                              message="Clustering hands (%s)..." % features)
+        self._cluster_window.run(lambda: self.model.clustering_model.update(features),
+                                 lambda nb_hands: self.on_select_group(None))
 
 
 class KController(Controller):
@@ -420,7 +515,7 @@ class KController(Controller):
         :return:
         """
         def is_project_set():
-            return True if self.view.project_label.cget("text") else False
+            return self.model.project_model.current_object is not None
 
         # State of "add cave" button depends on whether project is set or not
         self.view.views[0].add_cave_button.kstate = KState(self.view.views[0].add_cave_button,
@@ -435,6 +530,8 @@ class KController(Controller):
                         menu.entryconfig(item, command=self.on_new_project)
                     elif entry == "open project":
                         menu.entryconfig(item, command=self.on_open_project)
+                    elif entry == "import caves":
+                        menu.entryconfig(item, command=self.on_import_caves)
                     elif entry == "exit":
                         menu.entryconfig(item, command=self.on_close)
                     elif entry == "about":
@@ -455,6 +552,22 @@ class KController(Controller):
         # TODO: close all files explicitly that are opened before closing the main window
         self.view.root.destroy()
 
+    def on_import_caves(self):
+        """ Import caves menu callback
+
+        :return:
+        """
+        if self.model.project_model.current_object is None:
+            messagebox.showinfo("Import caves", message="Create or open a project first")
+            return
+
+        filename = filedialog.askopenfilename(title="Import caves", filetypes=[("Cave files", "*.csv *.gpx *.kml"),
+                                                                              ("All files", "*")])
+        if filename:
+            report = self.model.cave_model.import_caves(filename)
+            messagebox.showinfo("Import caves", message="%d cave(s) imported, %d duplicate(s) skipped" %
+                                (len(report.caves), report.duplicates))
+
     def on_new_project(self):
         w_dialog = NewProjectDialog(self.view.root, title="New project", default_name="Project %d" % (len(
             self.model.project_model.projects) + 1))
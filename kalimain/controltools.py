@@ -5,6 +5,7 @@
 More detailed description.
 """
 import tkinter as tk
+from tkinter import messagebox
 
 from kalimain.observer import Observer
 
@@ -16,6 +17,27 @@ def combine_commands(*commands):
     return combined_command
 
 
+class KCatcher:
+    """ Catch GUI exceptions
+
+    """
+    def __init__(self, func, subst, widget):
+        self.func = func
+        self.subst = subst
+        self.widget = widget
+
+    def __call__(self, *args):
+        try:
+            if self.subst:
+                args = self.subst(*args)
+            return self.func(*args)
+        except Exception as e:
+            if isinstance(e, Warning):
+                messagebox.showwarning(title=e.__class__.__name__, message=e)
+            else:
+                messagebox.showerror(title=e.__class__.__name__, message=e)
+
+
 class Command(Observer):
 
     def __init__(self, observable, *commands):
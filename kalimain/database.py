@@ -4,20 +4,24 @@
 
 More detailed description.
 """
-import os
-import warnings
+from math import sqrt
 
-from geopy import Nominatim
-from geopy.exc import GeocoderServiceError
-from numpy import sqrt
-from PIL import Image as PilImage
+import numpy as np
 from pycountry_convert import country_alpha2_to_continent_code, convert_continent_code_to_continent_name
-from shapely.geometry import Polygon
-from sqlalchemy import Column, Integer, ForeignKey, Boolean, Float, String
+from sqlalchemy import Column, Integer, ForeignKey, Boolean, Float, String, Text, LargeBinary, UniqueConstraint
 from sqlalchemy.ext.declarative import declared_attr, declarative_base
 from sqlalchemy.orm import relationship
 
-from kalimain.exceptions import ImageError, ApiConnectionWarning
+from kalimain import features
+from kalimain.exceptions import ImageError
+from kalimain.imaging import DIGEST_SIZE, HASH_SIZE, UNREADABLE_IMAGE_ERRORS, fingerprint
+
+# Hand features summarized by HandStat
+STAT_FEATURES = ("D1", "D2", "D3", "D4", "D5", "manning")
+
+# Pigment colour measures of HandPigment: statistic of Lab channel inside or around hand outline (e.g. inside_L_mean)
+PIGMENT_MEASURES = tuple("%s_%s_%s" % (region, channel, statistic) for region in ("inside", "around")
+                         for channel in ("L", "a", "b") for statistic in ("mean", "p10", "p50", "p90"))
 
 
 class Base:
@@ -37,7 +41,7 @@ class HPoint(Base):
     """
     x = Column(Integer)
     y = Column(Integer)
-    hand_id = Column(Integer, ForeignKey('hands.id'))
+    hand_id = Column(Integer, ForeignKey('hands.id'), index=True)
 
     hand = relationship("Hand", back_populates="hpoints")
 
@@ -46,6 +50,9 @@ class Hand(Base):
     """ Hand class for storing hands
 
     """
+    # Ids of deleted hands are never reused, so that values derived from a deleted hand (shape, cluster, pigment,
+    # measures) cannot be taken for those of a new hand
+    __table_args__ = dict(sqlite_autoincrement=True)
 
     left = Column(Boolean)
     right = Column(Boolean)
@@ -60,12 +67,24 @@ class Hand(Base):
     image = relationship("Image", back_populates="hands")
     hpoints = relationship("HPoint", order_by=HPoint.id, back_populates="hand", cascade="all, delete-orphan")
 
-    def __init__(self, list_of_points):
+    def __init__(self, list_of_points, **kwargs):
+        super().__init__(**kwargs)
         # TODO: add hand with 15 canvas_points
         self.hpoints = list_of_points
-        self.left, self.right = self.is_left_handed(), not self.is_left_handed()
-        self.D1, self.D2, self.D3, self.D4, self.D5 = self.finger_heights()
-        self.manning = self.manning_index()
+        self.set_features(features.compute_features(self.landmarks))
+
+    @classmethod
+    def update_features(cls, hands):
+        """ Recompute features of a batch of hands at once
+
+        :param hands: iterable of Hand instances
+        :return:
+        """
+        hands = list(hands)
+        if hands:
+            hand_features = features.compute_features(features.as_landmarks([hand.hpoints for hand in hands]))
+            for i, hand in enumerate(hands):
+                hand.set_features(hand_features, i)
 
     def get_info(self):
         """ Return a dict of the hand's main info and features
@@ -74,10 +93,21 @@ class Hand(Base):
         """
         return dict(d1=self.D1, d2=self.D2, d3=self.D3, d4=self.D4, d5=self.D5, manning=self.manning)
 
+    def set_features(self, hand_features, index=0):
+        """ Set hand's features from batch of computed features
+
+        :param hand_features: HandFeatures instance (see kalimain.features)
+        :param index: index of the hand within the batch
+        :return:
+        """
+        # Do not set numpy types to avoid error when inserting into the database
+        self.left, self.right = bool(hand_features.left[index]), bool(hand_features.right[index])
+        self.D1, self.D2, self.D3, self.D4, self.D5 = hand_features.digits[index].tolist()
+        self.manning = float(hand_features.manning[index])
+
     @staticmethod
     def distance(pt1, pt2):
-        # Do not return numpy float to avoid error when inserting into the database
-        return float(sqrt((pt2.x - pt1.x) ** 2 + (pt2.y - pt1.y) ** 2))
+        return sqrt((pt2.x - pt1.x) ** 2 + (pt2.y - pt1.y) ** 2)
 
     @staticmethod
     def height_of_finger(start, mid, end):
@@ -88,18 +118,15 @@ class Hand(Base):
         :param end:
         :return:
         """
-        return 2 * Polygon([(start.x, start.y), (mid.x, mid.y), (end.x, end.y)]).area / Hand.distance(start, end)
+        start, mid, end = (np.array([pt.x, pt.y], dtype=float) for pt in (start, mid, end))
+        return float(2 * features.triangle_area(start, mid, end) / features.distance(start, end))
 
     def finger_heights(self):
         """ Get height of fingers
 
         :return:
         """
-        if self.is_left_handed():
-            finger_order = [10, 7, 5, 3, 1]
-        else:
-            finger_order = [1, 4, 6, 8, 10]
-        return [self.height_of_finger(*self.hpoints[i - 1:i + 2]) for i in finger_order]
+        return features.finger_heights(self.landmarks)[0].tolist()
 
     def is_left_handed(self):
         """ Is hand left or right ?
@@ -107,10 +134,15 @@ class Hand(Base):
         Compute width of first and last finger
         :return:
         """
-        if self.distance(self.hpoints[0], self.hpoints[2]) < self.distance(self.hpoints[-1], self.hpoints[-3]):
-            return True
-        else:
-            return False
+        return bool(features.is_left_handed(self.landmarks)[0])
+
+    @property
+    def landmarks(self):
+        """ Hand's points as a landmark array of shape (1, 12, 2)
+
+        :return:
+        """
+        return features.as_landmarks([self.hpoints])
 
     def manning_index(self):
         """ Compute Manning index
@@ -128,8 +160,13 @@ class Image(Base):
     name = Column(String(50))
     description = Column(String(200))
     path = Column(String(200))
+    digest = Column(String(2 * DIGEST_SIZE), unique=True, index=True)
+    phash = Column(String(HASH_SIZE ** 2 // 4))
     width = Column(Integer)
     height = Column(Integer)
+    mode = Column(String(10))
+    bit_depth = Column(Integer)
+    thumbnail = Column(LargeBinary)
     cave_id = Column(Integer, ForeignKey("caves.id"))
 
     cave = relationship("Cave", back_populates="images")
@@ -138,23 +175,28 @@ class Image(Base):
     def __init__(self, filename, **kwargs):
         super().__init__(**kwargs)
 
+        # Only header and a reduced preview are decoded, and file is closed
         try:
-            self._image = PilImage.open(filename)
-        except (FileNotFoundError, OSError):
+            attributes = fingerprint(filename)
+        except UNREADABLE_IMAGE_ERRORS:
             raise ImageError("Unable to read file '%s" % filename)
         else:
+            for key, value in attributes.items():
+                setattr(self, key, value)
             self.path = filename
-            self.width = self._image.width
-            self.height = self._image.height
 
     def __eq__(self, other):
         if not isinstance(other, Image):
             return False
-        if self.size == other.size and os.stat(self.path).st_size == os.stat(other.path).st_size:
+        if self.digest == other.digest:
             return True
         else:
             return False
 
+    @property
+    def perceptual_hash(self):
+        return int(self.phash, 16) if self.phash is not None else None
+
     @property
     def size(self):
         return self.width, self.height
@@ -171,7 +213,7 @@ class Cave(Base):
     longitude = Column(Float)
     project_id = Column(Integer, ForeignKey("projects.id"))
 
-    # Secondary attributes (retrieved using geopy library)
+    # Secondary attributes (retrieved by reverse geocoding, see kalimain.geocoding)
     city = Column(String(50))
     town = Column(String(50))
     village = Column(String(50))
@@ -187,18 +229,6 @@ class Cave(Base):
     project = relationship("Project", back_populates="caves")
     images = relationship("Image", order_by=Image.id, back_populates="cave", cascade="all, delete-orphan")
 
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.geolocator = Nominatim(user_agent="Kalimain")
-
-        try:
-            self.location = self.geolocator.reverse("%f, %f" % (self.latitude, self.longitude))
-        except GeocoderServiceError:
-            warnings.warn("Unable to reach service: only primary attributes will be set", ApiConnectionWarning)
-        else:
-            # Set secondary attributes
-            self.get_secondary_attributes()
-
     def __eq__(self, other):
         if not isinstance(other, Cave):
             return False
@@ -208,20 +238,39 @@ class Cave(Base):
             return False
 
     def get_continent(self):
-        if self.country is not None:
-            continent_code = country_alpha2_to_continent_code(self.country_code.upper())
+        if self.country_code is not None:
+            try:
+                continent_code = country_alpha2_to_continent_code(self.country_code.upper())
+            except KeyError:
+                return None
             return convert_continent_code_to_continent_name(continent_code)
 
-    def get_secondary_attributes(self):
-        self.address = self.location.raw["display_name"]
+    def get_secondary_attributes(self, geocoder):
+        """ Retrieve and set secondary attributes synchronously
+
+        :param geocoder: Geocoder instance (see kalimain.geocoding)
+        :return:
+        """
+        location = geocoder.reverse(self.latitude, self.longitude)
+        if location is not None:
+            self.set_secondary_attributes(location)
+
+    def set_secondary_attributes(self, location):
+        """ Set secondary attributes from reverse geocoding result
 
-        for key, val in self.location.raw["address"].items():
+        :param location: raw location dict as returned by Nominatim
+        :return:
+        """
+        self.address = location["display_name"]
+
+        for key, val in location["address"].items():
             try:
                 self.__setattr__(key, val)
             except AttributeError:
                 pass
 
-        self.continent = self.get_continent()
+        if "continent" not in location["address"]:
+            self.continent = self.get_continent()
 
 
 class Project(Base):
@@ -240,3 +289,124 @@ class Project(Base):
             return True
         else:
             return False
+
+
+class JobCheckpoint(Base):
+    """ Checkpoint class instance for storing progress of resumable batch jobs
+
+    """
+    name = Column(String(50), unique=True)
+    last_id = Column(Integer, default=0)
+
+
+class HandStat(Base):
+    """ Hand statistics class instance, per image, cave or project, or of all hands
+
+    Kept up to date by kalimain.summary
+    """
+    __table_args__ = (UniqueConstraint("scope", "scope_id"),)
+
+    scope = Column(String(10))
+    scope_id = Column(Integer)
+    hands = Column(Integer, default=0)
+    left = Column(Integer, default=0)
+    right = Column(Integer, default=0)
+
+
+# Count, sum, sum of squares, min and max of every summarized feature (e.g. manning_sum)
+for _feature in STAT_FEATURES:
+    setattr(HandStat, _feature + "_count", Column(Integer, default=0))
+    setattr(HandStat, _feature + "_sum", Column(Float, default=0))
+    setattr(HandStat, _feature + "_squares", Column(Float, default=0))
+    setattr(HandStat, _feature + "_min", Column(Float))
+    setattr(HandStat, _feature + "_max", Column(Float))
+
+
+class HandShape(Base):
+    """ Hand shape class instance: landmarks of hand after Procrustes alignment
+
+    Kept by kalimain.shapes
+    """
+    hand_id = Column(Integer, ForeignKey("hands.id", ondelete="CASCADE"), unique=True, index=True)
+    size = Column(Float)
+    distance = Column(Float)
+    shape = Column(LargeBinary)
+
+
+class MeanShape(Base):
+    """ Mean shape class instance, per project, cave, country or continent, or of all hands
+
+    Kept by kalimain.shapes
+    """
+    __table_args__ = (UniqueConstraint("scope", "key"),)
+
+    scope = Column(String(10))
+    key = Column(String(50))
+    count = Column(Integer)
+    shape = Column(LargeBinary)
+
+
+class Clustering(Base):
+    """ Clustering class instance: state of mini-batch k-means of hands, per feature set
+
+    Kept by kalimain.clustering
+    """
+    name = Column(String(20), unique=True)
+    nb_clusters = Column(Integer)
+    centers = Column(LargeBinary)
+    counts = Column(LargeBinary)
+    offsets = Column(LargeBinary)
+    scales = Column(LargeBinary)
+
+
+class HandCluster(Base):
+    """ Hand cluster class instance: cluster of hand, per feature set
+
+    Kept by kalimain.clustering
+    """
+    __table_args__ = (UniqueConstraint("name", "hand_id"),)
+
+    name = Column(String(20))
+    hand_id = Column(Integer, ForeignKey("hands.id", ondelete="CASCADE"), index=True)
+    cluster = Column(Integer)
+
+
+class HandPigment(Base):
+    """ Hand pigment class instance: colour measures inside and around hand outline
+
+    Computed by kalimain.jobs.PigmentStatisticsJob
+    """
+    hand_id = Column(Integer, ForeignKey("hands.id", ondelete="CASCADE"), unique=True, index=True)
+    area = Column(Integer)
+    ring_area = Column(Integer)
+    delta_e = Column(Float)
+
+
+for _measure in PIGMENT_MEASURES:
+    setattr(HandPigment, _measure, Column(Float))
+
+
+class HandMeasure(Base):
+    """ Hand measure class instance: value of registered measure of hand (long table)
+
+    Kept by kalimain.measures
+    """
+    __table_args__ = (UniqueConstraint("name", "hand_id"),)
+
+    name = Column(String(50), index=True)
+    hand_id = Column(Integer, ForeignKey("hands.id", ondelete="CASCADE"), index=True)
+    version = Column(Integer)
+    value = Column(Float)
+
+
+class Location(Base):
+    """ Location class instance for caching reverse geocoding results
+
+    """
+    key = Column(String(50), unique=True, index=True)
+    raw = Column(Text)
+
+
+# Tables of values derived from hands, whose rows are deleted along with their hand by ORM flushes, even when
+# foreign keys are not enforced (see kalimain.summary)
+HAND_TABLES = (HandShape, HandCluster, HandPigment, HandMeasure)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+""" Columnar read API of hands
+
+Hands and their landmarks are read with Core select statements (no ORM
+instances) joining hands, images, caves and projects, and written by chunks
+into typed NumPy arrays: one structured array of hand attributes and one
+contiguous (N, 12, 2) array of landmarks. Datasets can be converted to
+pandas data frames or Arrow tables when those packages are installed.
+"""
+from collections import namedtuple
+from itertools import chain
+
+import numpy as np
+from sqlalchemy import select, func, false
+
+import kalimain
+from kalimain.database import Hand, HPoint, Image, Cave, Project
+from kalimain.features import NB_LANDMARKS
+
+HAND_DTYPE = np.dtype([("id", np.int64), ("image_id", np.int64), ("cave_id", np.int64), ("project_id", np.int64),
+                       ("left", np.bool_), ("D1", np.float64), ("D2", np.float64), ("D3", np.float64),
+                       ("D4", np.float64), ("D5", np.float64), ("manning", np.float64), ("latitude", np.float64),
+                       ("longitude", np.float64), ("image", "U50"), ("cave", "U50"), ("project", "U50"),
+                       ("country", "U50"), ("country_code", "U2"), ("continent", "U50")])
+
+HandDataset = namedtuple("HandDataset", ["hands", "landmarks"])
+
+
+def filter_statement(statement, project_id=None, cave_id=None, country=None, continent=None):
+    """ Filter select statement of hands by project, cave, country or continent
+
+    Statement must select from caves (and images for cave filter)
+    :return:
+    """
+    if project_id is not None:
+        statement = statement.where(Cave.project_id == project_id)
+    if cave_id is not None:
+        statement = statement.where(Image.cave_id == cave_id)
+    if country is not None:
+        statement = statement.where(Cave.country == country)
+    if continent is not None:
+        statement = statement.where(Cave.continent == continent)
+
+    return statement
+
+
+def hands_statement(**filters):
+    """ Select statement of hand attributes (see HAND_DTYPE), ordered by hand id
+
+    Missing ids are -1, missing names are empty strings
+    :param filters: project_id, cave_id, country and/or continent
+    :return:
+    """
+    columns = [Hand.id, func.coalesce(Hand.image_id, -1), func.coalesce(Image.cave_id, -1),
+               func.coalesce(Cave.project_id, -1), func.coalesce(Hand.left, false()), Hand.D1, Hand.D2, Hand.D3,
+               Hand.D4, Hand.D5, Hand.manning, Cave.latitude, Cave.longitude]
+    columns += [func.coalesce(column, "") for column in (Image.name, Cave.name, Project.name, Cave.country,
+                                                          Cave.country_code, Cave.continent)]
+    statement = select(*columns).select_from(Hand).outerjoin(Image, Hand.image_id == Image.id).outerjoin(
+        Cave, Image.cave_id == Cave.id).outerjoin(Project, Cave.project_id == Project.id)
+
+    return filter_statement(statement, **filters).order_by(Hand.id)
+
+
+def landmarks_statement(**filters):
+    """ Select statement of (hand id, x, y) landmarks, ordered by hand and point id
+
+    :param filters: project_id, cave_id, country and/or continent
+    :return:
+    """
+    statement = select(HPoint.hand_id, HPoint.x, HPoint.y).select_from(HPoint).join(Hand, HPoint.hand_id == Hand.id)
+    if any(value is not None for value in filters.values()):
+        statement = statement.join(Image, Hand.image_id == Image.id).join(Cave, Image.cave_id == Cave.id)
+
+    return filter_statement(statement, **filters).order_by(HPoint.hand_id, HPoint.id)
+
+
+def read_chunks(connection, statement, dtype, chunk_size):
+    """ Read result of statement into array, chunk by chunk
+
+    Result is streamed (server side cursor when supported by the database)
+    :param connection: SQLAlchemy connection
+    :param statement: select statement
+    :param dtype: numpy dtype (structured dtype matching statement columns, or plain dtype)
+    :param chunk_size: number of rows per chunk
+    :return: array
+    """
+    result = connection.execution_options(stream_results=True).execute(statement)
+    chunks = []
+    for rows in result.partitions(chunk_size):
+        if dtype.names is not None:
+            chunk = np.empty(len(rows), dtype=dtype)
+            for name, column in zip(dtype.names, zip(*rows)):
+                chunk[name] = column
+        else:
+            nb_columns = len(statement.selected_columns)
+            chunk = np.fromiter(chain.from_iterable(rows), dtype, len(rows) * nb_columns).reshape(-1, nb_columns)
+        chunks.append(chunk)
+
+    if chunks:
+        return np.concatenate(chunks)
+    else:
+        return np.empty(0 if dtype.names is not None else (0, len(statement.selected_columns)), dtype=dtype)
+
+
+def load_hands(engine=None, project_id=None, cave_id=None, country=None, continent=None, chunk_size=10000):
+    """ Load hands and their landmarks into NumPy arrays
+
+    Landmarks of hands without exactly 12 points are NaN
+    :param engine: SQLAlchemy engine or connection (default: kalimain.ENGINE)
+    :param project_id: only load hands of that project
+    :param cave_id: only load hands of that cave
+    :param country: only load hands of caves in that country
+    :param continent: only load hands of caves in that continent
+    :param chunk_size: number of rows fetched at once
+    :return: HandDataset with hands structured array (see HAND_DTYPE) and (N, 12, 2) landmarks array
+    """
+    filters = dict(project_id=project_id, cave_id=cave_id, country=country, continent=continent)
+
+    if engine is None:
+        engine = kalimain.ENGINE
+
+    with engine.connect() as connection:
+        hands = read_chunks(connection, hands_statement(**filters), HAND_DTYPE, chunk_size)
+        points = read_chunks(connection, landmarks_statement(**filters), np.dtype(np.float64),
+                             chunk_size * NB_LANDMARKS)
+
+    landmarks = np.full((len(hands), NB_LANDMARKS, 2), np.nan)
+    hand_ids, hand_landmarks = group_landmarks(points)
+    # Hands and points are both sorted by hand id
+    landmarks[np.searchsorted(hands["id"], hand_ids)] = hand_landmarks
+
+    return HandDataset(hands, landmarks)
+
+
+def group_landmarks(points, nb_landmarks=NB_LANDMARKS):
+    """ Landmark array of hands from (hand id, x, y) rows sorted by hand id
+
+    Hands without exactly nb_landmarks points are left out
+    :param points: (M, 3) array (see landmarks_statement)
+    :param nb_landmarks: number of landmarks of hands
+    :return: (hand ids, (N, nb_landmarks, 2) landmarks array)
+    """
+    if len(points) == 0:
+        return np.empty(0, dtype=np.int64), np.empty((0, nb_landmarks, 2))
+
+    hand_ids, start, counts = np.unique(points[:, 0].astype(np.int64), return_index=True, return_counts=True)
+    valid = counts == nb_landmarks
+    index = (start[valid, np.newaxis] + np.arange(nb_landmarks)).ravel()
+
+    return hand_ids[valid], points[index, 1:].reshape(-1, nb_landmarks, 2)
+
+
+def to_pandas(dataset):
+    """ Convert dataset to pandas data frame indexed by hand id
+
+    Landmarks are stored in x1..x12 and y1..y12 columns. Require pandas
+    :param dataset: HandDataset
+    :return:
+    """
+    import pandas as pd
+
+    frame = pd.DataFrame(dataset.hands).set_index("id")
+    for i in range(NB_LANDMARKS):
+        frame["x%d" % (i + 1)] = dataset.landmarks[:, i, 0]
+        frame["y%d" % (i + 1)] = dataset.landmarks[:, i, 1]
+
+    return frame
+
+
+def to_arrow(dataset):
+    """ Convert dataset to Arrow table
+
+    Landmarks are stored in a fixed size list column of 24 values (x1, y1,
+    x2, y2, etc.). Require pyarrow
+    :param dataset: HandDataset
+    :return:
+    """
+    import pyarrow as pa
+
+    columns = {name: pa.array(dataset.hands[name]) for name in dataset.hands.dtype.names}
+    columns["landmarks"] = pa.FixedSizeListArray.from_arrays(pa.array(dataset.landmarks.reshape(-1)),
+                                                            2 * NB_LANDMARKS)
+
+    return pa.table(columns)
@@ -4,11 +4,14 @@
 
 Add here any window dialog necessary to Kalimain
 """
+import threading
 import tkinter as tk
 
-from tkinter import font as tkfont
+from tkinter import font as tkfont, ttk
 from abc import ABCMeta, abstractmethod
+from queue import Queue, Empty
 
+from kalimain.observer import Observer
 from kalimain.viewtools import FloatEntry
 from kalimain.widgets import KListbox
 
@@ -245,3 +248,101 @@ class OpenProjectDialog(Dialog):
     def apply(self):
         if self.klistbox.curselection():
             self.result = dict(project_id=self.klistbox.get_selected_id())
+
+
+class ProgressWindow(tk.Toplevel):
+    """ Progress window of a job running in background, with cancel button
+
+    Job progress is observed from the job's thread and displayed by polling
+    from the Tk thread.
+    """
+    poll_delay = 100
+    bar_length = 300
+    label_width = 40
+
+    class ProgressObserver(Observer):
+
+        def __init__(self, window):
+            self.window = window
+
+        def update(self, observable, progress):
+            self.window.progress.put(progress)
+
+    def __init__(self, parent, title=None, on_cancel=None, unit="items", message=None):
+        """
+
+        :param parent:
+        :param title:
+        :param on_cancel: callable cancelling the job (thread safe), None if job cannot be cancelled
+        :param unit: name of processed items
+        :param message: if not None, message displayed by window of job without progress
+        """
+        tk.Toplevel.__init__(self, parent)
+        self.transient(parent)
+
+        if title:
+            self.title(title)
+
+        self.on_cancel = on_cancel
+        self.unit = unit
+        self.progress = Queue()
+        self.observer = ProgressWindow.ProgressObserver(self)
+        self.result = None
+        self.error = None
+        self._thread = None
+
+        self.label = tk.Label(self, text=message or "", width=self.label_width)
+        self.label.pack(padx=5, pady=5)
+        self.progress_bar = ttk.Progressbar(self, length=self.bar_length, maximum=1.0,
+                                            mode="determinate" if message is None else "indeterminate")
+        self.progress_bar.pack(padx=5, pady=5)
+        if message is not None:
+            self.progress_bar.start()
+        self.cancel_button = tk.Button(self, text="Cancel", width=10, command=self.cancel,
+                                       state=tk.NORMAL if on_cancel is not None else tk.DISABLED)
+        self.cancel_button.pack(padx=5, pady=5)
+
+        self.protocol("WM_DELETE_WINDOW", self.cancel)
+
+    def cancel(self):
+        if self.on_cancel is not None:
+            self.on_cancel()
+        self.cancel_button.config(state=tk.DISABLED)
+
+    def poll(self, on_done):
+        progress = None
+        while True:
+            try:
+                progress = self.progress.get_nowait()
+            except Empty:
+                break
+
+        if progress is not None and progress.total:
+            self.progress_bar.config(value=progress.done / progress.total)
+            self.label.config(text="%d/%d %s - %.0f %s/s" % (progress.done, progress.total, self.unit, progress.rate,
+                                                             self.unit))
+
+        if self._thread.is_alive():
+            self.after(self.poll_delay, self.poll, on_done)
+        else:
+            self.destroy()
+            if self.error is not None:
+                raise self.error
+            on_done(self.result)
+
+    def run(self, target, on_done):
+        """ Run target in background thread, then on_done(result) in Tk thread
+
+        :param target: callable running the job and returning its result
+        :param on_done: callable
+        :return:
+        """
+        def job():
+            try:
+                self.result = target()
+            except Exception as e:
+                self.error = e
+
+        self._thread = threading.Thread(target=job, daemon=True)
+        self._thread.start()
+        self.after(self.poll_delay, self.poll, on_done)
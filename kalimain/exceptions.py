@@ -4,28 +4,6 @@
 
 More detailed description.
 """
-from tkinter import messagebox
-
-
-class KCatcher:
-    """ Catch GUI exceptions
-
-    """
-    def __init__(self, func, subst, widget):
-        self.func = func
-        self.subst = subst
-        self.widget = widget
-
-    def __call__(self, *args):
-        try:
-            if self.subst:
-                args = self.subst(*args)
-            return self.func(*args)
-        except Exception as e:
-            if isinstance(e, Warning):
-                messagebox.showwarning(title=e.__class__.__name__, message=e)
-            else:
-                messagebox.showerror(title=e.__class__.__name__, message=e)
 
 
 class KException(Exception):
@@ -102,3 +80,7 @@ class DuplicateElementWarning(KWarning):
 
 class InvalidNameWarning(KWarning):
     pass
+
+
+class NearDuplicateWarning(KWarning):
+    pass
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+""" Streaming export of Kalimain tables
+
+Tables (or the denormalised view of hands with their image, cave and
+project) are streamed from the database in fixed-size chunks, using server
+side cursors when supported, and appended to CSV or Parquet files chunk by
+chunk: memory use does not depend on the number of exported rows. Foreign
+keys are denormalised by joining referenced tables, whose columns are
+prefixed with the referenced object name (e.g. cave_name).
+"""
+import csv
+import os
+import time
+
+from sqlalchemy import select, func, LargeBinary
+
+import kalimain
+from kalimain.database import Base, Hand, Image, Cave, Project
+from kalimain.dataset import filter_statement
+from kalimain.jobs import Progress, ProgressNotifier
+
+EXPORT_FORMATS = (".csv", ".parquet")
+
+
+def _prefix(table):
+    """ Column prefix of referenced table (e.g. "cave_" for caves)
+
+    """
+    return table.name[:-1] + "_" if table.name.endswith("s") else table.name + "_"
+
+
+def table_statement(table_name, denormalize=True):
+    """ Select statement of all rows of table, ordered by id
+
+    Binary columns (e.g. thumbnails) are not exported
+    :param table_name: name of table (e.g. "images")
+    :param denormalize: if True, add columns of tables referenced by foreign keys
+    :return:
+    """
+    try:
+        table = Base.metadata.tables[table_name]
+    except KeyError:
+        raise ValueError("Unknown table '%s' (valid tables: %s)" % (table_name, ", ".join(Base.metadata.tables)))
+
+    columns = [column for column in table.columns if not isinstance(column.type, LargeBinary)]
+    from_clause = table
+    if denormalize:
+        for foreign_key in sorted(table.foreign_keys, key=lambda fk: fk.parent.name):
+            referenced = foreign_key.column.table.alias(_prefix(foreign_key.column.table)[:-1])
+            from_clause = from_clause.outerjoin(referenced, foreign_key.parent == referenced.c[foreign_key.column.name])
+            columns += [column.label(_prefix(foreign_key.column.table) + column.name) for column in referenced.columns
+                        if not column.foreign_keys and not column.primary_key
+                        and not isinstance(column.type, LargeBinary)]
+
+    return select(*columns).select_from(from_clause).order_by(table.c.id)
+
+
+def hands_statement(**filters):
+    """ Select statement of hands with their image, cave and project attributes
+
+    :param filters: project_id, cave_id, country and/or continent (see kalimain.dataset)
+    :return:
+    """
+    columns = [Hand.id, Hand.left, Hand.D1, Hand.D2, Hand.D3, Hand.D4, Hand.D5, Hand.manning,
+               Image.id.label("image_id"), Image.name.label("image_name"), Image.path.label("image_path"),
+               Cave.id.label("cave_id"), Cave.name.label("cave_name"), Cave.latitude, Cave.longitude, Cave.country,
+               Cave.country_code, Cave.state, Cave.continent, Project.id.label("project_id"),
+               Project.name.label("project_name")]
+    statement = select(*columns).select_from(Hand).outerjoin(Image, Hand.image_id == Image.id).outerjoin(
+        Cave, Image.cave_id == Cave.id).outerjoin(Project, Cave.project_id == Project.id)
+
+    return filter_statement(statement, **filters).order_by(Hand.id)
+
+
+class CsvWriter:
+
+    def __init__(self, filename, columns):
+        self.file = open(filename, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([column.name for column in columns])
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """ Append chunks of rows to Parquet file (row group per chunk)
+
+    Require pyarrow
+    """
+    arrow_types = {bool: "bool_", int: "int64", float: "float64", str: "string"}
+
+    def __init__(self, filename, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        # Schema is given by column types, so that chunks with null columns do not change it
+        self.schema = pa.schema([(column.name, getattr(pa, self.arrow_types.get(column.type.python_type, "string"))())
+                                 for column in columns])
+        self.writer = pq.ParquetWriter(filename, self.schema)
+
+    def write(self, rows):
+        arrays = [self.pa.array(values, type=field.type) for values, field in zip(zip(*rows), self.schema)]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class Exporter:
+    """ Export tables or hands view to CSV or Parquet files
+
+    """
+    writers = {".csv": CsvWriter, ".parquet": ParquetWriter}
+
+    def __init__(self, engine=None, chunk_size=10000):
+        """
+
+        :param engine: SQLAlchemy engine (default: kalimain.ENGINE)
+        :param chunk_size: number of rows fetched and written at once
+        """
+        self.engine = engine if engine is not None else kalimain.ENGINE
+        self.chunk_size = chunk_size
+        self.progress_notifier = ProgressNotifier()
+
+    def export_hands(self, filename, **filters):
+        """ Export hands with their image, cave and project attributes
+
+        :param filename: path to CSV or Parquet file
+        :param filters: project_id, cave_id, country and/or continent
+        :return: Progress at the end of export
+        """
+        return self.run(hands_statement(**filters), filename)
+
+    def export_table(self, table_name, filename, denormalize=True):
+        """ Export table
+
+        :param table_name: name of table (e.g. "caves")
+        :param filename: path to CSV or Parquet file
+        :param denormalize: if True, add columns of tables referenced by foreign keys
+        :return: Progress at the end of export
+        """
+        return self.run(table_statement(table_name, denormalize), filename)
+
+    def run(self, statement, filename):
+        """ Stream result of select statement to file
+
+        :param statement: select statement
+        :param filename: path to CSV or Parquet file (format is given by extension)
+        :return: Progress at the end of export
+        """
+        extension = os.path.splitext(filename)[1].lower()
+        if extension not in self.writers:
+            raise ValueError("Unsupported export format '%s' (valid formats: %s)" % (extension,
+                                                                                      ", ".join(EXPORT_FORMATS)))
+
+        start_time = time.perf_counter()
+        with self.engine.connect() as connection:
+            total = connection.execute(select(func.count()).select_from(statement.subquery())).scalar()
+            result = connection.execution_options(stream_results=True, max_row_buffer=self.chunk_size).execute(
+                statement)
+            writer = self.writers[extension](filename, statement.selected_columns)
+            done = 0
+            progress = Progress(done, total, 0, 0, 0)
+            try:
+                while True:
+                    rows = result.fetchmany(self.chunk_size)
+                    if not rows:
+                        break
+                    writer.write(rows)
+                    done += len(rows)
+                    elapsed = time.perf_counter() - start_time
+                    progress = Progress(done, total, 0, elapsed, done / elapsed if elapsed else 0)
+                    self.progress_notifier.notify_observers(progress)
+            finally:
+                writer.close()
+
+        return progress
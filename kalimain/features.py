@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+""" Hand features engine
+
+Vectorized computation of hand features (handedness, finger heights and Manning
+index) for a batch of N hands given as an (N, 12, 2) array of landmarks.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+NB_LANDMARKS = 12
+
+# Landmark index of each finger tip, from D1 (thumb) to D5. Finger height is
+# computed from the triangle (tip - 1, tip, tip + 1)
+RIGHT_FINGER_ORDER = (1, 4, 6, 8, 10)
+LEFT_FINGER_ORDER = (10, 7, 5, 3, 1)
+
+HandFeatures = namedtuple("HandFeatures", ["left", "right", "digits", "manning"])
+
+
+def as_landmarks(hands):
+    """ Convert sequence of hands into landmark array
+
+    :param hands: sequence of hands, each hand being a sequence of points with x and y attributes
+    :return: float array of shape (N, 12, 2)
+    """
+    landmarks = np.array([[(pt.x, pt.y) for pt in points] for points in hands], dtype=float)
+
+    return check_landmarks(landmarks)
+
+
+def check_landmarks(landmarks):
+    """ Check landmark array and return it as a float (N, 12, 2) array
+
+    :param landmarks: array-like of shape (N, 12, 2) or (12, 2)
+    :return:
+    """
+    landmarks = np.asarray(landmarks, dtype=float)
+
+    if landmarks.ndim == 2:
+        landmarks = landmarks[np.newaxis]
+
+    if landmarks.ndim != 3 or landmarks.shape[1:] != (NB_LANDMARKS, 2):
+        raise ValueError("Landmarks must be of shape (N, %d, 2), not %s" % (NB_LANDMARKS, landmarks.shape))
+
+    return landmarks
+
+
+def distance(pt1, pt2):
+    """ Euclidean distance between points along last axis
+
+    :param pt1: array of shape (..., 2)
+    :param pt2: array of shape (..., 2)
+    :return:
+    """
+    return np.sqrt((pt2[..., 0] - pt1[..., 0]) ** 2 + (pt2[..., 1] - pt1[..., 1]) ** 2)
+
+
+def triangle_area(start, mid, end):
+    """ Area of triangles using cross product
+
+    :param start: array of shape (..., 2)
+    :param mid: array of shape (..., 2)
+    :param end: array of shape (..., 2)
+    :return:
+    """
+    cross = (mid[..., 0] - start[..., 0]) * (end[..., 1] - start[..., 1]) - \
+        (end[..., 0] - start[..., 0]) * (mid[..., 1] - start[..., 1])
+
+    return np.abs(cross) / 2
+
+
+def is_left_handed(landmarks):
+    """ Is hand left or right ?
+
+    Compare width of first and last finger
+    :param landmarks: array of shape (N, 12, 2)
+    :return: boolean array of shape (N,)
+    """
+    return distance(landmarks[:, 0], landmarks[:, 2]) < distance(landmarks[:, -1], landmarks[:, -3])
+
+
+def finger_heights(landmarks, left=None):
+    """ Get height of fingers
+
+    :param landmarks: array of shape (N, 12, 2)
+    :param left: boolean array of shape (N,). If None, computed from landmarks
+    :return: array of shape (N, 5) with heights of D1 to D5
+    """
+    if left is None:
+        left = is_left_handed(landmarks)
+
+    tips = np.where(left[:, np.newaxis], LEFT_FINGER_ORDER, RIGHT_FINGER_ORDER)
+    start, mid, end = [np.take_along_axis(landmarks, (tips + offset)[..., np.newaxis], axis=1)
+                       for offset in (-1, 0, 1)]
+
+    return 2 * triangle_area(start, mid, end) / distance(start, end)
+
+
+def manning_index(heights):
+    """ Compute Manning index
+
+    Compute Manning index (ratio 2-Digit/4-Digit)
+    :param heights: array of shape (N, 5)
+    :return:
+    """
+    return heights[:, 1] / heights[:, 3]
+
+
+def compute_features(landmarks):
+    """ Compute features of a batch of hands
+
+    :param landmarks: array-like of shape (N, 12, 2)
+    :return: HandFeatures of arrays of shape (N,) (handedness, Manning index) and (N, 5) (finger heights)
+    """
+    landmarks = check_landmarks(landmarks)
+    left = is_left_handed(landmarks)
+    digits = finger_heights(landmarks, left)
+
+    return HandFeatures(left, ~left, digits, manning_index(digits))
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+""" Geographic tools
+
+Great-circle distances and in-memory spatial index of locations (caves)
+given by latitude and longitude in degrees.
+"""
+from collections import defaultdict
+from math import cos, floor, radians
+
+import numpy as np
+
+EARTH_RADIUS = 6371.0088  # Mean earth radius in km
+KM_PER_DEGREE = np.pi * EARTH_RADIUS / 180
+HALF_CIRCUMFERENCE = np.pi * EARTH_RADIUS
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """ Great-circle distance in km between points (vectorized)
+
+    :param lat1: latitude(s) in degrees
+    :param lon1: longitude(s) in degrees
+    :param lat2: latitude(s) in degrees
+    :param lon2: longitude(s) in degrees
+    :return: distance(s) in km
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=float)) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class GeoIndex:
+    """ Grid index of locations on the sphere
+
+    Locations are bucketed into cells of cell_size degrees. Queries only visit
+    the cells overlapping the bounding box of the search circle, then refine
+    candidates with vectorized haversine distances.
+    """
+
+    def __init__(self, cell_size=0.5):
+        """
+
+        :param cell_size: size of grid cells in degrees
+        """
+        self.cell_size = cell_size
+        self.nb_lon_cells = int(np.ceil(360 / cell_size))
+        self.cells = defaultdict(set)
+        self.locations = dict()
+
+    def __len__(self):
+        return len(self.locations)
+
+    def _cell(self, latitude, longitude):
+        return floor((latitude + 90) / self.cell_size), floor((longitude + 180) / self.cell_size) % self.nb_lon_cells
+
+    def _candidates(self, latitude, longitude, radius):
+        """ Items within cells overlapping bounding box of search circle
+
+        """
+        dlat = radius / KM_PER_DEGREE
+        min_lat, max_lat = latitude - dlat, latitude + dlat
+        max_abs_lat = max(abs(min_lat), abs(max_lat))
+
+        i_min, i_max = self._cell(max(min_lat, -90), longitude)[0], self._cell(min(max_lat, 90), longitude)[0]
+        dlon = dlat / cos(radians(max_abs_lat)) if max_abs_lat < 90 else 180
+        # Longitude columns before wrapping: when they span the whole circle, scan every column
+        j_min = floor((longitude - dlon + 180) / self.cell_size)
+        j_max = floor((longitude + dlon + 180) / self.cell_size)
+        if j_max - j_min + 1 >= self.nb_lon_cells:
+            j_range = range(self.nb_lon_cells)
+        else:
+            j_range = [j % self.nb_lon_cells for j in range(j_min, j_max + 1)]
+
+        if (i_max - i_min + 1) * len(j_range) > len(self.cells):
+            # Bounding box is larger than index: scan non-empty cells instead
+            j_set = set(j_range)
+            return [item for (i, j), items in self.cells.items() if i_min <= i <= i_max and j in j_set
+                    for item in items]
+        else:
+            return [item for i in range(i_min, i_max + 1) for j in j_range for item in self.cells.get((i, j), ())]
+
+    def add(self, item, latitude, longitude):
+        """ Add item at given location
+
+        :param item: any hashable object (e.g. cave id)
+        :param latitude: in degrees
+        :param longitude: in degrees
+        :return:
+        """
+        self.locations[item] = (latitude, longitude)
+        self.cells[self._cell(latitude, longitude)].add(item)
+
+    def remove(self, item):
+        """ Remove item from index
+
+        :param item:
+        :return:
+        """
+        cell = self._cell(*self.locations.pop(item))
+        self.cells[cell].discard(item)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def within(self, latitude, longitude, radius):
+        """ Items within radius of location
+
+        :param latitude: in degrees
+        :param longitude: in degrees
+        :param radius: in km
+        :return: list of (distance in km, item) sorted by distance
+        """
+        candidates = self._candidates(latitude, longitude, radius)
+        if not candidates:
+            return []
+
+        locations = np.array([self.locations[item] for item in candidates])
+        distances = haversine(latitude, longitude, locations[:, 0], locations[:, 1])
+        order = np.argsort(distances)
+
+        return [(float(distances[i]), candidates[i]) for i in order if distances[i] <= radius]
+
+    def nearest(self, latitude, longitude, k=1):
+        """ k nearest items of location
+
+        Search radius is doubled until k items are found
+        :param latitude: in degrees
+        :param longitude: in degrees
+        :param k: number of items
+        :return: list of (distance in km, item) sorted by distance
+        """
+        radius = self.cell_size * KM_PER_DEGREE
+        while True:
+            result = self.within(latitude, longitude, radius)
+            if len(result) >= k or radius >= HALF_CIRCUMFERENCE:
+                return result[:k]
+            radius *= 2
+
+
+def close_pairs(latitudes, longitudes, distance, subset=None):
+    """ Pairs of locations lying within distance of each other (vectorized)
+
+    Locations are bucketed into grid cells at least distance wide. Candidate
+    pairs are only looked up within the same and neighbouring cells (sorted
+    keys + binary search) and refined with haversine distances.
+    :param latitudes: array of latitudes in degrees
+    :param longitudes: array of longitudes in degrees
+    :param distance: distance in km
+    :param subset: indices of first locations of pairs (None = all locations)
+    :return: (first, second, distances) arrays of pairs of distinct locations, in both orders when subset is None
+    """
+    latitudes, longitudes = np.asarray(latitudes, dtype=float), np.asarray(longitudes, dtype=float)
+    subset = np.arange(len(latitudes)) if subset is None else np.asarray(subset, dtype=np.int64)
+    if len(latitudes) < 2 or len(subset) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+
+    dlat = max(distance / KM_PER_DEGREE, 1e-9)
+    max_abs_lat = np.abs(latitudes).max() + dlat
+    # Longitude cells evenly divide 360 degrees, so that cells wrapping around the antimeridian are neighbours.
+    # Search circles reaching a pole span all longitudes: a single column is then scanned
+    if max_abs_lat < 90:
+        nb_lon_cells = max(int(360 // (dlat / np.cos(np.radians(max_abs_lat)))), 1)
+    else:
+        nb_lon_cells = 1
+    dlon = 360 / nb_lon_cells
+
+    rows = np.floor((latitudes + 90) / dlat).astype(np.int64)
+    cols = np.floor((longitudes + 180) / dlon).astype(np.int64) % nb_lon_cells
+    keys = rows * nb_lon_cells + cols
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+
+    firsts, seconds, distances = [], [], []
+    for di in (-1, 0, 1):
+        # Distinct neighbouring columns only (there may be less than 3 columns)
+        for dj in {dj % nb_lon_cells for dj in (-1, 0, 1)}:
+            targets = (rows[subset] + di) * nb_lon_cells + (cols[subset] + dj) % nb_lon_cells
+            start, end = np.searchsorted(sorted_keys, targets, "left"), np.searchsorted(sorted_keys, targets, "right")
+            counts = end - start
+            first = np.repeat(subset, counts)
+            second = order[np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+            pair_distances = haversine(latitudes[first], longitudes[first], latitudes[second], longitudes[second])
+            close = (pair_distances <= distance) & (first != second)
+            firsts.append(first[close])
+            seconds.append(second[close])
+            distances.append(pair_distances[close])
+
+    return np.concatenate(firsts), np.concatenate(seconds), np.concatenate(distances)
+
+
+def duplicate_mask(latitudes, longitudes, tolerance, start=0):
+    """ Flag locations lying within tolerance of a previous location (vectorized)
+
+    :param latitudes: array of latitudes in degrees
+    :param longitudes: array of longitudes in degrees
+    :param tolerance: distance in km
+    :param start: index of first location to check (previous ones are only compared with)
+    :return: boolean array, True when location is a duplicate of a previous one
+    """
+    mask = np.zeros(len(latitudes), dtype=bool)
+    subset = np.arange(start, len(latitudes)) if start else None
+    first, second, _ = close_pairs(latitudes, longitudes, tolerance, subset)
+    # Only compare with previous locations
+    mask[first[second < first]] = True
+
+    return mask
+
+
+def nearest_pairs(latitudes, longitudes, k):
+    """ Pairs of every location with its k nearest locations (vectorized)
+
+    Pairs are searched within a radius, which is doubled for locations with
+    less than k neighbours within it
+    :param latitudes: array of latitudes in degrees
+    :param longitudes: array of longitudes in degrees
+    :param k: number of neighbours
+    :return: (first, second, distances) arrays, sorted by first location and distance
+    """
+    latitudes, longitudes = np.asarray(latitudes, dtype=float), np.asarray(longitudes, dtype=float)
+    k = min(k, len(latitudes) - 1)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+
+    # First radius: disk holding k locations on average over bounding box
+    height = (latitudes.max() - latitudes.min()) * KM_PER_DEGREE
+    width = (longitudes.max() - longitudes.min()) * KM_PER_DEGREE * np.cos(np.radians(np.abs(latitudes).max()))
+    radius = max(np.sqrt(k * max(height, 1) * max(width, 1) / (np.pi * len(latitudes))), 1)
+
+    pending = np.arange(len(latitudes))
+    firsts, seconds, distances = [], [], []
+    while len(pending):
+        first, second, pair_distances = close_pairs(latitudes, longitudes, radius, pending)
+        counts = np.bincount(first, minlength=len(latitudes))
+        done = counts >= k if radius < HALF_CIRCUMFERENCE else np.ones(len(latitudes), dtype=bool)
+        keep = done[first]
+        first, second, pair_distances = first[keep], second[keep], pair_distances[keep]
+
+        order = np.lexsort((pair_distances, first))
+        first, second, pair_distances = first[order], second[order], pair_distances[order]
+        starts = np.searchsorted(first, first, "left")
+        nearest = np.arange(len(first)) - starts < k
+        firsts.append(first[nearest])
+        seconds.append(second[nearest])
+        distances.append(pair_distances[nearest])
+
+        pending = pending[~done[pending]]
+        radius *= 2
+
+    first, second, distances = np.concatenate(firsts), np.concatenate(seconds), np.concatenate(distances)
+    order = np.lexsort((distances, first))
+
+    return first[order], second[order], distances[order]
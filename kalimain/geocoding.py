@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+
+""" Reverse geocoding of caves
+
+Caves get their secondary attributes (address, country, state, etc.) by
+reverse geocoding of their coordinates, using either the remote Nominatim
+service or local boundary files (offline). Geocoding requests are run by a
+background thread so that the GUI never waits for the network, while results
+are applied to the database from the calling thread when polling the queue.
+"""
+import json
+import os
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from queue import Queue, Empty
+
+import numpy as np
+import shapely
+from geopy import Nominatim
+from shapely.geometry import shape
+
+from kalimain import kalimain_home_directory
+from kalimain.database import Cave, Location
+
+boundaries_directory = os.path.join(kalimain_home_directory, "boundaries")
+
+
+def default_geocoder():
+    """ Return offline geocoder if boundary files are available, Nominatim otherwise
+
+    Offline geocoder uses "countries" and optional "regions" GeoJSON or shapefiles
+    of the boundaries directory in kalimain home directory
+    :return:
+    """
+    files = dict()
+    if os.path.isdir(boundaries_directory):
+        for filename in sorted(os.listdir(boundaries_directory)):
+            name, ext = os.path.splitext(filename)
+            if name in ("countries", "regions") and ext.lower() in BoundaryIndex.extensions:
+                files.setdefault(name, os.path.join(boundaries_directory, filename))
+
+    if "countries" in files:
+        return OfflineGeocoder(files["countries"], files.get("regions"))
+    else:
+        return NominatimGeocoder()
+
+
+def read_features(filename):
+    """ Read geometries and properties of features in GeoJSON file or shapefile
+
+    Reading shapefiles requires the fiona package
+    :param filename:
+    :return: (list of shapely geometries, list of property dicts)
+    """
+    if os.path.splitext(filename)[1].lower() in (".json", ".geojson"):
+        with open(filename) as file:
+            features = json.load(file)["features"]
+    else:
+        import fiona
+        with fiona.open(filename) as collection:
+            features = [dict(geometry=feature["geometry"], properties=dict(feature["properties"]))
+                        for feature in collection]
+
+    features = [feature for feature in features if feature["geometry"] is not None]
+
+    return [shape(feature["geometry"]) for feature in features], [feature["properties"] for feature in features]
+
+
+class BoundaryIndex:
+    """ STR-tree index of boundary polygons (countries, regions, etc.)
+
+    """
+    extensions = (".json", ".geojson", ".shp")
+
+    def __init__(self, filename):
+        self.geometries, self.properties = read_features(filename)
+        self.geometries = np.array(self.geometries, dtype=object)
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+    def lookup(self, points):
+        """ Return index of boundary containing each point (-1 if none)
+
+        :param points: array of shapely points
+        :return:
+        """
+        point_index, boundary_index = self.tree.query(points, predicate="intersects")
+        result = np.full(len(points), -1)
+        # Keep first boundary when point lies on a shared border
+        result[point_index[::-1]] = boundary_index[::-1]
+
+        return result
+
+
+class Geocoder(metaclass=ABCMeta):
+    """ Base class for reverse geocoders
+
+    Reverse geocoders return raw locations formatted as Nominatim's, i.e. dicts
+    with a "display_name" string and an "address" dict of Cave secondary
+    attributes (country, country_code, state, etc.)
+    """
+    # Minimum delay between two requests in seconds
+    min_delay = 0
+
+    @abstractmethod
+    def reverse(self, latitude, longitude):
+        """ Return raw location at given coordinates (None if nothing was found)
+
+        :param latitude:
+        :param longitude:
+        :return:
+        """
+        pass
+
+    def reverse_many(self, latitudes, longitudes):
+        """ Return raw locations of many coordinates at once
+
+        :param latitudes:
+        :param longitudes:
+        :return: list of raw locations
+        """
+        return [self.reverse(latitude, longitude) for latitude, longitude in zip(latitudes, longitudes)]
+
+
+class NominatimGeocoder(Geocoder):
+    """ Reverse geocoder using OpenStreetMap's Nominatim service
+
+    """
+    min_delay = 1.0  # Nominatim usage policy: 1 request/s
+
+    def __init__(self, user_agent="Kalimain", timeout=10):
+        self.geolocator = Nominatim(user_agent=user_agent, timeout=timeout)
+
+    def reverse(self, latitude, longitude):
+        location = self.geolocator.reverse("%f, %f" % (latitude, longitude))
+        if location is not None:
+            return location.raw
+
+
+class OfflineGeocoder(Geocoder):
+    """ Reverse geocoder using local boundary files
+
+    Resolve country, country_code, continent and state from country and
+    (optional) admin region polygons, e.g. Natural Earth admin 0 and admin 1
+    datasets. Field names of boundary files can be changed with class
+    attributes.
+    """
+    country_name_field = "NAME"
+    country_code_field = "ISO_A2"
+    continent_field = "CONTINENT"
+    region_name_field = "name"
+
+    def __init__(self, countries, regions=None):
+        """
+
+        :param countries: path to countries GeoJSON file or shapefile
+        :param regions: path to admin regions (states) GeoJSON file or shapefile
+        """
+        self.countries = BoundaryIndex(countries)
+        self.regions = BoundaryIndex(regions) if regions is not None else None
+
+    def _location(self, country, region):
+        address = dict()
+        if country is not None:
+            address["country"] = country.get(self.country_name_field)
+            code = country.get(self.country_code_field)
+            if isinstance(code, str) and len(code) == 2:
+                address["country_code"] = code.lower()
+            if country.get(self.continent_field):
+                address["continent"] = country[self.continent_field]
+        if region is not None:
+            address["state"] = region.get(self.region_name_field)
+
+        if address:
+            return dict(display_name=", ".join(address[key] for key in ("state", "country") if address.get(key)),
+                        address=address)
+
+    def reverse(self, latitude, longitude):
+        return self.reverse_many([latitude], [longitude])[0]
+
+    def reverse_many(self, latitudes, longitudes):
+        points = shapely.points(np.asarray(longitudes, dtype=float), np.asarray(latitudes, dtype=float))
+        countries = self.countries.lookup(points)
+        regions = self.regions.lookup(points) if self.regions is not None else np.full(len(points), -1)
+
+        return [self._location(self.countries.properties[c] if c >= 0 else None,
+                               self.regions.properties[r] if r >= 0 else None)
+                for c, r in zip(countries.tolist(), regions.tolist())]
+
+
+def set_secondary_attributes(caves, geocoder):
+    """ Set secondary attributes of many caves at once
+
+    :param caves: list of Cave instances
+    :param geocoder: Geocoder instance
+    :return:
+    """
+    locations = geocoder.reverse_many([cave.latitude for cave in caves], [cave.longitude for cave in caves])
+    for cave, location in zip(caves, locations):
+        if location is not None:
+            cave.set_secondary_attributes(location)
+
+
+class GeocodingQueue:
+    """ Background reverse geocoding queue
+
+    Requests are sent one at a time, no faster than the rate limit. Requests
+    for coordinates sharing the same rounded location are coalesced into one,
+    and results are stored in a persistent cache (locations table) keyed by
+    rounded location, so that each location is only geocoded once.
+    """
+    def __init__(self, geocoder=None, min_delay=None, precision=3):
+        """
+
+        :param geocoder: Geocoder instance (see default_geocoder)
+        :param min_delay: minimum delay between two requests in seconds (default to geocoder's)
+        :param precision: number of decimals of rounded locations (3 decimals ~ 100 m)
+        """
+        self.geocoder = geocoder if geocoder is not None else default_geocoder()
+        self.min_delay = min_delay if min_delay is not None else self.geocoder.min_delay
+        self.precision = precision
+        self.pending = dict()
+        self.requests = Queue()
+        self.results = Queue()
+        self._thread = None
+
+    def _run(self):
+        last_request = 0
+        while True:
+            key = self.requests.get()
+            if key is None:
+                break
+            time.sleep(max(0, last_request + self.min_delay - time.monotonic()))
+            last_request = time.monotonic()
+            try:
+                self.results.put((key, self.geocoder.reverse(*self.location(key))))
+            except Exception as e:
+                # Any failure (network, service or geocoder bug) is reported by poll: the thread keeps running
+                self.results.put((key, e))
+
+    def close(self):
+        """ Stop background thread
+
+        :return:
+        """
+        if self._thread is not None:
+            self.requests.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def key(self, latitude, longitude):
+        return "%.*f,%.*f" % (self.precision, latitude, self.precision, longitude)
+
+    @staticmethod
+    def location(key):
+        return tuple(float(coordinate) for coordinate in key.split(","))
+
+    def poll(self, session):
+        """ Apply available results to caves and cache
+
+        Must be called from the thread owning the session. Changes are
+        flushed, and committed by the caller (e.g. its unit of work)
+        :param session: database session
+        :return: (list of updated cave ids, list of errors)
+        """
+        updated, errors = [], []
+        while True:
+            try:
+                key, location = self.results.get_nowait()
+            except Empty:
+                break
+
+            cave_ids = self.pending.pop(key)
+            if isinstance(location, Exception):
+                # Caves stay without secondary attributes until next backfill
+                errors.append(location)
+                continue
+
+            session.add(Location(key=key, raw=json.dumps(location)))
+            if location is not None:
+                for cave in session.query(Cave).filter(Cave.id.in_(cave_ids)):
+                    cave.set_secondary_attributes(location)
+                    updated.append(cave.id)
+
+        if updated or errors:
+            session.flush()
+
+        return updated, errors
+
+    def cached_locations(self, session, keys, batch_size=500):
+        """ Return cached raw locations of rounded location keys
+
+        :param session: database session
+        :param keys: list of location keys
+        :param batch_size: number of keys per query
+        :return: dict of raw locations (None when nothing was found) by key
+        """
+        cached = dict()
+        for i in range(0, len(keys), batch_size):
+            cached.update((key, json.loads(raw)) for key, raw in session.query(Location.key, Location.raw).filter(
+                Location.key.in_(keys[i:i + batch_size])))
+
+        return cached
+
+    def submit(self, session, cave):
+        """ Submit cave for reverse geocoding
+
+        Cave is immediately updated when its location is in cache
+        :param session: database session
+        :param cave: Cave instance (already stored in database)
+        :return: True if cave was updated from cache, False otherwise
+        """
+        return self.submit_many(session, [cave]) == 1
+
+    def submit_many(self, session, caves):
+        """ Submit caves for reverse geocoding
+
+        Caves whose location is in cache are immediately updated
+        :param session: database session
+        :param caves: list of Cave instances (already stored in database)
+        :return: number of caves updated from cache
+        """
+        keys = [self.key(cave.latitude, cave.longitude) for cave in caves]
+        cached = self.cached_locations(session, list(set(keys)))
+        updated = 0
+
+        for key, cave in zip(keys, caves):
+            if key in cached:
+                if cached[key] is not None:
+                    cave.set_secondary_attributes(cached[key])
+                updated += 1
+            elif key in self.pending:
+                self.pending[key].add(cave.id)
+            else:
+                self.pending[key] = {cave.id}
+                self.requests.put(key)
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+
+        return updated
+
+    def backfill(self, session):
+        """ Submit all caves without secondary attributes (e.g. saved while offline)
+
+        Changes are flushed, and committed by the caller (e.g. its unit of work)
+        :param session: database session
+        :return: number of caves updated from cache
+        """
+        updated = self.submit_many(session, session.query(Cave).filter(Cave.address.is_(None)).all())
+        if updated:
+            session.flush()
+
+        return updated
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+""" Image file tools
+
+Tools for reading image files without decoding full pixel data (header
+probe, reduced previews), and for identifying image files independently of
+their name and location: content digests for exact copies, perceptual hashes
+for re-saved copies.
+"""
+import hashlib
+import io
+from collections import defaultdict, namedtuple
+from functools import lru_cache
+from itertools import combinations
+
+import numpy as np
+from PIL import Image as PilImage, ExifTags
+
+DIGEST_SIZE = 32
+CHUNK_SIZE = 1 << 20
+HASH_SIZE = 8
+THUMBNAIL_SIZE = (128, 128)
+
+# EXIF tags of embedded JPEG thumbnail (offset and length), and TIFF tags
+JPEG_INTERCHANGE_FORMAT = 0x0201
+JPEG_INTERCHANGE_FORMAT_LENGTH = 0x0202
+BITS_PER_SAMPLE = 258
+NEW_SUBFILE_TYPE = 254
+
+# Errors raised by PIL on missing, corrupt, truncated or oversized (decompression bomb) files. Warnings
+# (e.g. DecompressionBombWarning, corrupt EXIF data) are errors when turned into errors, as in the GUI
+UNREADABLE_IMAGE_ERRORS = (OSError, ValueError, SyntaxError, PilImage.DecompressionBombError, Warning)
+
+ImageHeader = namedtuple("ImageHeader", ["width", "height", "mode", "bit_depth", "format", "thumbnail"])
+
+
+def _bit_depth(image):
+    """ Number of bits per channel
+
+    """
+    bits = getattr(image, "tag_v2", {}).get(BITS_PER_SAMPLE)  # TIFF
+    if bits:
+        return max(bits) if isinstance(bits, tuple) else bits
+    if image.mode == "1":
+        return 1
+    elif image.mode.startswith("I;16"):
+        return 16
+    elif image.mode in ("I", "F"):
+        return 32
+    else:
+        return 8
+
+
+def _embedded_thumbnail(image):
+    """ Bytes of JPEG thumbnail embedded in EXIF data (None if any)
+
+    """
+    exif = image.info.get("exif")
+    if not exif:
+        return None
+    try:
+        ifd1 = image.getexif().get_ifd(ExifTags.IFD.IFD1)
+        offset, length = ifd1[JPEG_INTERCHANGE_FORMAT], ifd1[JPEG_INTERCHANGE_FORMAT_LENGTH]
+    except (KeyError, SyntaxError, ValueError):
+        return None
+    # Offset is relative to TIFF header, which follows "Exif\0\0"
+    start = 6 + offset if exif.startswith(b"Exif") else offset
+    thumbnail = exif[start:start + length]
+
+    return thumbnail if len(thumbnail) == length else None
+
+
+def _image_header(image):
+    return ImageHeader(image.width, image.height, image.mode, _bit_depth(image), image.format,
+                       _embedded_thumbnail(image))
+
+
+def _preview_size(header, size):
+    """ Size of image scaled down to fit in size
+
+    """
+    scale = min(size[0] / header.width, size[1] / header.height, 1)
+    return max(round(header.width * scale), 1), max(round(header.height * scale), 1)
+
+
+def _embedded_preview(header, size, aspect_tolerance=0.02):
+    """ Embedded JPEG thumbnail, when large enough and of the same aspect ratio as image (None otherwise)
+
+    Thumbnails padded with borders (other aspect ratio) would change the perceptual hash
+    """
+    if header.thumbnail is None:
+        return None
+    try:
+        thumbnail = PilImage.open(io.BytesIO(header.thumbnail))
+        thumbnail.load()
+    except UNREADABLE_IMAGE_ERRORS:
+        return None
+
+    width, height = _preview_size(header, size)
+    if thumbnail.width < width or thumbnail.height < height or abs(
+            thumbnail.width * header.height / (thumbnail.height * header.width) - 1) > aspect_tolerance:
+        return None
+
+    return thumbnail
+
+
+def _reduced_frame(image, header, size):
+    """ Seek smallest reduced resolution TIFF subfile still covering preview size (if any)
+
+    """
+    width, height = _preview_size(header, size)
+    best = None
+    for frame in range(getattr(image, "n_frames", 1)):
+        image.seek(frame)
+        reduced = image.tag_v2.get(NEW_SUBFILE_TYPE, 0) & 1
+        if reduced and image.width >= width and image.height >= height and (best is None or
+                                                                             image.width < best[1]):
+            best = (frame, image.width)
+    image.seek(best[0] if best is not None else 0)
+
+
+def read_preview(filename, size=THUMBNAIL_SIZE):
+    """ Read header and reduced copy of image fitting in size
+
+    Full resolution pixel data are only decoded as a last resort: embedded
+    JPEG thumbnail is used when large enough, otherwise JPEG images are
+    decoded at reduced size (draft mode) and multi-resolution TIFF images
+    from their reduced resolution subfile. File is closed before returning
+    :param filename: path to image file
+    :param size: maximum (width, height) of preview
+    :return: (ImageHeader, L or RGB PIL image)
+    """
+    with PilImage.open(filename) as image:
+        header = _image_header(image)
+        preview = _embedded_preview(header, size)
+        if preview is None:
+            if header.format == "TIFF":
+                _reduced_frame(image, header, size)
+            image.draft("RGB", size)
+            preview = image
+        if preview.mode not in ("L", "RGB"):
+            preview = preview.convert("RGB")
+        preview = preview.copy()
+    preview.thumbnail(size)
+
+    return header, preview
+
+
+def fingerprint(filename, thumbnail_size=THUMBNAIL_SIZE):
+    """ Compute stored attributes of image file
+
+    Dimensions, mode, bit depth, content digest, perceptual hash (see dhash)
+    and PNG preview thumbnail. Pixel data are only decoded at thumbnail size
+    (see read_preview): perceptual hash is computed from thumbnail, so that
+    images added one at a time or by folder get the same hash.
+    :param filename: path to image file
+    :param thumbnail_size: maximum (width, height) of thumbnail
+    :return: dict with width, height, mode, bit_depth, digest, phash (hexadecimal) and thumbnail (PNG bytes) keys
+    """
+    digest = file_digest(filename)
+    header, preview = read_preview(filename, thumbnail_size)
+    buffer = io.BytesIO()
+    preview.save(buffer, format="PNG")
+
+    return dict(width=header.width, height=header.height, mode=header.mode, bit_depth=header.bit_depth,
+                digest=digest, phash="%0*x" % (HASH_SIZE ** 2 // 4, dhash(preview)), thumbnail=buffer.getvalue())
+
+
+def file_digest(filename, chunk_size=CHUNK_SIZE):
+    """ Return BLAKE2 hexadecimal digest of file content
+
+    File is read by chunks, so that memory use does not depend on file size
+    :param filename: path to file
+    :param chunk_size: size of chunks in bytes
+    :return:
+    """
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def dhash(image, hash_size=HASH_SIZE):
+    """ Return difference hash of image
+
+    Perceptual hash robust to re-encoding, resizing and small color changes:
+    image is decoded at reduced size when supported (JPEG draft mode), shrunk
+    to (hash_size + 1, hash_size) gray pixels and each bit tells whether a
+    pixel is brighter than its right neighbour.
+    :param image: PIL image
+    :param hash_size: hash is hash_size ** 2 bits long
+    :return: integer hash
+    """
+    image.draft("L", (4 * (hash_size + 1), 4 * hash_size))
+    if image.mode not in ("L", "RGB"):
+        image = image.convert("RGB")
+    pixels = np.asarray(image.resize((hash_size + 1, hash_size), PilImage.BILINEAR, reducing_gap=2.0).convert("L"),
+                        dtype=int)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming(hash1, hash2):
+    """ Hamming distance between integer hashes
+
+    :param hash1:
+    :param hash2:
+    :return:
+    """
+    return bin(hash1 ^ hash2).count("1")
+
+
+@lru_cache()
+def flip_masks(nb_bits, radius):
+    """ Masks flipping up to radius bits of an nb_bits long substring
+
+    :param nb_bits: length of substring
+    :param radius: maximum number of flipped bits
+    :return: tuple of integer masks
+    """
+    return tuple(sum(1 << bit for bit in bits) for r in range(radius + 1) for bits in combinations(range(nb_bits), r))
+
+
+class HammingIndex:
+    """ Multi-index hashing for hamming distance search among perceptual hashes
+
+    Hashes are split into nb_chunks substrings, each one indexed in its own
+    hash table. By pigeonhole principle, two hashes within distance r share at
+    least one substring within distance r // nb_chunks: search only looks up
+    those substring neighbours, then checks full distance of candidates.
+    """
+
+    def __init__(self, nb_bits=HASH_SIZE ** 2, nb_chunks=4):
+        self.nb_chunks = nb_chunks
+        self.chunk_bits = nb_bits // nb_chunks
+        self.tables = [defaultdict(set) for _ in range(nb_chunks)]
+        self.keys = dict()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _chunks(self, key):
+        mask = (1 << self.chunk_bits) - 1
+        return [(key >> (i * self.chunk_bits)) & mask for i in range(self.nb_chunks)]
+
+    def add(self, key, item):
+        """ Add item with given hash key (replacing its previous key, if any)
+
+        :param key: integer hash
+        :param item: any hashable object (e.g. image id)
+        :return:
+        """
+        if item in self.keys:
+            self.remove(item)
+        self.keys[item] = key
+        for table, chunk in zip(self.tables, self._chunks(key)):
+            table[chunk].add(item)
+
+    def remove(self, item):
+        """ Remove item
+
+        :param item:
+        :return:
+        """
+        key = self.keys.pop(item)
+        for table, chunk in zip(self.tables, self._chunks(key)):
+            table[chunk].discard(item)
+            if not table[chunk]:
+                del table[chunk]
+
+    def search(self, key, radius):
+        """ Search items within radius of key
+
+        :param key: integer hash
+        :param radius: maximum hamming distance
+        :return: list of (distance, item) sorted by distance
+        """
+        flips = flip_masks(self.chunk_bits, radius // self.nb_chunks)
+        candidates = set()
+        for table, chunk in zip(self.tables, self._chunks(key)):
+            for flip in flips:
+                candidates.update(table.get(chunk ^ flip, ()))
+
+        return sorted((d, item) for d, item in ((hamming(key, self.keys[item]), item) for item in candidates)
+                      if d <= radius)
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+
+""" Bulk import of data into Kalimain database
+
+Caves are read from CSV, GPX (waypoints) or KML (placemarks) files. Hand
+landmarks digitised elsewhere are read from CSV or JSON files, and inserted
+along with their features by chunks, with executemany inserts.
+
+Usage: python -m kalimain.importer landmarks.csv [--chunk-size 10000] [--profile bulk]
+"""
+import argparse
+import csv
+import json
+import os
+import time
+import xml.etree.ElementTree as ElementTree
+from collections import namedtuple
+from itertools import islice
+
+import numpy as np
+from sqlalchemy import select
+
+from kalimain.database import Cave, Location, Hand, HPoint, Image
+from kalimain.features import NB_LANDMARKS, compute_features
+from kalimain.geo import duplicate_mask
+from kalimain.geocoding import GeocodingQueue, default_geocoder
+from kalimain.summary import add_hands, create_tables
+
+CaveImportReport = namedtuple("CaveImportReport", ["read", "duplicates", "geocoded", "caves"])
+LandmarkImportReport = namedtuple("LandmarkImportReport", ["read", "inserted", "invalid", "unmatched", "rounded",
+                                                           "elapsed"])
+
+
+def _tag(element):
+    """ Tag name without namespace
+
+    """
+    return element.tag.rsplit("}", 1)[-1]
+
+
+def _child_text(element, tag):
+    for child in element:
+        if _tag(child) == tag:
+            return child.text.strip() if child.text else None
+
+
+def read_caves_csv(filename):
+    """ Read caves from CSV file
+
+    Columns: latitude (or lat), longitude (or lon), and optional name and description
+    :param filename:
+    :return: generator of dicts
+    """
+    with open(filename, newline="") as file:
+        for row in csv.DictReader(file):
+            row = {key.strip().lower(): val for key, val in row.items() if key is not None}
+            yield dict(name=row.get("name") or None, description=row.get("description") or None,
+                       latitude=float(row["latitude"] if "latitude" in row else row["lat"]),
+                       longitude=float(row["longitude"] if "longitude" in row else row["lon"]))
+
+
+def read_caves_gpx(filename):
+    """ Read caves from GPX waypoints
+
+    :param filename:
+    :return: generator of dicts
+    """
+    for _, element in ElementTree.iterparse(filename):
+        if _tag(element) == "wpt":
+            yield dict(name=_child_text(element, "name"), description=_child_text(element, "desc"),
+                       latitude=float(element.get("lat")), longitude=float(element.get("lon")))
+            element.clear()
+
+
+def read_caves_kml(filename):
+    """ Read caves from KML point placemarks
+
+    :param filename:
+    :return: generator of dicts
+    """
+    for _, element in ElementTree.iterparse(filename):
+        if _tag(element) == "Placemark":
+            coordinates = [item.text for item in element.iter() if _tag(item) == "coordinates"]
+            if coordinates:
+                longitude, latitude = coordinates[0].split()[0].split(",")[:2]
+                yield dict(name=_child_text(element, "name"), description=_child_text(element, "description"),
+                           latitude=float(latitude), longitude=float(longitude))
+            element.clear()
+
+
+def read_caves(filename):
+    """ Read caves from CSV, GPX or KML file
+
+    :param filename:
+    :return: generator of dicts with name, description, latitude and longitude keys
+    """
+    readers = {".csv": read_caves_csv, ".gpx": read_caves_gpx, ".kml": read_caves_kml}
+    try:
+        return readers[os.path.splitext(filename)[1].lower()](filename)
+    except KeyError:
+        raise ValueError("Unsupported cave file format: '%s'" % filename)
+
+
+def import_caves(session, project, filename, tolerance=0.05, geocoder=None, batch_size=1000, precision=3):
+    """ Import caves from file into project
+
+    Records are streamed by chunks of batch_size. Caves lying within
+    tolerance of another cave of the database or of a previous cave of the
+    file are skipped. Unique rounded locations which are not in geocoding
+    cache are reverse geocoded by batches, unless geocoder is rate limited
+    (e.g. Nominatim): those caves are then left to the geocoding queue
+    backfill. Caves are flushed, not committed: the caller commits (e.g. its
+    unit of work), so that all caves are inserted in one transaction.
+    :param session: database session
+    :param project: Project instance
+    :param filename: path to CSV, GPX or KML file
+    :param tolerance: duplicate tolerance in km
+    :param geocoder: Geocoder instance (default: kalimain.geocoding.default_geocoder)
+    :param batch_size: number of records per chunk, and of locations per geocoding batch
+    :param precision: number of decimals of rounded geocoding locations
+    :return: CaveImportReport
+    """
+    if geocoder is None:
+        geocoder = default_geocoder()
+    queue = GeocodingQueue(geocoder, precision=precision)
+    records = read_caves(filename)
+
+    # Coordinates of caves of the database and of caves kept so far
+    existing = np.array(session.query(Cave.latitude, Cave.longitude).all(), dtype=float).reshape(-1, 2)
+    latitudes, longitudes = existing[:, 0], existing[:, 1]
+    cached = dict()
+    caves = []
+    read = nb_duplicates = geocoded = 0
+
+    while True:
+        chunk = list(islice(records, batch_size))
+        if not chunk:
+            break
+        read += len(chunk)
+
+        # Compare chunk with previous caves and with itself in one vectorized pass
+        chunk_latitudes = np.concatenate([latitudes, [record["latitude"] for record in chunk]])
+        chunk_longitudes = np.concatenate([longitudes, [record["longitude"] for record in chunk]])
+        duplicates = duplicate_mask(chunk_latitudes, chunk_longitudes, tolerance, len(latitudes))[len(latitudes):]
+        nb_duplicates += int(duplicates.sum())
+        latitudes = np.concatenate([latitudes, chunk_latitudes[len(latitudes):][~duplicates]])
+        longitudes = np.concatenate([longitudes, chunk_longitudes[len(longitudes):][~duplicates]])
+        chunk_caves = [Cave(project_id=project.id, **record) for record, duplicate in zip(chunk, duplicates)
+                       if not duplicate]
+
+        # Geocode unique locations only
+        locations = dict()
+        for cave in chunk_caves:
+            locations.setdefault(queue.key(cave.latitude, cave.longitude), []).append(cave)
+        cached.update(queue.cached_locations(session, [key for key in locations if key not in cached], batch_size))
+
+        missing = [key for key in locations if key not in cached]
+        if geocoder.min_delay == 0 and missing:
+            raw = geocoder.reverse_many(*zip(*[queue.location(key) for key in missing]))
+            session.add_all([Location(key=key, raw=json.dumps(location)) for key, location in zip(missing, raw)])
+            cached.update(zip(missing, raw))
+            geocoded += len(missing)
+
+        for key, chunk_key_caves in locations.items():
+            if cached.get(key) is not None:
+                for cave in chunk_key_caves:
+                    cave.set_secondary_attributes(cached[key])
+
+        session.add_all(chunk_caves)
+        session.flush()
+        caves += chunk_caves
+
+    return CaveImportReport(read, nb_duplicates, geocoded, caves)
+
+
+def read_landmarks_csv(filename):
+    """ Read hand landmarks from CSV file
+
+    Columns: image_id, image_path or image (name) to identify the image,
+    optional cave (name) when image names are not unique, and x1, y1, ...,
+    x12, y12 landmark coordinates in image pixels
+    :param filename:
+    :return: generator of dicts with image_id, image_path, image, cave and landmarks (flat list of 24
+    coordinates, None if malformed or if image_id is not an integer) keys
+    """
+    with open(filename, newline="") as file:
+        reader = csv.reader(file)
+        columns = {key.strip().lower(): i for i, key in enumerate(next(reader, []))}
+        coordinates = [columns.get("%s%d" % (axis, i)) for i in range(1, NB_LANDMARKS + 1) for axis in "xy"]
+        keys = [(key, columns.get(key)) for key in ("image_id", "image_path", "image", "cave")]
+
+        for row in reader:
+            record = {key: row[i] or None if i is not None and i < len(row) else None for key, i in keys}
+            try:
+                record["landmarks"] = [float(row[i]) for i in coordinates]
+            except (IndexError, TypeError, ValueError):
+                record["landmarks"] = None
+            if record["image_id"] is not None:
+                try:
+                    record["image_id"] = int(record["image_id"])
+                except ValueError:
+                    record["image_id"] = record["landmarks"] = None
+            yield record
+
+
+def read_landmarks_json(filename):
+    """ Read hand landmarks from JSON file
+
+    JSON file is a list of hands (or an object with a "hands" list), each hand
+    being an object with image_id, image_path or image keys, optional cave key
+    and a "landmarks" list of 12 [x, y] points
+    :param filename:
+    :return: generator of dicts with image_id, image_path, image, cave and landmarks keys
+    """
+    with open(filename) as file:
+        hands = json.load(file)
+    if isinstance(hands, dict):
+        hands = hands["hands"]
+
+    for hand in hands:
+        yield dict(image_id=hand.get("image_id"), image_path=hand.get("image_path"), image=hand.get("image"),
+                   cave=hand.get("cave"), landmarks=hand.get("landmarks"))
+
+
+def read_landmarks(filename):
+    """ Read hand landmarks from CSV or JSON file
+
+    :param filename:
+    :return: generator of dicts
+    """
+    readers = {".csv": read_landmarks_csv, ".json": read_landmarks_json}
+    try:
+        return readers[os.path.splitext(filename)[1].lower()](filename)
+    except KeyError:
+        raise ValueError("Unsupported landmark file format: '%s'" % filename)
+
+
+class ImageLookup:
+    """ Map image ids, paths or (cave, image) names to image ids
+
+    """
+    def __init__(self, connection):
+        self.ids, self.paths, self.names = set(), dict(), dict()
+        for image_id, path, name, cave in connection.execute(select(Image.id, Image.path, Image.name, Cave.name).
+                                                             outerjoin(Cave, Image.cave_id == Cave.id)):
+            self.ids.add(image_id)
+            if path is not None:
+                self.paths[path] = image_id
+            self.names.setdefault((None, name), []).append(image_id)
+            if cave is not None:
+                self.names.setdefault((cave, name), []).append(image_id)
+
+    def get(self, record):
+        """ Return id of image of record (None if not found or ambiguous)
+
+        """
+        if record["image_id"] is not None:
+            return record["image_id"] if record["image_id"] in self.ids else None
+        if record["image_path"] is not None:
+            return self.paths.get(record["image_path"])
+        image_ids = self.names.get((record["cave"], record["image"]), [])
+        return image_ids[0] if len(image_ids) == 1 else None
+
+
+def executemany(connection, table, columns, rows):
+    """ Insert rows with a single DBAPI executemany call
+
+    Values are passed as they are to the driver, skipping SQLAlchemy's per
+    row parameter processing
+    :param connection: SQLAlchemy connection
+    :param table: Table instance
+    :param columns: list of column names
+    :param rows: list of tuples of values (same order as columns)
+    :return:
+    """
+    if not rows:
+        return
+    compiled = table.insert().compile(dialect=connection.dialect, column_keys=columns)
+    if compiled.positional:
+        index = [columns.index(key) for key in compiled.positiontup]
+        if index != list(range(len(columns))):
+            rows = [tuple(row[i] for i in index) for row in rows]
+    else:
+        rows = [dict(zip(columns, row)) for row in rows]
+    connection.exec_driver_sql(str(compiled), rows)
+
+
+def _landmark_array(records):
+    """ Landmarks of records as (N, 12, 2) array (NaN for missing or malformed landmarks)
+
+    """
+    try:
+        landmarks = np.array([record["landmarks"] for record in records], dtype=float)
+        return landmarks.reshape(len(records), NB_LANDMARKS, 2)
+    except (TypeError, ValueError):
+        landmarks = np.full((len(records), NB_LANDMARKS, 2), np.nan)
+        for i, record in enumerate(records):
+            try:
+                landmarks[i] = np.asarray(record["landmarks"], dtype=float).reshape(NB_LANDMARKS, 2)
+            except (TypeError, ValueError):
+                pass
+        return landmarks
+
+
+def valid_landmarks(landmarks):
+    """ Check landmark array of shape (N, 12, 2)
+
+    Landmarks must be finite and give finite, non-negative features (e.g. not
+    all points on a line)
+    :param landmarks: array of shape (N, 12, 2)
+    :return: (boolean mask of valid hands, HandFeatures of all hands)
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        hand_features = compute_features(np.where(np.isfinite(landmarks), landmarks, 0))
+    valid = np.isfinite(landmarks).all(axis=(1, 2)) & np.isfinite(hand_features.digits).all(axis=1) & \
+        np.isfinite(hand_features.manning) & (hand_features.digits > 0).all(axis=1)
+
+    return valid, hand_features
+
+
+def import_landmarks(engine, filename, chunk_size=10000):
+    """ Import hands from landmark file
+
+    Records are processed by chunks: landmarks are validated, mapped to
+    existing images and features are computed in batch, then hands and points
+    are inserted with executemany, one transaction per chunk. Hands with
+    invalid landmarks or unknown image are skipped. Coordinates are rounded to
+    integer pixels, as points drawn in the application, before features are
+    computed.
+    :param engine: SQLAlchemy engine (see kalimain.sqlite.tune_engine for bulk pragmas)
+    :param filename: path to CSV or JSON file
+    :param chunk_size: number of hands per chunk (and per transaction)
+    :return: LandmarkImportReport
+    """
+    start_time = time.perf_counter()
+    records = read_landmarks(filename)
+    read = inserted = invalid = unmatched = rounded = 0
+
+    with engine.connect() as connection:
+        images = ImageLookup(connection)
+
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+        read += len(chunk)
+
+        landmarks = _landmark_array(chunk)
+        with np.errstate(invalid="ignore"):
+            fractional = (landmarks != np.rint(landmarks)).any(axis=(1, 2))
+        landmarks = np.rint(landmarks)
+        valid, hand_features = valid_landmarks(landmarks)
+        image_ids = np.array([images.get(record) or -1 for record in chunk])
+        invalid += int((~valid).sum())
+        unmatched += int((valid & (image_ids < 0)).sum())
+        keep = np.flatnonzero(valid & (image_ids >= 0))
+        if not len(keep):
+            continue
+        rounded += int(fractional[keep].sum())
+
+        # Columns in table order, so that rows need not be reordered
+        columns = ["left", "right", "D1", "D2", "D3", "D4", "D5", "manning", "image_id"]
+        rows = [(is_left, not is_left, *digits, manning, image_id) for is_left, digits, manning, image_id in zip(
+            hand_features.left[keep].tolist(), hand_features.digits[keep].tolist(),
+            hand_features.manning[keep].tolist(), image_ids[keep].tolist())]
+        with engine.begin() as connection:
+            # Id of first hand is assigned by the database, whose write lock is then held until commit: other
+            # hands get the next ids (executemany does not return primary keys)
+            first_id, = connection.execute(Hand.__table__.insert().values(dict(zip(columns, rows[0])))).\
+                inserted_primary_key
+            hand_ids = np.arange(first_id, first_id + len(keep))
+            executemany(connection, Hand.__table__, ["id"] + columns,
+                        [(hand_id, *row) for hand_id, row in zip(hand_ids[1:].tolist(), rows[1:])])
+            points = landmarks[keep].reshape(-1, 2).astype(int)
+            executemany(connection, HPoint.__table__, ["x", "y", "hand_id"],
+                        list(zip(points[:, 0].tolist(), points[:, 1].tolist(),
+                                 np.repeat(hand_ids, NB_LANDMARKS).tolist())))
+            add_hands(connection, Hand.id.between(first_id, int(hand_ids[-1])))
+        inserted += len(keep)
+
+    return LandmarkImportReport(read, inserted, invalid, unmatched, rounded, time.perf_counter() - start_time)
+
+
+def main(argv=None):
+    """ Command line interface of landmark import
+
+    :param argv: command line arguments
+    :return:
+    """
+    from sqlalchemy import create_engine
+    from kalimain import ENGINE
+    from kalimain.sqlite import PRAGMA_PROFILES, tune_engine
+
+    parser = argparse.ArgumentParser(prog="python -m kalimain.importer",
+                                     description="Import hand landmarks from CSV or JSON files")
+    parser.add_argument("files", nargs="+", help="CSV or JSON landmark files")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="number of hands per transaction")
+    parser.add_argument("--profile", choices=sorted(PRAGMA_PROFILES), default="bulk", help="SQLite pragma profile")
+    args = parser.parse_args(argv)
+
+    # Same database as the application, without statement logging
+    engine = tune_engine(create_engine(ENGINE.url), args.profile)
+    create_tables(engine)
+    for filename in args.files:
+        report = import_landmarks(engine, filename, args.chunk_size)
+        print("%s: %d hand(s) read, %d inserted (%d with rounded coordinates), %d invalid, %d without matching "
+              "image - %.1f s - %.0f hands/s" % (
+                  filename, report.read, report.inserted, report.rounded, report.invalid, report.unmatched,
+                  report.elapsed, report.read / report.elapsed if report.elapsed else 0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+""" Folder ingest of images
+
+Walk a folder tree and add every image file to a cave. Files are probed
+(header, dimensions, content digest, perceptual hash and preview thumbnail)
+in a thread pool, duplicates are filtered out by digest and new images are
+inserted in batched transactions. Ingest can be cancelled at any time from
+another thread: images inserted so far are kept.
+"""
+import os
+import threading
+import time
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import kalimain
+from kalimain.database import Image
+from kalimain.imaging import THUMBNAIL_SIZE, UNREADABLE_IMAGE_ERRORS, fingerprint
+from kalimain.jobs import Progress, ProgressNotifier
+
+IMAGE_EXTENSIONS = (".bmp", ".jpeg", ".jpg", ".png", ".tif", ".tiff")
+
+IngestReport = namedtuple("IngestReport", ["inserted", "duplicates", "errors", "cancelled"])
+
+
+def walk_images(directory, extensions=IMAGE_EXTENSIONS):
+    """ Yield paths of image files within folder tree
+
+    :param directory: path to root folder
+    :param extensions: image file extensions (lower case)
+    :return:
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(files):
+            if os.path.splitext(filename)[1].lower() in extensions:
+                yield os.path.join(root, filename)
+
+
+def probe_file(filename, thumbnail_size=THUMBNAIL_SIZE):
+    """ Read image file metadata, digest, perceptual hash and PNG thumbnail
+
+    File is closed before returning
+    :param filename:
+    :param thumbnail_size: maximum (width, height) of thumbnail
+    :return: dict of Image column values, or None if file could not be read
+    """
+    try:
+        attributes = fingerprint(filename, thumbnail_size)
+    except UNREADABLE_IMAGE_ERRORS:
+        return None
+
+    return dict(attributes, path=filename, name=os.path.splitext(os.path.basename(filename))[0])
+
+
+class ImageIngest:
+    """ Ingest all images of a folder tree into a cave
+
+    """
+    def __init__(self, session_factory=None, workers=None, batch_size=100, thumbnail_size=THUMBNAIL_SIZE):
+        """
+
+        :param session_factory: callable returning a new session (default: kalimain.SESSION)
+        :param workers: number of threads probing files (None = ThreadPoolExecutor's default)
+        :param batch_size: number of images inserted per transaction
+        :param thumbnail_size: maximum (width, height) of preview thumbnails
+        """
+        self.session_factory = session_factory if session_factory is not None else kalimain.SESSION
+        self.workers = workers
+        self.batch_size = batch_size
+        self.thumbnail_size = thumbnail_size
+        self.progress_notifier = ProgressNotifier()
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        """ Stop ingest (thread safe)
+
+        :return:
+        """
+        self.cancel_event.set()
+
+    def _insert(self, session, batch, seen):
+        """ Insert batch of image rows which are not already in database
+
+        :return: number of duplicates
+        """
+        digests = [row["digest"] for row in batch]
+        existing = {digest for digest, in session.query(Image.digest).filter(Image.digest.in_(digests))}
+        rows = []
+        for row in batch:
+            if row["digest"] not in existing and row["digest"] not in seen:
+                seen.add(row["digest"])
+                rows.append(row)
+        session.bulk_insert_mappings(Image, rows)
+        session.commit()
+
+        return len(batch) - len(rows)
+
+    def run(self, directory, cave_id):
+        """ Run ingest
+
+        :param directory: path to root folder
+        :param cave_id: id of cave images belong to
+        :return: IngestReport
+        """
+        self.cancel_event.clear()
+        files = list(walk_images(directory))
+        session = self.session_factory()
+        workers = self.workers if self.workers is not None else min(32, (os.cpu_count() or 1) + 4)
+        executor = ThreadPoolExecutor(workers)
+        read = duplicates = errors = done = 0
+        start_time = time.perf_counter()
+        batch, seen, pending = [], set(), deque()
+        files_iter = iter(files)
+
+        try:
+            while not self.cancel_event.is_set():
+                # Bounded number of files in flight, so that cancellation is fast
+                while len(pending) < 2 * workers:
+                    filename = next(files_iter, None)
+                    if filename is None:
+                        break
+                    pending.append(executor.submit(probe_file, filename, self.thumbnail_size))
+                if not pending:
+                    break
+
+                row = pending.popleft().result()
+                done += 1
+                if row is None:
+                    errors += 1
+                else:
+                    row.update(cave_id=cave_id)
+                    batch.append(row)
+
+                if len(batch) >= self.batch_size:
+                    duplicates += self._insert(session, batch, seen)
+                    read, batch = read + len(batch), []
+
+                elapsed = time.perf_counter() - start_time
+                self.progress_notifier.notify_observers(Progress(done, len(files), duplicates + errors, elapsed,
+                                                                 done / elapsed if elapsed else 0))
+
+            # Also keep last batch when cancelled
+            if batch:
+                duplicates += self._insert(session, batch, seen)
+                read += len(batch)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            session.close()
+
+        return IngestReport(read - duplicates, duplicates, errors, self.cancel_event.is_set())
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+
+""" Dataset-wide batch jobs
+
+Resumable jobs running over every stored hand. Hands (or images of hands) are
+streamed from the database by chunks of increasing id, computed across a
+process pool and written back with bulk updates, one transaction per chunk.
+The id of the last written hand (or image) is committed along with each
+chunk, so that an interrupted job resumes where it stopped.
+"""
+import os
+import time
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import kalimain
+from kalimain.database import Hand, HPoint, Image, Cave, JobCheckpoint, HandPigment
+from kalimain.dataset import group_landmarks
+from kalimain.features import NB_LANDMARKS, compute_features
+from kalimain.pigment import MARGIN, measure_image
+from kalimain.observer import Observable, Observer
+from kalimain.summary import rebuild
+
+Progress = namedtuple("Progress", ["done", "total", "skipped", "elapsed", "rate"])
+
+
+def compute_chunk(hand_ids, landmarks):
+    """ Compute features of a chunk of hands
+
+    Run in worker processes: return plain mappings ready for bulk update
+    :param hand_ids: array of hand ids of shape (N,)
+    :param landmarks: array of shape (N, 12, 2)
+    :return: list of dict
+    """
+    features = compute_features(landmarks)
+
+    return [dict(id=hand_id, left=left, right=not left, D1=d1, D2=d2, D3=d3, D4=d4, D5=d5, manning=manning)
+            for hand_id, left, (d1, d2, d3, d4, d5), manning in zip(hand_ids.tolist(), features.left.tolist(),
+                                                                    features.digits.tolist(),
+                                                                    features.manning.tolist())]
+
+
+class ProgressNotifier(Observable):
+
+    def notify_observers(self, arg=None):
+        self.set_changed()
+        super().notify_observers(arg)
+
+
+class PrintProgress(Observer):
+    """ Print job progress and throughput
+
+    """
+    def __init__(self, unit="hands"):
+        self.unit = unit
+
+    def update(self, observable, progress):
+        print("%d/%d %s (%d skipped) - %.1f s - %.0f %s/s" % (progress.done, progress.total, self.unit,
+                                                             progress.skipped, progress.elapsed, progress.rate,
+                                                             self.unit))
+
+
+class CheckpointJob:
+    """ Base class of resumable jobs, checkpointed by name (and project)
+
+    """
+    name = None
+
+    def __init__(self, session_factory=None, processes=None, project_id=None):
+        """
+
+        :param session_factory: callable returning a new session (default: kalimain.SESSION)
+        :param processes: number of worker processes (None = number of CPUs, 0 = no process pool)
+        :param project_id: if not None, only process hands of that project
+        """
+        self.session_factory = session_factory if session_factory is not None else kalimain.SESSION
+        self.processes = processes
+        self.project_id = project_id
+        self.progress_notifier = ProgressNotifier()
+
+    @property
+    def checkpoint_name(self):
+        if self.project_id is None:
+            return self.name
+        else:
+            return "%s_%d" % (self.name, self.project_id)
+
+    def _get_checkpoint(self, session, restart):
+        checkpoint = session.query(JobCheckpoint).filter_by(name=self.checkpoint_name).first()
+        if checkpoint is None:
+            checkpoint = JobCheckpoint(name=self.checkpoint_name, last_id=0)
+            session.add(checkpoint)
+        elif restart:
+            checkpoint.last_id = 0
+        session.commit()
+
+        return checkpoint
+
+
+class RecomputeFeaturesJob(CheckpointJob):
+    """ Recompute features (handedness, D1-D5, Manning index) of all stored hands
+
+    """
+    name = "recompute_features"
+
+    def __init__(self, session_factory=None, chunk_size=10000, processes=None, project_id=None):
+        """
+
+        :param session_factory: callable returning a new session (default: kalimain.SESSION)
+        :param chunk_size: number of hands per chunk (and per transaction)
+        :param processes: number of worker processes (None = number of CPUs, 0 = no process pool)
+        :param project_id: if not None, only recompute hands of that project
+        """
+        super().__init__(session_factory, processes, project_id)
+        self.chunk_size = chunk_size
+
+    def _filter(self, query):
+        if self.project_id is not None:
+            query = query.join(Image, Hand.image_id == Image.id).join(Cave).filter(Cave.project_id == self.project_id)
+        return query
+
+    def _read_chunk(self, session, last_id):
+        """ Read next chunk of hands with id greater than last_id
+
+        :return: (hand ids, landmarks, id of last hand read, number of skipped hands) or None when done
+        """
+        hand_ids = self._filter(session.query(Hand.id)).filter(Hand.id > last_id).order_by(Hand.id).limit(
+            self.chunk_size).all()
+        if not hand_ids:
+            return None
+
+        # Hands are streamed by chunks of increasing id: landmarks of one chunk only are loaded at once
+        first_id, last_id = hand_ids[0][0], hand_ids[-1][0]
+        points = np.array(self._filter(session.query(HPoint.hand_id, HPoint.x, HPoint.y).join(
+            Hand, HPoint.hand_id == Hand.id)).filter(HPoint.hand_id.between(first_id, last_id)).order_by(
+            HPoint.hand_id, HPoint.id).all(), dtype=float).reshape(-1, 3)
+
+        # Only keep hands with a complete set of landmarks
+        ids, start, counts = np.unique(points[:, 0].astype(int), return_index=True, return_counts=True)
+        valid = counts == NB_LANDMARKS
+        index = (start[valid, np.newaxis] + np.arange(NB_LANDMARKS)).ravel()
+
+        return ids[valid], points[index, 1:].reshape(-1, NB_LANDMARKS, 2), last_id, int(len(hand_ids) - valid.sum())
+
+    def run(self, restart=False):
+        """ Run job
+
+        :param restart: if True, ignore any previous checkpoint and recompute all hands
+        :return: Progress at the end of the job
+        """
+        session = self.session_factory()
+        workers = self.processes if self.processes is not None else os.cpu_count()
+        pool = ProcessPoolExecutor(workers) if workers else None
+        try:
+            checkpoint = self._get_checkpoint(session, restart)
+            total = self._filter(session.query(Hand.id)).filter(Hand.id > checkpoint.last_id).count()
+            done = skipped = 0
+            start_time = time.perf_counter()
+            progress = Progress(done, total, skipped, 0, 0)
+            pending = deque()
+            last_read_id = checkpoint.last_id
+
+            while True:
+                chunk = self._read_chunk(session, last_read_id)
+
+                if chunk is not None:
+                    hand_ids, landmarks, last_read_id, nb_skipped = chunk
+                    skipped += nb_skipped
+                    if pool is not None:
+                        pending.append((pool.submit(compute_chunk, hand_ids, landmarks), last_read_id, len(hand_ids)))
+                    else:
+                        pending.append((compute_chunk(hand_ids, landmarks), last_read_id, len(hand_ids)))
+
+                # Keep workers busy while writing results back in order
+                if pending and (chunk is None or len(pending) > workers):
+                    result, last_id, size = pending.popleft()
+                    mappings = result.result() if pool is not None else result
+                    session.bulk_update_mappings(Hand, mappings)
+                    checkpoint.last_id = last_id
+                    session.commit()
+
+                    done += size
+                    elapsed = time.perf_counter() - start_time
+                    progress = Progress(done, total, skipped, elapsed, done / elapsed if elapsed else 0)
+                    self.progress_notifier.notify_observers(progress)
+                elif chunk is None:
+                    break
+
+            # Job is complete: next run starts from scratch. Bulk updates bypass ORM
+            # events, so that hand statistics are rebuilt at once
+            session.delete(checkpoint)
+            rebuild(session.connection())
+            session.commit()
+
+            return progress
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            session.close()
+
+
+class PigmentStatisticsJob(CheckpointJob):
+    """ Measure pigment colour inside and around the outline of all stored hands
+
+    Hands are grouped by image so that every image is decoded once, and images
+    are measured in parallel. Measures are stored in HandPigment (see
+    kalimain.pigment)
+    """
+    name = "pigment_statistics"
+
+    def __init__(self, session_factory=None, images_per_chunk=16, processes=None, project_id=None, margin=MARGIN):
+        """
+
+        :param session_factory: callable returning a new session (default: kalimain.SESSION)
+        :param images_per_chunk: number of images per chunk (and per transaction)
+        :param processes: number of worker processes (None = number of CPUs, 0 = no process pool)
+        :param project_id: if not None, only measure hands of that project
+        :param margin: width of ring around hand outline, relative to the largest side of the hand bounding box
+        """
+        super().__init__(session_factory, processes, project_id)
+        self.images_per_chunk = images_per_chunk
+        self.margin = margin
+
+    def _filter(self, query):
+        query = query.join(Hand, Hand.image_id == Image.id)
+        if self.project_id is not None:
+            query = query.join(Cave, Image.cave_id == Cave.id).filter(Cave.project_id == self.project_id)
+        return query
+
+    def _read_chunk(self, session, last_id):
+        """ Read next chunk of images with id greater than last_id, with landmarks of their hands
+
+        :return: (list of (path, hand ids, landmarks) by image, ids of all hands, id of last image read,
+            number of skipped hands) or None when done
+        """
+        images = self._filter(session.query(Image.id, Image.path)).filter(Image.id > last_id).distinct().order_by(
+            Image.id).limit(self.images_per_chunk).all()
+        if not images:
+            return None
+
+        image_ids = [image_id for image_id, _ in images]
+        hands = np.array(session.query(Hand.id, Hand.image_id).filter(Hand.image_id.in_(image_ids)).order_by(
+            Hand.id).all(), dtype=np.int64).reshape(-1, 2)
+        points = np.array(session.query(HPoint.hand_id, HPoint.x, HPoint.y).join(
+            Hand, HPoint.hand_id == Hand.id).filter(Hand.image_id.in_(image_ids)).order_by(
+            HPoint.hand_id, HPoint.id).all(), dtype=float).reshape(-1, 3)
+
+        # Only keep hands with a complete set of landmarks, grouped by image
+        hand_ids, landmarks = group_landmarks(points)
+        hand_image_ids = hands[np.searchsorted(hands[:, 0], hand_ids), 1]
+        tasks = []
+        for image_id, path in images:
+            in_image = hand_image_ids == image_id
+            if in_image.any():
+                tasks.append((path, hand_ids[in_image], landmarks[in_image]))
+
+        return tasks, hands[:, 0], image_ids[-1], int(len(hands) - len(hand_ids))
+
+    def run(self, restart=False):
+        """ Run job
+
+        :param restart: if True, ignore any previous checkpoint and measure all hands
+        :return: Progress at the end of the job
+        """
+        session = self.session_factory()
+        workers = self.processes if self.processes is not None else os.cpu_count()
+        pool = ProcessPoolExecutor(workers) if workers else None
+        try:
+            checkpoint = self._get_checkpoint(session, restart)
+            total = self._filter(session.query(Hand.id).select_from(Image)).filter(
+                Image.id > checkpoint.last_id).count()
+            done = skipped = 0
+            start_time = time.perf_counter()
+            progress = Progress(done, total, skipped, 0, 0)
+            pending = deque()
+            last_read_id = checkpoint.last_id
+
+            while True:
+                chunk = self._read_chunk(session, last_read_id)
+
+                if chunk is not None:
+                    tasks, chunk_hand_ids, last_read_id, nb_skipped = chunk
+                    if pool is not None:
+                        results = [pool.submit(measure_image, path, hand_ids, landmarks, self.margin)
+                                   for path, hand_ids, landmarks in tasks]
+                    else:
+                        results = [measure_image(path, hand_ids, landmarks, self.margin)
+                                   for path, hand_ids, landmarks in tasks]
+                    pending.append((results, [len(hand_ids) for _, hand_ids, _ in tasks], chunk_hand_ids,
+                                    last_read_id, nb_skipped))
+
+                # Keep workers busy with the next chunk while writing results back in order
+                if pending and (chunk is None or len(pending) > 1):
+                    results, sizes, chunk_hand_ids, last_id, nb_skipped = pending.popleft()
+                    mappings = []
+                    for result, size in zip(results, sizes):
+                        rows = result.result() if pool is not None else result
+                        # Unreadable image files and hands outside of their image are skipped
+                        rows = rows if rows is not None else []
+                        nb_skipped += size - len(rows)
+                        mappings += rows
+
+                    session.query(HandPigment).filter(HandPigment.hand_id.in_(chunk_hand_ids.tolist())).delete(
+                        synchronize_session=False)
+                    session.bulk_insert_mappings(HandPigment, mappings)
+                    checkpoint.last_id = last_id
+                    session.commit()
+
+                    done += len(mappings)
+                    skipped += nb_skipped
+                    elapsed = time.perf_counter() - start_time
+                    progress = Progress(done, total, skipped, elapsed, done / elapsed if elapsed else 0)
+                    self.progress_notifier.notify_observers(progress)
+                elif chunk is None:
+                    break
+
+            # Job is complete: next run starts from scratch. Measures of hands deleted
+            # without ORM flush nor enforced foreign keys are purged
+            session.delete(checkpoint)
+            session.query(HandPigment).filter(HandPigment.hand_id.notin_(session.query(Hand.id))).delete(
+                synchronize_session=False)
+            session.commit()
+
+            return progress
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            session.close()
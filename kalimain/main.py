@@ -8,7 +8,7 @@ import warnings
 import tkinter as tk
 
 from kalimain.controller import KController
-from kalimain.exceptions import KCatcher
+from kalimain.controltools import KCatcher
 from kalimain.model import KModel
 from kalimain.view import KView
 
@@ -21,7 +21,7 @@ warnings.filterwarnings('error')
 tk.CallWrapper = KCatcher
 
 # Main model & view
-model = KModel()
+model = KModel(reset=True)  # TODO: Do not reset database when deploying (Development version)
 view = KView(tk.Tk(), model)
 
 # Main controller
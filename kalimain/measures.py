@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+""" Registry of hand measures
+
+A measure is a vectorized function of an (N, K, 2) landmark array (K = 12
+landmarks by default) returning an (N,) array, registered under a name with
+a version:
+
+    @register("palm_ratio", version=1)
+    def palm_ratio(landmarks):
+        ...
+
+Values are stored in a long table (see database.HandMeasure), one row per
+hand and measure along with the version of the measure. They are computed
+in batch on first request, for all hands without value, and then read from
+the table. Bumping the version of a measure discards its stored values only,
+so that this measure alone is computed again on next request. Hands whose
+number of landmarks differs from that of a measure get a null value.
+"""
+from collections import namedtuple
+
+import numpy as np
+from sqlalchemy import select, delete, insert, func
+
+import kalimain
+from kalimain.database import Hand, HPoint, HandMeasure
+from kalimain.dataset import read_chunks, group_landmarks
+from kalimain.features import NB_LANDMARKS, check_landmarks, compute_features, is_left_handed, distance
+
+Measure = namedtuple("Measure", ["name", "version", "function", "nb_landmarks", "description"])
+
+MeasureTable = namedtuple("MeasureTable", ["hand_ids", "names", "values"])
+
+# Registered measures, by name
+MEASURES = dict()
+
+
+def register(name, version=1, nb_landmarks=NB_LANDMARKS, description=None):
+    """ Decorator registering vectorized hand measure
+
+    Registering a name again replaces the measure (e.g. with a new version)
+    :param name: name of measure
+    :param version: version of measure, to be bumped whenever its values change
+    :param nb_landmarks: number of landmarks of hands the measure applies to
+    :param description: description of measure (default: first line of function docstring)
+    :return:
+    """
+    def decorator(function):
+        if description is None and function.__doc__:
+            summary = function.__doc__.strip().splitlines()[0]
+        else:
+            summary = description or ""
+        MEASURES[name] = Measure(name, int(version), function, nb_landmarks, summary)
+        return function
+
+    return decorator
+
+
+def get_measures(names=None, registry=None):
+    """ Registered measures from names
+
+    :param names: sequence of names (None = all registered measures)
+    :param registry: dict of measures (default: MEASURES)
+    :return: list of Measure
+    """
+    registry = registry if registry is not None else MEASURES
+    if names is None:
+        return list(registry.values())
+
+    unknown = [name for name in names if name not in registry]
+    if unknown:
+        raise ValueError("Unknown measure '%s' (valid measures: %s)" % (unknown[0], ", ".join(registry)))
+
+    return [registry[name] for name in names]
+
+
+def compute_measures(landmarks, measures):
+    """ Compute measures of a batch of hands
+
+    :param landmarks: (N, K, 2) array, K being the number of landmarks of every measure
+    :param measures: sequence of Measure
+    :return: (N, M) float array
+    """
+    landmarks = np.asarray(landmarks, dtype=float)
+    values = np.empty((len(landmarks), len(measures)))
+    for j, measure in enumerate(measures):
+        value = np.asarray(measure.function(landmarks), dtype=float)
+        if value.shape != (len(landmarks),):
+            raise ValueError("Measure '%s' returned shape %s for %d hands" % (measure.name, value.shape,
+                                                                               len(landmarks)))
+        values[:, j] = value
+
+    return values
+
+
+class MeasureStore:
+    """ Stored values of registered measures, computed lazily
+
+    """
+    def __init__(self, engine=None, registry=None, chunk_size=10000):
+        """
+
+        :param engine: SQLAlchemy engine (default: kalimain.ENGINE)
+        :param registry: dict of measures (default: MEASURES)
+        :param chunk_size: number of hands computed and written at once
+        """
+        self.engine = engine if engine is not None else kalimain.ENGINE
+        self.registry = registry if registry is not None else MEASURES
+        self.chunk_size = chunk_size
+
+    def _missing(self, connection, measures):
+        """ Hands without (current) value of some measure, and hands with value of each measure
+
+        """
+        names = [measure.name for measure in measures]
+        measured = select(HandMeasure.hand_id).where(HandMeasure.name.in_(names)).group_by(
+            HandMeasure.hand_id).having(func.count(HandMeasure.id) == len(names))
+        points = read_chunks(connection, select(HPoint.hand_id, HPoint.x, HPoint.y).where(
+            HPoint.hand_id.notin_(measured)).order_by(HPoint.hand_id, HPoint.id), np.dtype(np.float64),
+            self.chunk_size * NB_LANDMARKS)
+        existing = {name: np.fromiter(connection.execute(select(HandMeasure.hand_id).where(
+            HandMeasure.name == name, HandMeasure.hand_id.notin_(measured))).scalars(), dtype=np.int64)
+            for name in names}
+
+        return points, existing
+
+    def update(self, names=None):
+        """ Compute and store values of measures for all hands without value, in batch
+
+        Stored values of former versions of measures are discarded first
+        :param names: names of measures (None = all registered measures)
+        :return: dict of number of values computed, by measure name
+        """
+        measures = get_measures(names, self.registry)
+        computed = {measure.name: 0 for measure in measures}
+        if not measures:
+            return computed
+
+        with self.engine.begin() as connection:
+            # Values of hands deleted by ORM flushes or under enforced foreign keys are already deleted with them
+            connection.execute(delete(HandMeasure).where(HandMeasure.hand_id.notin_(select(Hand.id))))
+            for measure in measures:
+                connection.execute(delete(HandMeasure).where(HandMeasure.name == measure.name,
+                                                             HandMeasure.version != measure.version))
+
+            # Every hand with landmarks has a value of every measure (usual case)
+            nb_hands = connection.execute(select(func.count(func.distinct(HPoint.hand_id)))).scalar()
+            counts = dict(connection.execute(select(HandMeasure.name, func.count(HandMeasure.id)).where(
+                HandMeasure.name.in_(computed)).group_by(HandMeasure.name)).all())
+            if all(counts.get(name, 0) == nb_hands for name in computed):
+                return computed
+
+            points, existing = self._missing(connection, measures)
+            hand_ids = np.unique(points[:, 0].astype(np.int64))
+            missing = np.column_stack([~np.isin(hand_ids, existing[measure.name]) for measure in measures]
+                                      ).reshape(len(hand_ids), len(measures))
+
+            # Only measures without some value (e.g. new version) are computed, over hands without value only
+            values = np.full((len(hand_ids), len(measures)), np.nan)
+            for nb_landmarks in set(measure.nb_landmarks for measure, lacking in zip(measures, missing.any(axis=0))
+                                    if lacking):
+                ids, landmarks = group_landmarks(points, nb_landmarks)
+                rows = np.searchsorted(hand_ids, ids)
+                for j, measure in enumerate(measures):
+                    if measure.nb_landmarks != nb_landmarks:
+                        continue
+                    lacking = np.flatnonzero(missing[rows, j])
+                    for start in range(0, len(lacking), self.chunk_size):
+                        chunk = lacking[start:start + self.chunk_size]
+                        values[rows[chunk], j] = compute_measures(landmarks[chunk], [measure])[:, 0]
+            for start in range(0, len(hand_ids), self.chunk_size):
+                stop = start + self.chunk_size
+                rows = [dict(name=measure.name, hand_id=int(hand_id), version=measure.version,
+                             value=float(value) if np.isfinite(value) else None)
+                        for hand_id, hand_values, hand_missing in zip(hand_ids[start:stop], values[start:stop],
+                                                                      missing[start:stop])
+                        for measure, value, is_missing in zip(measures, hand_values, hand_missing) if is_missing]
+                if rows:
+                    connection.execute(insert(HandMeasure), rows)
+
+        for measure, count in zip(measures, missing.sum(axis=0).tolist()):
+            computed[measure.name] = count
+
+        return computed
+
+    def table(self, names=None, hand_ids=None):
+        """ Wide table of values of measures, computed first when missing
+
+        :param names: names of measures (None = all registered measures)
+        :param hand_ids: ids of hands (None = all hands with landmarks)
+        :return: MeasureTable of hand ids (N,), measure names and (N, M) array of values (NaN if null)
+        """
+        measures = get_measures(names, self.registry)
+        self.update([measure.name for measure in measures])
+
+        with self.engine.connect() as connection:
+            columns = []
+            for measure in measures:
+                column = read_chunks(connection, select(HandMeasure.hand_id, HandMeasure.value).where(
+                    HandMeasure.name == measure.name).order_by(HandMeasure.hand_id), np.dtype(np.float64),
+                    self.chunk_size)
+                columns.append(column)
+
+        ids = np.unique(np.concatenate([column[:, 0] for column in columns])).astype(np.int64) if columns else \
+            np.empty(0, dtype=np.int64)
+        if hand_ids is not None:
+            ids = ids[np.isin(ids, np.asarray(hand_ids, dtype=np.int64))]
+        values = np.full((len(ids), len(measures)), np.nan)
+        for j, column in enumerate(columns):
+            column = column[np.isin(column[:, 0], ids)]
+            values[np.searchsorted(ids, column[:, 0].astype(np.int64)), j] = column[:, 1]
+
+        return MeasureTable(ids, [measure.name for measure in measures], values)
+
+    def values(self, name, hand_ids=None):
+        """ Values of one measure, computed first when missing
+
+        :param name: name of measure
+        :param hand_ids: ids of hands (None = all hands with landmarks)
+        :return: (hand ids, values) arrays
+        """
+        table = self.table([name], hand_ids)
+
+        return table.hand_ids, table.values[:, 0]
+
+
+def _polygon_area(landmarks):
+    x, y = landmarks[..., 0], landmarks[..., 1]
+    return np.abs((x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y).sum(axis=1)) / 2
+
+
+@register("left", description="Handedness (1 for left hands, 0 for right hands)")
+def left_measure(landmarks):
+    return is_left_handed(check_landmarks(landmarks)).astype(float)
+
+
+def _digit_measure(index):
+    def digit(landmarks):
+        return compute_features(landmarks).digits[:, index]
+
+    return digit
+
+
+for _index in range(5):
+    register("D%d" % (_index + 1), description="Height of finger D%d" % (_index + 1))(_digit_measure(_index))
+
+
+@register("manning")
+def manning_measure(landmarks):
+    """ Manning index (ratio of D2 to D4 finger heights)
+
+    """
+    return compute_features(landmarks).manning
+
+
+@register("area")
+def area_measure(landmarks):
+    """ Area of hand outline polygon (square pixels)
+
+    """
+    return _polygon_area(landmarks)
+
+
+@register("perimeter")
+def perimeter_measure(landmarks):
+    """ Perimeter of hand outline polygon (pixels)
+
+    """
+    return distance(landmarks, np.roll(landmarks, -1, axis=1)).sum(axis=1)
@@ -6,16 +6,36 @@ More detailed description.
 """
 import warnings
 
-from kalimain import SESSION, ENGINE
-from kalimain.database import HPoint, Hand, Image, Cave, Base, Project
-from kalimain.exceptions import DuplicateElementWarning, DeleteWarning
-from kalimain.observer import Observable
+from sqlalchemy.orm import selectinload, sessionmaker
+
+import kalimain
+from kalimain import summary
+from kalimain.analytics import Analytics
+from kalimain.clustering import ClusterStore
+from kalimain.database import HPoint, Hand, Image, Cave, Project
+from kalimain.exceptions import DuplicateElementWarning, DeleteWarning, NearDuplicateWarning, ApiConnectionWarning
+from kalimain.geo import GeoIndex
+from kalimain.geocoding import GeocodingQueue
+from kalimain.importer import import_caves
+from kalimain.ingest import ImageIngest
+from kalimain.imaging import HammingIndex
+from kalimain.observer import Observable, Observer
+from kalimain.readmodel import hand_view, image_view, cave_view, project_view, SimilarHandView
+from kalimain.similarity import SimilarityIndex, hand_profile, DIGITS
+from kalimain.unit_of_work import UnitOfWork
 
 
 class Model:
 
     current_object = None
     db_class = None
+    unit_of_work = None
+
+    # Function returning detached read model of db_class instances (see kalimain.readmodel)
+    read_model = None
+
+    # Loader options of set_object, so that observers do not lazy load relationships one row at a time
+    loader_options = ()
 
     add_object_notifier = None
     delete_object_notifier = None
@@ -40,24 +60,44 @@ class Model:
     class SetNotifier(Notifier):
         pass
 
-    def __init__(self, session=None):
+    @property
+    def session(self):
+        """ Session of current unit of work
+
+        """
+        return self.unit_of_work.session
+
+    def __init__(self, unit_of_work=None):
         self.set_notifiers()
-        if session:
-            self.session = session
+        if unit_of_work:
+            self.unit_of_work = unit_of_work
 
     def add_object(self, obj):
-        self.session.add(obj)
-        self.session.commit()
-        self.add_object_notifier.notify_observers(obj)
+        """ Store object and notify observers with its read model
+
+        :param obj: db_class instance
+        :return: read model of object
+        """
+        with self.unit_of_work:
+            self.session.add(obj)
+            self.session.flush()
+            view = self.read_model(obj)
+            self.unit_of_work.after_commit(self.add_object_notifier.notify_observers, view)
+
+        return view
 
     def delete_object(self, obj_id):
-        obj = self.session.query(self.db_class).get(obj_id)
-        self.session.delete(obj)  # Delete object from SQL session
-        self.delete_object_notifier.notify_observers(obj_id)
+        with self.unit_of_work:
+            obj = self.session.query(self.db_class).get(obj_id)
+            self.session.delete(obj)  # Delete object from SQL session
+            self.unit_of_work.after_commit(self.delete_object_notifier.notify_observers, obj_id)
 
     def set_object(self, obj_id):
-        self.current_object = self.session.query(self.db_class).get(obj_id)
-        self.set_object_notifier.notify_observers(self.current_object)
+        with self.unit_of_work:
+            obj = self.session.query(self.db_class).options(*self.loader_options).filter(
+                self.db_class.id == obj_id).one_or_none()
+            self.current_object = self.read_model(obj) if obj is not None else None
+            self.unit_of_work.after_commit(self.set_object_notifier.notify_observers, self.current_object)
 
     def set_notifiers(self):
         self.add_object_notifier = self.__class__.AddNotifier(self)
@@ -103,47 +143,151 @@ class PointModel(Model):
 class HandModel(Model):
 
     db_class = Hand
+    read_model = staticmethod(hand_view)
 
     hand_info_notifier = None
+    image_hands_notifier = None
+
+    # Number of similar hands given with hand info
+    nb_similar_hands = 10
+
+    _similarity_index = None
 
     class HandInfoNotifier(Model.Notifier):
 
         def notify_observers(self, hand_id=None):
-            hand = self.outer.session.query(Hand).get(hand_id)
-            super().notify_observers(hand.get_info())
+            with self.outer.unit_of_work:
+                info = self.outer.session.query(Hand).get(hand_id).get_info()
+            info["similar"] = self.outer.similar_hands(hand_id, self.outer.nb_similar_hands)
+            super().notify_observers(info)
+
+    class ImageHandsNotifier(Model.Notifier):
+        """ Notify id of image whose hands were added or deleted
+
+        """
+        pass
+
+    class ResetSimilarityObserver(Observer):
+
+        def __init__(self, outer):
+            self.outer = outer
+
+        def update(self, observable, arg):
+            self.outer.reset_similarity_index()
 
-    def __init__(self, session, image_model, point_model):
-        super().__init__(session)
+    @property
+    def similarity_index(self):
+        """ Nearest neighbour index of hand profiles (built on first use)
+
+        :return:
+        """
+        if self._similarity_index is None:
+            self._similarity_index = SimilarityIndex()
+            with self.unit_of_work:
+                self._similarity_index.load(self.session.connection())
+        return self._similarity_index
+
+    def __init__(self, unit_of_work, image_model, point_model):
+        super().__init__(unit_of_work)
         self.image_model = image_model
         self.point_model = point_model
+        image_model.delete_object_notifier.add_observer(HandModel.ResetSimilarityObserver(self))
 
     def add_hand(self):
-        hand = Hand(self.point_model.current_set_of_points)
-        self.image_model.current_object.hands.append(hand)
-        self.add_object(hand)
+        hand = Hand(self.point_model.current_set_of_points, image_id=self.image_model.current_object.id)
+        with self.unit_of_work:
+            view = self.add_object(hand)
+            if self._similarity_index is not None and all(getattr(hand, digit) is not None for digit in DIGITS):
+                self.unit_of_work.after_commit(self._similarity_index.add, view.id,
+                                               hand_profile(hand, self._similarity_index.handedness_weight))
+            self.unit_of_work.after_commit(self.image_hands_notifier.notify_observers, view.image_id)
         self.point_model.clear()
 
     def delete_object(self, hand_id):
-        super().delete_object(hand_id)
+        with self.unit_of_work:
+            image_id = self.session.query(Hand.image_id).filter(Hand.id == hand_id).scalar()
+            super().delete_object(hand_id)
+            if self._similarity_index is not None:
+                self.unit_of_work.after_commit(self._similarity_index.remove, hand_id)
+            self.unit_of_work.after_commit(self.image_hands_notifier.notify_observers, image_id)
 
     def get_hand_info(self, hand_id):
         self.hand_info_notifier.notify_observers(hand_id)
 
+    def reset_similarity_index(self):
+        self._similarity_index = None  # Rebuilt on next use
+
     def set_notifiers(self):
         self.hand_info_notifier = HandModel.HandInfoNotifier(self)
+        self.image_hands_notifier = HandModel.ImageHandsNotifier(self)
         super().set_notifiers()
 
+    def similar_hands(self, hand_id, k=10):
+        """ k hands (of all projects) whose finger length profiles are most similar to hand
+
+        :param hand_id:
+        :param k: number of hands
+        :return: list of SimilarHandView sorted by distance (empty if hand has no profile)
+        """
+        try:
+            neighbours = self.similarity_index.similar(hand_id, k)
+        except KeyError:
+            return []
+
+        distances = {neighbour_id: distance for distance, neighbour_id in neighbours}
+        with self.unit_of_work:
+            rows = self.session.query(Hand.id, Image.id, Image.name, Cave.name, Project.name).join(
+                Image, Hand.image_id == Image.id).outerjoin(Cave, Image.cave_id == Cave.id).outerjoin(
+                Project, Cave.project_id == Project.id).filter(Hand.id.in_(distances)).all()
+
+        return sorted((SimilarHandView(row[0], distances[row[0]], *row[1:]) for row in rows),
+                      key=lambda view: view.distance)
+
+    def update_features(self, project_id=None):
+        """ Recompute features of all hands in one batch
+
+        :param project_id: if not None, only recompute hands of that project
+        :return:
+        """
+        with self.unit_of_work:
+            query = self.session.query(Hand).options(selectinload(Hand.hpoints))
+            if project_id is not None:
+                query = query.join(Image).join(Cave).filter(Cave.project_id == project_id)
+            Hand.update_features(query.all())
+        self.reset_similarity_index()
+
 
 class ImageModel(Model):
 
     db_class = Image
+    read_model = staticmethod(image_view)
+    loader_options = (selectinload(Image.hands).selectinload(Hand.hpoints),)
+
+    # Maximum hamming distance between perceptual hashes of near-duplicate images
+    near_duplicate_radius = 10
+
+    _phash_index = None
 
     @property
     def images(self):
-        return self.session.query(Image).all()
+        with self.unit_of_work:
+            return [image_view(image, hands=False) for image in self.session.query(Image)]
+
+    @property
+    def phash_index(self):
+        """ Hamming index of image ids by perceptual hash (built on first use)
 
-    def __init__(self, session, cave_model):
-        super().__init__(session)
+        :return:
+        """
+        if self._phash_index is None:
+            self._phash_index = HammingIndex()
+            with self.unit_of_work:
+                for image_id, phash in self.session.query(Image.id, Image.phash).filter(Image.phash.isnot(None)):
+                    self._phash_index.add(int(phash, 16), image_id)
+        return self._phash_index
+
+    def __init__(self, unit_of_work, cave_model):
+        super().__init__(unit_of_work)
         self.cave_model = cave_model
 
     def add_image(self, filename, name=None, description=None):
@@ -154,13 +298,79 @@ class ImageModel(Model):
         :param description:
         :return:
         """
-        image = Image(filename, name=name, description=description)
+        image = Image(filename, name=name, description=description, cave_id=self.cave_model.current_object.id)
 
-        if image not in self.images:
-            self.cave_model.current_object.images.append(image)
+        with self.unit_of_work:
+            if self.session.query(Image.id).filter_by(digest=image.digest).first():
+                warnings.warn("Image already in dataset.", DuplicateElementWarning)
+                return
+            near_duplicates = self.near_duplicates(image)
             self.add_object(image)
-        else:
-            warnings.warn("Image already in dataset.", DuplicateElementWarning)
+            self.unit_of_work.after_commit(self._index_image, image.id, image.perceptual_hash)
+            # Name is optional: fall back to path, then id
+            names = [name or path or "image %d" % image_id for image_id, name, path in self.session.query(
+                Image.id, Image.name, Image.path).filter(Image.id.in_(near_duplicates))]
+
+        if names:
+            warnings.warn("Image looks like: %s" % ", ".join(names), NearDuplicateWarning)
+
+    def after_ingest(self, cave_id):
+        """ Reload images after ingest of a folder into cave
+
+        :param cave_id:
+        :return:
+        """
+        self._phash_index = None  # Rebuilt on next use
+        self.cave_model.set_object(cave_id)
+
+    def delete_object(self, image_id):
+        with self.unit_of_work:
+            super().delete_object(image_id)
+            self.unit_of_work.after_commit(self._unindex_image, image_id)
+
+    def _index_image(self, image_id, perceptual_hash):
+        # Index not built yet is loaded from committed images on first use
+        if self._phash_index is not None:
+            self._phash_index.add(perceptual_hash, image_id)
+
+    def _unindex_image(self, image_id):
+        if self._phash_index is not None and image_id in self._phash_index.keys:
+            self._phash_index.remove(image_id)
+
+    def ingest_directory(self, directory, ingest=None):
+        """ Add all images of folder tree to current cave
+
+        :param directory: path to root folder
+        :param ingest: ImageIngest instance (see new_ingest)
+        :return: IngestReport
+        """
+        cave_id = self.cave_model.current_object.id
+        if ingest is None:
+            ingest = self.new_ingest()
+        report = ingest.run(directory, cave_id)
+        self.after_ingest(cave_id)
+
+        return report
+
+    def new_ingest(self, **kwargs):
+        """ Return folder ingest job using the same database
+
+        :param kwargs: keyword arguments of ImageIngest
+        :return:
+        """
+        return ImageIngest(self.unit_of_work.session_factory, **kwargs)
+
+    def near_duplicates(self, image, radius=None):
+        """ Return ids of images looking like image, closest first
+
+        :param image: Image instance
+        :param radius: maximum hamming distance between perceptual hashes
+        :return:
+        """
+        if radius is None:
+            radius = self.near_duplicate_radius
+        return [image_id for _, image_id in self.phash_index.search(image.perceptual_hash, radius)
+                if image_id != image.id]
 
 
 class CaveModel(Model):
@@ -168,31 +378,155 @@ class CaveModel(Model):
 
     """
     db_class = Cave
+    read_model = staticmethod(cave_view)
+    loader_options = (selectinload(Cave.images),)
+
+    # Distance (km) under which two caves are considered the same
+    duplicate_tolerance = 0.05
+
+    _cave_index = None
 
     @property
     def caves(self):
-        return self.session.query(Cave).all()
+        with self.unit_of_work:
+            return [cave_view(cave, images=False) for cave in self.session.query(Cave)]
+
+    @property
+    def cave_index(self):
+        """ Spatial index of cave ids by location (built on first use)
 
-    def __init__(self, session, project_model):
-        super().__init__(session)
+        :return:
+        """
+        if self._cave_index is None:
+            self._cave_index = GeoIndex()
+            with self.unit_of_work:
+                for cave_id, latitude, longitude in self.session.query(Cave.id, Cave.latitude, Cave.longitude):
+                    self._cave_index.add(cave_id, latitude, longitude)
+        return self._cave_index
+
+    def __init__(self, unit_of_work, project_model, geocoding_queue=None):
+        """
+
+        :param unit_of_work: UnitOfWork instance
+        :param project_model:
+        :param geocoding_queue: GeocodingQueue instance (default uses kalimain.geocoding.default_geocoder)
+        """
+        super().__init__(unit_of_work)
         self.project_model = project_model
+        self.geocoding_queue = geocoding_queue if geocoding_queue is not None else GeocodingQueue()
 
     def add_cave(self, latitude, longitude, name=None, description=None):
-        cave = Cave(latitude=latitude, longitude=longitude, name=name, description=description)
-        if cave not in self.caves:
-            self.project_model.current_object.caves.append(cave)
-            self.add_object(cave)
+        if not self.duplicates(latitude, longitude):
+            cave = Cave(latitude=latitude, longitude=longitude, name=name, description=description,
+                        project_id=self.project_model.current_object.id)
+            with self.unit_of_work:
+                self.add_object(cave)
+                self.unit_of_work.after_commit(self._index_cave, cave.id, cave.latitude, cave.longitude)
+                self.geocoding_queue.submit(self.session, cave)
         else:
             warnings.warn("Cave already in dataset.", DuplicateElementWarning)
 
+    def backfill_secondary_attributes(self):
+        """ Submit caves without secondary attributes to geocoding queue
+
+        :return:
+        """
+        with self.unit_of_work:
+            self.geocoding_queue.backfill(self.session)
+
+    def reset_cave_index(self):
+        self._cave_index = None  # Rebuilt on next use (e.g. after caves were imported elsewhere)
+
+    def caves_within(self, latitude, longitude, radius):
+        """ Return caves within radius of location, closest first
+
+        :param latitude:
+        :param longitude:
+        :param radius: radius in km
+        :return: list of (distance in km, CaveView)
+        """
+        return self._get_caves(self.cave_index.within(latitude, longitude, radius))
+
     def delete_object(self, cave_id):
-        cave = self.session.query(Cave).get(cave_id)
-        if not cave.images:
-            self.session.delete(cave)
-            self.delete_object_notifier.notify_observers(cave_id)
-        else:
+        with self.unit_of_work:
+            cave = self.session.query(Cave).get(cave_id)
+            has_images = bool(cave.images)
+            if not has_images:
+                self.session.delete(cave)
+                self.unit_of_work.after_commit(self._unindex_cave, cave_id)
+                self.unit_of_work.after_commit(self.delete_object_notifier.notify_observers, cave_id)
+
+        if has_images:
             warnings.warn("Cannot delete cave with still related images", DeleteWarning)
 
+    def duplicates(self, latitude, longitude, tolerance=None):
+        """ Return ids of caves within tolerance of location
+
+        :param latitude:
+        :param longitude:
+        :param tolerance: distance in km (default to duplicate_tolerance)
+        :return:
+        """
+        if tolerance is None:
+            tolerance = self.duplicate_tolerance
+        return [cave_id for _, cave_id in self.cave_index.within(latitude, longitude, tolerance)]
+
+    def poll_geocoding(self):
+        """ Set secondary attributes of caves from available geocoding results
+
+        :return: list of updated cave ids
+        """
+        with self.unit_of_work:
+            updated, errors = self.geocoding_queue.poll(self.session)
+        if errors:
+            warnings.warn("Unable to reach geocoding service: secondary attributes of %d location(s) will be "
+                          "retrieved later" % len(errors), ApiConnectionWarning)
+        return updated
+
+    def import_caves(self, filename):
+        """ Import caves from CSV, GPX or KML file into current project
+
+        :param filename:
+        :return: CaveImportReport
+        """
+        with self.unit_of_work:
+            report = import_caves(self.session, self.project_model.current_object, filename, self.duplicate_tolerance,
+                                  self.geocoding_queue.geocoder, precision=self.geocoding_queue.precision)
+            report = report._replace(caves=[cave_view(cave, images=False) for cave in report.caves])
+            for cave in report.caves:
+                self.unit_of_work.after_commit(self._index_cave, cave.id, cave.latitude, cave.longitude)
+                self.unit_of_work.after_commit(self.add_object_notifier.notify_observers, cave)
+
+        # Caves not geocoded at import (rate limited geocoder) are left to the queue
+        self.backfill_secondary_attributes()
+
+        return report
+
+    def _index_cave(self, cave_id, latitude, longitude):
+        # Index not built yet is loaded from committed caves on first use
+        if self._cave_index is not None:
+            self._cave_index.add(cave_id, latitude, longitude)
+
+    def _unindex_cave(self, cave_id):
+        if self._cave_index is not None and cave_id in self._cave_index.locations:
+            self._cave_index.remove(cave_id)
+
+    def nearest_caves(self, latitude, longitude, k=1):
+        """ Return k nearest caves of location, closest first
+
+        :param latitude:
+        :param longitude:
+        :param k:
+        :return: list of (distance in km, CaveView)
+        """
+        return self._get_caves(self.cave_index.nearest(latitude, longitude, k))
+
+    def _get_caves(self, result):
+        with self.unit_of_work:
+            caves = {cave.id: cave_view(cave, images=False) for cave in self.session.query(Cave).filter(
+                Cave.id.in_([i for _, i in result]))}
+        return [(distance, caves[cave_id]) for distance, cave_id in result]
+
 
 class ProjectModel(Model):
     """ Project's corresponding model
@@ -200,50 +534,209 @@ class ProjectModel(Model):
     """
     current_project = None
     db_class = Project
+    read_model = staticmethod(project_view)
+    loader_options = (selectinload(Project.caves),)
 
-    def __init__(self, session, kmodel):
+    def __init__(self, unit_of_work, kmodel):
         """
 
-        :param session:
+        :param unit_of_work: UnitOfWork instance
         :param kmodel: Main model
         """
-        super().__init__(session)
+        super().__init__(unit_of_work)
         self.kmodel = kmodel
 
     @property
     def projects(self):
-        return self.session.query(Project).all()
+        with self.unit_of_work:
+            return [project_view(project, caves=False) for project in self.session.query(Project)]
 
     def add_project(self, name, description=None):
-        project = Project(name=name, description=description)
-        if project not in self.projects:
-            self.current_project = project
-            self.add_object(project)
+        with self.unit_of_work:
+            exists = self.session.query(Project.id).filter_by(name=name).first() is not None
+        if not exists:
+            self.current_project = self.add_object(Project(name=name, description=description))
         else:
             warnings.warn("Project with that name already exists", DuplicateElementWarning)
 
 
+class AnalyticsModel(Model):
+    """ Summaries and distributions of hands per group (Display tab)
+
+    Results are cached by kalimain.analytics.Analytics and only recomputed
+    for groups whose hands changed
+    """
+    variable = "manning"
+    by = None
+
+    statistics_notifier = None
+
+    class StatisticsNotifier(Model.Notifier):
+        pass
+
+    class InvalidateImageObserver(Observer):
+
+        def __init__(self, outer):
+            self.outer = outer
+
+        def update(self, observable, image_id):
+            self.outer.analytics.invalidate_image(image_id)
+
+    class InvalidateAllObserver(Observer):
+
+        def __init__(self, outer):
+            self.outer = outer
+
+        def update(self, observable, arg):
+            self.outer.analytics.invalidate()
+
+    def __init__(self, unit_of_work, engine, hand_model, image_model):
+        """
+
+        :param unit_of_work: UnitOfWork instance
+        :param engine: SQLAlchemy engine
+        :param hand_model: HandModel instance (hands of images are added or deleted)
+        :param image_model: ImageModel instance (images and their hands are deleted)
+        """
+        super().__init__(unit_of_work)
+        self.analytics = Analytics(engine)
+        hand_model.image_hands_notifier.add_observer(AnalyticsModel.InvalidateImageObserver(self))
+        image_model.delete_object_notifier.add_observer(AnalyticsModel.InvalidateAllObserver(self))
+
+    def compute(self, variable=None, by=None):
+        """ Notify summaries and distributions of variable per group
+
+        :param variable: Manning index or finger length (default: last variable)
+        :param by: None (all hands), "project", "cave", "country" or "continent"
+        :return:
+        """
+        if variable is not None:
+            self.variable = variable
+        self.by = by
+        self.statistics_notifier.notify_observers(self.analytics.statistics(self.variable, self.by))
+
+    def set_notifiers(self):
+        self.statistics_notifier = AnalyticsModel.StatisticsNotifier(self)
+
+
+class ClusteringModel(Model):
+    """ Clusters of hands (Display tab)
+
+    Clusters are stored: hands added since last use are assigned to clusters
+    (updating k-means centers) on next use, instead of clustering all hands
+    again
+    """
+    histogram_notifier = None
+
+    class HistogramNotifier(Model.Notifier):
+        pass
+
+    class InvalidateObserver(Observer):
+
+        def __init__(self, outer):
+            self.outer = outer
+
+        def update(self, observable, arg):
+            self.outer.invalidate()
+
+    def __init__(self, unit_of_work, engine, hand_model, image_model):
+        """
+
+        :param unit_of_work: UnitOfWork instance
+        :param engine: SQLAlchemy engine
+        :param hand_model: HandModel instance (hands of images are added or deleted)
+        :param image_model: ImageModel instance (images and their hands are deleted)
+        """
+        super().__init__(unit_of_work)
+        self.clusters = ClusterStore(engine)
+
+        # Feature sets whose clusters are up to date, and number of invalidations (clusters may be updated in a
+        # background thread while hands are added)
+        self._updated = set()
+        self._generation = 0
+
+        hand_model.image_hands_notifier.add_observer(ClusteringModel.InvalidateObserver(self))
+        image_model.delete_object_notifier.add_observer(ClusteringModel.InvalidateObserver(self))
+
+    def compute_histogram(self, features, variable, bin_edges, by=None, group=None):
+        """ Notify histogram of variable per cluster, for hands of group
+
+        :param features: "profile", "shape" or "both"
+        :param variable: Manning index or finger length
+        :param bin_edges: bin edges of histogram
+        :param by: None (all hands), "project", "cave", "country" or "continent"
+        :param group: key of group
+        :return:
+        """
+        if features not in self._updated:
+            self.update(features)
+        self.histogram_notifier.notify_observers(self.clusters.histogram(features, variable, bin_edges, by, group))
+
+    def invalidate(self):
+        """ Hands were added or deleted: update clusters on next use
+
+        :return:
+        """
+        self._generation += 1
+        self._updated.clear()
+        self.clusters.invalidate()
+
+    def is_updated(self, features):
+        """ Whether clusters of feature set are up to date (compute_histogram is then fast)
+
+        :param features: "profile", "shape" or "both"
+        :return:
+        """
+        return features in self._updated
+
+    def update(self, features):
+        """ Assign hands added since last use to clusters
+
+        First use fits k-means on all hands, which is slow: may run in a
+        background thread (no observer is notified)
+        :param features: "profile", "shape" or "both"
+        :return: number of assigned hands
+        """
+        generation = self._generation
+        nb_hands = self.clusters.update(features)
+        if generation == self._generation:
+            self._updated.add(features)
+
+        return nb_hands
+
+    def set_notifiers(self):
+        self.histogram_notifier = ClusteringModel.HistogramNotifier(self)
+
+
 class KModel(Model):
     """ Main API model
 
     """
 
-    def __init__(self):
+    def __init__(self, engine=None, reset=False, expire_on_commit=False):
+        """
+
+        :param engine: SQLAlchemy engine (default: kalimain.ENGINE)
+        :param reset: if True, drop all tables first (all data are lost)
+        :param expire_on_commit: expire instances on commit (see kalimain.unit_of_work.UnitOfWork)
+        """
         super().__init__()
+        self.engine = engine if engine is not None else kalimain.ENGINE
 
         # Create all tables if necessary
-        Base.metadata.drop_all(ENGINE)  # TODO: Remove this line when deploying (Development version)
-        Base.metadata.create_all(ENGINE)
+        summary.create_tables(self.engine, reset)
 
-        # Initialize database session
-        self.session = SESSION()
+        # One short-lived session per user operation
+        self.unit_of_work = UnitOfWork(sessionmaker(self.engine), expire_on_commit)
 
         # Initialize sub models
-        self.point_model = PointModel(self.session)
-        self.project_model = ProjectModel(self.session, self)
-        self.cave_model = CaveModel(self.session, self.project_model)
-        self.image_model = ImageModel(self.session, self.cave_model)
-        self.hand_model = HandModel(self.session, self.image_model, self.point_model)
+        self.point_model = PointModel(self.unit_of_work)
+        self.project_model = ProjectModel(self.unit_of_work, self)
+        self.cave_model = CaveModel(self.unit_of_work, self.project_model)
+        self.image_model = ImageModel(self.unit_of_work, self.cave_model)
+        self.hand_model = HandModel(self.unit_of_work, self.image_model, self.point_model)
+        self.analytics_model = AnalyticsModel(self.unit_of_work, self.engine, self.hand_model, self.image_model)
+        self.clustering_model = ClusteringModel(self.unit_of_work, self.engine, self.hand_model, self.image_model)
 
     def set_notifiers(self):
         pass
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+""" Pigment colour measures of hand stencils
+
+The outline of a hand (its 12 landmarks, in image pixels) is rasterised into
+a mask of the hand bounding box, together with a ring of given width around
+the outline. Pixels are converted to CIE Lab, and the mean and percentiles
+of each channel are computed inside the hand and in the ring around it, with
+the colour difference (CIE76 delta E) between both means.
+
+Hands are measured image by image, so that each image is decoded once (see
+kalimain.jobs.PigmentStatisticsJob).
+"""
+import numpy as np
+from PIL import Image as PilImage, ImageDraw
+
+from kalimain.database import PIGMENT_MEASURES
+from kalimain.imaging import UNREADABLE_IMAGE_ERRORS
+
+CHANNELS = ("L", "a", "b")
+REGIONS = ("inside", "around")
+PERCENTILES = (10, 50, 90)
+
+# Width of ring around hand outline, relative to the largest side of the hand bounding box
+MARGIN = 0.1
+
+# sRGB (D65) to CIE XYZ matrix and D65 white point
+_RGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041]])
+_WHITE = np.array([0.95047, 1.0, 1.08883])
+
+
+def rgb_to_lab(rgb):
+    """ Convert sRGB pixels to CIE Lab (D65)
+
+    :param rgb: array of shape (..., 3) with values in [0, 255]
+    :return: float array of shape (..., 3)
+    """
+    rgb = np.asarray(rgb, dtype=np.float64) / 255
+    linear = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = linear @ _RGB_TO_XYZ.T / _WHITE
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+
+    return np.stack((116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])), axis=-1)
+
+
+def outline_masks(points, size, ring_width):
+    """ Masks of polygon and of ring around its outline
+
+    :param points: (M, 2) array of polygon vertices, relative to mask origin
+    :param size: (width, height) of masks
+    :param ring_width: width of ring in pixels
+    :return: (inside, ring) boolean arrays of shape (height, width)
+    """
+    vertices = [tuple(point) for point in np.asarray(points, dtype=float).tolist()]
+    inside = PilImage.new("1", size, 0)
+    ImageDraw.Draw(inside).polygon(vertices, fill=1)
+    outline = PilImage.new("1", size, 0)
+    ImageDraw.Draw(outline).line(vertices + vertices[:1], fill=1, width=2 * ring_width + 1, joint="curve")
+    inside, outline = np.asarray(inside, dtype=bool), np.asarray(outline, dtype=bool)
+
+    return inside, outline & ~inside
+
+
+def region_statistics(lab, mask):
+    """ Mean and percentiles of every Lab channel within mask
+
+    :param lab: (H, W, 3) array
+    :param mask: (H, W) boolean array
+    :return: (3, 1 + len(PERCENTILES)) array (NaN if mask is empty)
+    """
+    pixels = lab[mask]
+    if len(pixels) == 0:
+        return np.full((len(CHANNELS), 1 + len(PERCENTILES)), np.nan)
+
+    return np.column_stack((pixels.mean(axis=0), np.percentile(pixels, PERCENTILES, axis=0).T))
+
+
+def measure_hands(image, hand_ids, polygons, margin=MARGIN):
+    """ Pigment colour measures of hands of image
+
+    :param image: RGB PIL image
+    :param hand_ids: sequence of hand ids
+    :param polygons: (N, 12, 2) array of landmarks in image pixels
+    :param margin: width of ring around outline, relative to the largest side of the hand bounding box
+    :return: list of dict ready for bulk insert of HandPigment
+    """
+    rows = []
+    for hand_id, polygon in zip(hand_ids, np.asarray(polygons, dtype=float)):
+        low, high = polygon.min(axis=0), polygon.max(axis=0)
+        ring_width = max(int(round(margin * (high - low).max())), 1)
+        left, top = np.maximum(np.floor(low).astype(int) - ring_width, 0)
+        right, bottom = np.minimum(np.ceil(high).astype(int) + ring_width + 1, image.size)
+        if right <= left or bottom <= top:
+            continue
+
+        inside, ring = outline_masks(polygon - (left, top), (right - left, bottom - top), ring_width)
+        lab = rgb_to_lab(np.asarray(image.crop((left, top, right, bottom))))
+        statistics = np.stack([region_statistics(lab, mask) for mask in (inside, ring)])
+
+        row = dict(zip(PIGMENT_MEASURES, (None if np.isnan(value) else float(value) for value in statistics.ravel())))
+        delta_e = np.sqrt(((statistics[0, :, 0] - statistics[1, :, 0]) ** 2).sum())
+        row.update(hand_id=int(hand_id), area=int(inside.sum()), ring_area=int(ring.sum()),
+                   delta_e=None if np.isnan(delta_e) else float(delta_e))
+        rows.append(row)
+
+    return rows
+
+
+def measure_image(path, hand_ids, polygons, margin=MARGIN):
+    """ Decode image file once and measure pigment colour of its hands
+
+    Run in worker processes
+    :param path: path to image file
+    :return: list of dict (see measure_hands), None if file is missing, corrupt, truncated or too large
+    """
+    if path is None:
+        return None
+
+    try:
+        with PilImage.open(path) as image:
+            image = image.convert("RGB")
+    except UNREADABLE_IMAGE_ERRORS:
+        return None
+
+    return measure_hands(image, hand_ids, polygons, margin)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+""" Detached read model
+
+Immutable copies of database objects handed over to the view. They keep the
+attribute names of the mapped classes the view relies on, but hold no
+session state, so that they can outlive the unit of work which loaded them
+(see kalimain.unit_of_work) and never trigger lazy loads.
+"""
+from collections import namedtuple
+
+PointView = namedtuple("PointView", ["id", "x", "y"])
+HandView = namedtuple("HandView", ["id", "image_id", "hpoints"])
+ImageView = namedtuple("ImageView", ["id", "name", "description", "path", "width", "height", "cave_id", "hands"])
+CaveView = namedtuple("CaveView", ["id", "name", "description", "latitude", "longitude", "country", "continent",
+                                   "address", "project_id", "images"])
+ProjectView = namedtuple("ProjectView", ["id", "name", "description", "caves"])
+SimilarHandView = namedtuple("SimilarHandView", ["id", "distance", "image_id", "image", "cave", "project"])
+
+
+def hand_view(hand):
+    """ Read model of hand with its points
+
+    :param hand: Hand instance
+    :return: HandView
+    """
+    return HandView(hand.id, hand.image_id, tuple(PointView(point.id, point.x, point.y) for point in hand.hpoints))
+
+
+def image_view(image, hands=True):
+    """ Read model of image
+
+    :param image: Image instance
+    :param hands: if True, copy hands and their points (None otherwise)
+    :return: ImageView
+    """
+    return ImageView(image.id, image.name, image.description, image.path, image.width, image.height, image.cave_id,
+                     tuple(hand_view(hand) for hand in image.hands) if hands else None)
+
+
+def cave_view(cave, images=True):
+    """ Read model of cave
+
+    :param cave: Cave instance
+    :param images: if True, copy images without their hands (None otherwise)
+    :return: CaveView
+    """
+    return CaveView(cave.id, cave.name, cave.description, cave.latitude, cave.longitude, cave.country, cave.continent,
+                    cave.address, cave.project_id,
+                    tuple(image_view(image, hands=False) for image in cave.images) if images else None)
+
+
+def project_view(project, caves=True):
+    """ Read model of project
+
+    :param project: Project instance
+    :param caves: if True, copy caves without their images (None otherwise)
+    :return: ProjectView
+    """
+    return ProjectView(project.id, project.name, project.description,
+                       tuple(cave_view(cave, images=False) for cave in project.caves) if caves else None)
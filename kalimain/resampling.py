@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+""" Bootstrap and permutation tests between groups of hands
+
+Compare the Manning index or finger lengths of two groups of hands (caves,
+projects, countries or continents): bootstrap confidence interval of the
+difference of a statistic, and permutation test of that difference.
+
+Resamples are drawn by chunks of (resamples, hands) arrays processed at once
+by NumPy, whose size is given by a memory budget. Resamples are split into
+fixed size tasks, which can be spread across a process pool: every task has
+its own random stream spawned from the seed, so that results only depend on
+the seed, not on the number of processes.
+"""
+import math
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+STATISTICS = ("mean", "median", "std")
+ALTERNATIVES = ("two-sided", "greater", "less")
+
+# Memory used by a chunk of resamples (bytes) and number of resamples per task
+MEMORY_BUDGET = 64 * 2 ** 20
+TASK_SIZE = 1000
+
+Interval = namedtuple("Interval", ["estimate", "low", "high", "confidence"])
+Comparison = namedtuple("Comparison", ["variable", "by", "group_a", "group_b", "statistic", "count_a", "count_b",
+                                       "difference", "low", "high", "confidence", "p_value", "nb_resamples"])
+
+
+def _statistic(statistic):
+    """ Function computing statistic of every row of a 2D array
+
+    """
+    if statistic == "mean":
+        return lambda samples: samples.mean(axis=1)
+    elif statistic == "median":
+        return lambda samples: np.median(samples, axis=1)
+    elif statistic == "std":
+        return lambda samples: samples.std(axis=1)
+    else:
+        raise ValueError("Unknown statistic '%s' (valid statistics: %s)" % (statistic, ", ".join(STATISTICS)))
+
+
+def chunk_size(nb_values, memory_budget=MEMORY_BUDGET):
+    """ Number of resamples of nb_values values drawn at once within memory budget
+
+    A resampled value takes an index (int64) and a value (float64)
+    :param nb_values: number of values per resample
+    :param memory_budget: memory budget in bytes
+    :return:
+    """
+    return max(1, memory_budget // (16 * max(nb_values, 1)))
+
+
+def _bootstrap_task(a, b, statistic, nb_resamples, seed, memory_budget):
+    """ Bootstrap distribution of statistic(a) - statistic(b), or of statistic(a) if b is None
+
+    """
+    rng = np.random.default_rng(seed)
+    compute = _statistic(statistic)
+    result = np.empty(nb_resamples)
+    size = chunk_size(len(a) + (len(b) if b is not None else 0), memory_budget)
+    for start in range(0, nb_resamples, size):
+        stop = min(start + size, nb_resamples)
+        result[start:stop] = compute(a[rng.integers(0, len(a), (stop - start, len(a)))])
+        if b is not None:
+            result[start:stop] -= compute(b[rng.integers(0, len(b), (stop - start, len(b)))])
+
+    return result
+
+
+def _permutation_task(pooled, nb_a, statistic, nb_resamples, seed, memory_budget):
+    """ Distribution of statistic(a) - statistic(b) under random relabelling of pooled values
+
+    """
+    rng = np.random.default_rng(seed)
+    compute = _statistic(statistic)
+    result = np.empty(nb_resamples)
+    size = chunk_size(len(pooled), memory_budget)
+    for start in range(0, nb_resamples, size):
+        stop = min(start + size, nb_resamples)
+        samples = rng.permuted(np.broadcast_to(pooled, (stop - start, len(pooled))), axis=1)
+        result[start:stop] = compute(samples[:, :nb_a]) - compute(samples[:, nb_a:])
+
+    return result
+
+
+def _run(task, args, nb_resamples, seed, memory_budget, processes):
+    """ Run resampling task by blocks of TASK_SIZE resamples, optionally in a process pool
+
+    """
+    seeds = np.random.SeedSequence(seed).spawn(math.ceil(nb_resamples / TASK_SIZE))
+    sizes = [min(TASK_SIZE, nb_resamples - i * TASK_SIZE) for i in range(len(seeds))]
+    workers = processes if processes is not None else os.cpu_count()
+
+    if workers and len(seeds) > 1:
+        with ProcessPoolExecutor(min(workers, len(seeds))) as pool:
+            results = list(pool.map(task, *zip(*[args] * len(seeds)), sizes, seeds, [memory_budget] * len(seeds)))
+    else:
+        results = [task(*args, size, task_seed, memory_budget) for size, task_seed in zip(sizes, seeds)]
+
+    return np.concatenate(results)
+
+
+def _as_array(values):
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        raise ValueError("Cannot resample empty group")
+    return values
+
+
+def _interval(estimate, distribution, confidence):
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(distribution, [alpha, 1 - alpha])
+    return Interval(float(estimate), float(low), float(high), confidence)
+
+
+def bootstrap(values, statistic="mean", nb_resamples=10000, confidence=0.95, seed=None,
+              memory_budget=MEMORY_BUDGET, processes=0):
+    """ Bootstrap percentile confidence interval of statistic
+
+    :param values: 1D array (NaN are ignored)
+    :param statistic: "mean", "median" or "std"
+    :param nb_resamples: number of bootstrap resamples
+    :param confidence: confidence level of interval
+    :param seed: random seed (None = unpredictable)
+    :param memory_budget: memory used by a chunk of resamples (bytes)
+    :param processes: number of worker processes (None = number of CPUs, 0 = no process pool)
+    :return: Interval
+    """
+    values = _as_array(values)
+    distribution = _run(_bootstrap_task, (values, None, statistic), nb_resamples, seed, memory_budget, processes)
+
+    return _interval(_statistic(statistic)(values[np.newaxis, :])[0], distribution, confidence)
+
+
+def bootstrap_difference(a, b, statistic="mean", nb_resamples=10000, confidence=0.95, seed=None,
+                         memory_budget=MEMORY_BUDGET, processes=0):
+    """ Bootstrap percentile confidence interval of statistic(a) - statistic(b)
+
+    Groups are resampled independently
+    :param a: 1D array of first group (NaN are ignored)
+    :param b: 1D array of second group (NaN are ignored)
+    :return: Interval (see bootstrap for other parameters)
+    """
+    a, b = _as_array(a), _as_array(b)
+    compute = _statistic(statistic)
+    distribution = _run(_bootstrap_task, (a, b, statistic), nb_resamples, seed, memory_budget, processes)
+
+    return _interval(compute(a[np.newaxis, :])[0] - compute(b[np.newaxis, :])[0], distribution, confidence)
+
+
+def permutation_test(a, b, statistic="mean", nb_resamples=10000, alternative="two-sided", seed=None,
+                     memory_budget=MEMORY_BUDGET, processes=0):
+    """ Permutation test of the difference statistic(a) - statistic(b)
+
+    p-value is (r + 1) / (nb_resamples + 1), r being the number of
+    permutations whose difference is at least as extreme as the observed one
+    :param a: 1D array of first group (NaN are ignored)
+    :param b: 1D array of second group (NaN are ignored)
+    :param alternative: "two-sided", "greater" (a > b) or "less" (a < b)
+    :return: (observed difference, p-value) (see bootstrap for other parameters)
+    """
+    if alternative not in ALTERNATIVES:
+        raise ValueError("Unknown alternative '%s' (valid alternatives: %s)" % (alternative, ", ".join(ALTERNATIVES)))
+
+    a, b = _as_array(a), _as_array(b)
+    compute = _statistic(statistic)
+    observed = compute(a[np.newaxis, :])[0] - compute(b[np.newaxis, :])[0]
+    distribution = _run(_permutation_task, (np.concatenate((a, b)), len(a), statistic), nb_resamples, seed,
+                        memory_budget, processes)
+
+    if alternative == "two-sided":
+        extreme = np.abs(distribution) >= abs(observed)
+    elif alternative == "greater":
+        extreme = distribution >= observed
+    else:
+        extreme = distribution <= observed
+
+    return float(observed), float((extreme.sum() + 1) / (nb_resamples + 1))
+
+
+class GroupComparisons:
+    """ Cached comparisons of groups of hands
+
+    A comparison is cached per pair of groups, and recomputed only when the
+    stored count, sum, sum of squares, min or max of either group changed
+    (see kalimain.analytics.Analytics.stored_statistics)
+    """
+    def __init__(self, analytics, statistic="mean", nb_resamples=10000, confidence=0.95, seed=None,
+                 memory_budget=MEMORY_BUDGET, processes=None):
+        """
+
+        :param analytics: kalimain.analytics.Analytics instance
+        :param statistic: "mean", "median" or "std"
+        :param nb_resamples: number of bootstrap resamples and of permutations
+        :param confidence: confidence level of bootstrap intervals
+        :param seed: random seed (None = unpredictable)
+        :param memory_budget: memory used by a chunk of resamples (bytes)
+        :param processes: number of worker processes (None = number of CPUs, 0 = no process pool)
+        """
+        _statistic(statistic)
+        self.analytics = analytics
+        self.statistic = statistic
+        self.nb_resamples = nb_resamples
+        self.confidence = confidence
+        self.seed = seed
+        self.memory_budget = memory_budget
+        self.processes = processes
+
+        # (variable, grouping, group a, group b) -> (group fingerprints, Comparison)
+        self._cache = dict()
+
+    def compare(self, variable, by, group_a, group_b):
+        """ Compare variable between two groups
+
+        :param variable: Manning index or finger length (see kalimain.analytics.VARIABLES)
+        :param by: "project", "cave", "country" or "continent"
+        :param group_a: key of first group (project or cave id, country or continent name)
+        :param group_b: key of second group
+        :return: Comparison
+        """
+        statistics = self.analytics.stored_statistics(variable, by, (group_a, group_b))
+        for group in (group_a, group_b):
+            if not statistics.get(group, (0,))[0]:
+                raise ValueError("No %s value in %s group '%s'" % (variable, by, group))
+        fingerprint = (statistics[group_a], statistics[group_b])
+
+        key = (variable, by, group_a, group_b)
+        if key in self._cache and self._cache[key][0] == fingerprint:
+            return self._cache[key][1]
+
+        values = self.analytics.values(variable, by, (group_a, group_b))
+        a, b = values[group_a], values[group_b]
+        interval = bootstrap_difference(a, b, self.statistic, self.nb_resamples, self.confidence, self.seed,
+                                        self.memory_budget, self.processes)
+        _, p_value = permutation_test(a, b, self.statistic, self.nb_resamples, seed=self.seed,
+                                      memory_budget=self.memory_budget, processes=self.processes)
+        comparison = Comparison(variable, by, group_a, group_b, self.statistic, len(a), len(b), interval.estimate,
+                                interval.low, interval.high, self.confidence, p_value, self.nb_resamples)
+        self._cache[key] = (fingerprint, comparison)
+
+        return comparison
+
+    def invalidate(self):
+        """ Clear all cached comparisons
+
+        :return:
+        """
+        self._cache.clear()
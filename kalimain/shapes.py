@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+
+""" Procrustes shape analysis of hands
+
+Whole hand geometry (the 12 landmarks) is compared after generalised
+Procrustes analysis (GPA): landmarks are centred, scaled to unit centroid size
+and rotated onto a consensus shape, which is iteratively re-estimated as the
+mean of the aligned shapes. Left hands are mirrored (x axis flipped, landmark
+order reversed), so that all hands are compared as right hands.
+
+2D shapes are handled as complex vectors: the optimal rotation of a hand is
+then a single complex product, and every GPA iteration is a few operations
+on an (N, 12) array. The full Procrustes distance between two aligned shapes
+z and w is sqrt(1 - |<z, w>|^2). Pairwise distances are computed by blocks of
+rows whose size is given by a memory budget, and can be written to a memory
+mapped .npy file when the full matrix does not fit in memory.
+
+Aligned shapes of hands and mean shapes of groups are stored (see
+database.HandShape and database.MeanShape): hands added later are aligned
+onto the stored consensus, without running GPA again.
+"""
+from collections import namedtuple
+
+import numpy as np
+from sqlalchemy import select, func, delete, insert
+
+import kalimain
+from kalimain.analytics import GROUPS, NO_CAVE, cave_groups, group_codes
+from kalimain.database import Hand, HPoint, Image, HandShape, MeanShape
+from kalimain.dataset import read_chunks, group_landmarks
+from kalimain.features import NB_LANDMARKS, check_landmarks, is_left_handed
+
+# Memory used by a block of pairwise distances (bytes)
+MEMORY_BUDGET = 64 * 2 ** 20
+
+# Convergence tolerance (change of consensus between iterations) and maximum number of GPA iterations
+TOLERANCE = 1e-10
+MAX_ITERATIONS = 100
+
+Alignment = namedtuple("Alignment", ["shapes", "sizes", "consensus", "iterations"])
+GroupShape = namedtuple("GroupShape", ["by", "key", "count", "shape"])
+
+# Scope of stored consensus shape (see MeanShape)
+CONSENSUS = "consensus"
+
+
+def preshapes(landmarks, left=None):
+    """ Centred, unit size and right handed shapes of hands
+
+    :param landmarks: array-like of shape (N, 12, 2)
+    :param left: boolean array of shape (N,). If None, computed from landmarks
+    :return: (N, 12) complex array of shapes and (N,) array of centroid sizes (NaN for missing landmarks)
+    """
+    landmarks = check_landmarks(landmarks)
+    if left is None:
+        left = is_left_handed(landmarks)
+
+    shapes = landmarks[..., 0] + 1j * landmarks[..., 1]
+    shapes = np.where(np.asarray(left)[:, np.newaxis], -np.conj(shapes[:, ::-1]), shapes)
+    shapes = shapes - shapes.mean(axis=1, keepdims=True)
+    sizes = np.sqrt((np.abs(shapes) ** 2).sum(axis=1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        shapes = shapes / sizes[:, np.newaxis]
+
+    return shapes, sizes
+
+
+def align(shapes, reference):
+    """ Rotate shapes onto reference shape
+
+    :param shapes: (N, 12) complex array of preshapes
+    :param reference: (12,) complex array of preshape
+    :return: (N, 12) complex array
+    """
+    products = (np.conj(shapes) * reference).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return shapes * (products / np.abs(products))[:, np.newaxis]
+
+
+def procrustes_distance(shapes, others):
+    """ Full Procrustes distance between shapes, row by row
+
+    :param shapes: (N, 12) complex array of preshapes
+    :param others: (N, 12) or (12,) complex array of preshapes
+    :return: (N,) array
+    """
+    products = (shapes * np.conj(others)).sum(axis=-1)
+
+    return np.sqrt(np.maximum(1 - np.abs(products) ** 2, 0))
+
+
+def generalized_procrustes(landmarks, left=None, tolerance=TOLERANCE, max_iterations=MAX_ITERATIONS):
+    """ Generalised Procrustes alignment of hands
+
+    :param landmarks: array-like of shape (N, 12, 2)
+    :param left: boolean array of shape (N,). If None, computed from landmarks
+    :param tolerance: convergence tolerance on the change of consensus shape
+    :param max_iterations: maximum number of iterations
+    :return: Alignment with (N, 12) complex array of aligned shapes (NaN for missing landmarks), (N,) centroid
+             sizes, (12,) consensus shape and number of iterations
+    """
+    shapes, sizes = preshapes(landmarks, left)
+    valid = ~np.isnan(shapes).any(axis=1)
+    if not valid.any():
+        raise ValueError("No hand with valid landmarks")
+
+    valid_shapes = shapes[valid]
+    consensus = valid_shapes[0]
+    iterations = 0
+    for iterations in range(1, max_iterations + 1):
+        mean = normalize(align(valid_shapes, consensus).sum(axis=0), consensus)
+        change = np.sqrt((np.abs(mean - consensus) ** 2).sum())
+        consensus = mean
+        if change < tolerance:
+            break
+
+    shapes[valid] = align(valid_shapes, consensus)
+    shapes[~valid] = np.nan
+
+    return Alignment(shapes, sizes, consensus, iterations)
+
+
+def normalize(shape, reference=None):
+    """ Scale centred shape (e.g. sum of aligned shapes) to unit size, and rotate it onto reference
+
+    :param shape: (12,) complex array
+    :param reference: (12,) complex array of preshape (None = no rotation)
+    :return: (12,) complex array
+    """
+    shape = shape / np.sqrt((np.abs(shape) ** 2).sum())
+    if reference is not None:
+        shape = align(shape[np.newaxis], reference)[0]
+
+    return shape
+
+
+def grouped_sums(shapes, codes, nb_groups):
+    """ Sum of shapes per group
+
+    :param shapes: (N, 12) complex array
+    :param codes: group index of each shape (0 <= code < nb_groups, -1 = no group)
+    :param nb_groups: number of groups
+    :return: (nb_groups, 12) complex array of sums and (nb_groups,) array of counts
+    """
+    in_group = codes >= 0
+    shapes, codes = shapes[in_group], codes[in_group]
+    sums = np.empty((nb_groups, shapes.shape[1]), dtype=np.complex128)
+    for landmark in range(shapes.shape[1]):
+        sums[:, landmark] = np.bincount(codes, shapes[:, landmark].real, nb_groups) + \
+            1j * np.bincount(codes, shapes[:, landmark].imag, nb_groups)
+
+    return sums, np.bincount(codes, minlength=nb_groups)
+
+
+def to_landmarks(shapes):
+    """ Convert complex shapes into landmark array
+
+    :param shapes: (N, 12) or (12,) complex array
+    :return: (N, 12, 2) or (12, 2) array
+    """
+    return np.stack((shapes.real, shapes.imag), axis=-1)
+
+
+def block_size(nb_columns, memory_budget=MEMORY_BUDGET):
+    """ Number of rows of pairwise distances computed at once within memory budget
+
+    An entry takes a complex product (complex128) and a distance (float64)
+    :param nb_columns: number of columns of distance matrix
+    :param memory_budget: memory budget in bytes
+    :return:
+    """
+    return max(1, memory_budget // (24 * max(nb_columns, 1)))
+
+
+def pairwise_distances(shapes, others=None, memory_budget=MEMORY_BUDGET):
+    """ Full Procrustes distances between shapes and others, by blocks of rows
+
+    :param shapes: (N, 12) complex array of preshapes
+    :param others: (M, 12) complex array of preshapes (default: shapes)
+    :param memory_budget: memory used by a block (bytes)
+    :return: iterator of (first row, (rows, M) array of distances)
+    """
+    others = shapes if others is None else others
+    transposed = np.conj(others).T
+    size = block_size(len(others), memory_budget)
+    for start in range(0, len(shapes), size):
+        products = np.abs(shapes[start:start + size] @ transposed)
+        np.square(products, out=products)
+        np.subtract(1, products, out=products)
+        np.maximum(products, 0, out=products)
+        yield start, np.sqrt(products, out=products)
+
+
+def distance_matrix(shapes, others=None, filename=None, dtype=np.float32, memory_budget=MEMORY_BUDGET):
+    """ Matrix of full Procrustes distances between shapes and others
+
+    :param shapes: (N, 12) complex array of preshapes
+    :param others: (M, 12) complex array of preshapes (default: shapes)
+    :param filename: if not None, matrix is written to that .npy file (memory mapped, see numpy.load)
+    :param dtype: dtype of matrix
+    :param memory_budget: memory used by a block of distances computed at once (bytes)
+    :return: (N, M) array (memory map if filename is not None)
+    """
+    shape = (len(shapes), len(shapes) if others is None else len(others))
+    if filename is not None:
+        matrix = np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=shape)
+    else:
+        matrix = np.empty(shape, dtype=dtype)
+
+    for start, block in pairwise_distances(shapes, others, memory_budget):
+        matrix[start:start + len(block)] = block
+
+    if filename is not None:
+        matrix.flush()
+
+    return matrix
+
+
+def _decode(blobs):
+    return np.frombuffer(b"".join(blobs), dtype=np.complex128).reshape(-1, NB_LANDMARKS)
+
+
+class ShapeStore:
+    """ Stored Procrustes shapes of hands, and mean shapes per group
+
+    """
+    def __init__(self, engine=None, tolerance=TOLERANCE, max_iterations=MAX_ITERATIONS, chunk_size=10000):
+        """
+
+        :param engine: SQLAlchemy engine (default: kalimain.ENGINE)
+        :param tolerance: convergence tolerance of GPA
+        :param max_iterations: maximum number of GPA iterations
+        :param chunk_size: number of hands read or written at once
+        """
+        self.engine = engine if engine is not None else kalimain.ENGINE
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.chunk_size = chunk_size
+
+    def _read_landmarks(self, connection, missing_only):
+        statement = select(HPoint.hand_id, HPoint.x, HPoint.y).order_by(HPoint.hand_id, HPoint.id)
+        if missing_only:
+            statement = statement.where(HPoint.hand_id.notin_(select(HandShape.hand_id)))
+
+        return group_landmarks(read_chunks(connection, statement, np.dtype(np.float64),
+                                           self.chunk_size * NB_LANDMARKS))
+
+    def _store_means(self, connection):
+        """ Recompute mean shapes of all groups from stored shapes
+
+        """
+        groups = cave_groups(connection)
+        keys = {by: sorted((key for key in groups[by][1] if key is not None), key=str) for by in GROUPS}
+        keys[None] = [None]
+        sums = {by: np.zeros((len(keys[by]), NB_LANDMARKS), dtype=np.complex128) for by in keys}
+        counts = {by: np.zeros(len(keys[by]), dtype=np.int64) for by in keys}
+
+        statement = select(func.coalesce(Image.cave_id, NO_CAVE), HandShape.shape).select_from(HandShape).join(
+            Hand, HandShape.hand_id == Hand.id).outerjoin(Image, Hand.image_id == Image.id)
+        for rows in connection.execution_options(stream_results=True).execute(statement).partitions(
+                self.chunk_size):
+            cave_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+            shapes = _decode([row[1] for row in rows])
+            for by in keys:
+                codes = np.zeros(len(rows), dtype=np.int64) if by is None else \
+                    group_codes(cave_ids, groups[by][0], keys[by])
+                group_sums, group_counts = grouped_sums(shapes, codes, len(keys[by]))
+                sums[by] += group_sums
+                counts[by] += group_counts
+
+        consensus = self._consensus(connection)
+        connection.execute(delete(MeanShape).where(MeanShape.scope != CONSENSUS))
+        rows = [dict(scope=by or "all", key="" if by is None else str(key), count=int(count),
+                     shape=normalize(group_sum, consensus).tobytes())
+                for by in keys for key, group_sum, count in zip(keys[by], sums[by], counts[by]) if count]
+        if rows:
+            connection.execute(insert(MeanShape), rows)
+
+    @staticmethod
+    def _consensus(connection):
+        shape = connection.execute(select(MeanShape.shape).where(MeanShape.scope == CONSENSUS)).scalar()
+        return _decode([shape])[0] if shape is not None else None
+
+    def consensus(self):
+        """ Stored consensus shape (None if shapes were never aligned)
+
+        :return: (12,) complex array
+        """
+        with self.engine.connect() as connection:
+            return self._consensus(connection)
+
+    def distances(self, hand_ids=None, filename=None, dtype=np.float32, memory_budget=MEMORY_BUDGET):
+        """ Matrix of full Procrustes distances between stored shapes
+
+        :param hand_ids: ids of hands (None = all stored hands)
+        :param filename: if not None, matrix is written to that .npy file (memory mapped)
+        :param dtype: dtype of matrix
+        :param memory_budget: memory used by a block of distances computed at once (bytes)
+        :return: (hand ids, (N, N) array of distances)
+        """
+        hand_ids, shapes = self.shapes(hand_ids)
+
+        return hand_ids, distance_matrix(shapes, filename=filename, dtype=dtype, memory_budget=memory_budget)
+
+    def mean_shapes(self, by=None):
+        """ Stored mean shapes of groups
+
+        :param by: None (all hands), "project", "cave", "country" or "continent"
+        :return: list of GroupShape, with (12, 2) landmark arrays of unit size
+        """
+        if by is not None and by not in GROUPS:
+            raise ValueError("Unknown grouping '%s' (valid groupings: %s)" % (by, ", ".join(GROUPS)))
+
+        with self.engine.connect() as connection:
+            rows = connection.execute(select(MeanShape.key, MeanShape.count, MeanShape.shape).where(
+                MeanShape.scope == (by or "all")).order_by(MeanShape.key)).all()
+
+        return [GroupShape(by, key or None, count, to_landmarks(_decode([shape])[0])) for key, count, shape in rows]
+
+    def shapes(self, hand_ids=None, condition=None):
+        """ Stored aligned shapes of hands
+
+        :param hand_ids: ids of hands (None = all stored hands)
+        :param condition: if not None, only read shapes matching SQL condition (e.g. on HandShape.hand_id)
+        :return: (hand ids, (N, 12) complex array of shapes), ordered by hand id
+        """
+        statement = select(HandShape.hand_id, HandShape.shape).order_by(HandShape.hand_id)
+        if hand_ids is not None:
+            statement = statement.where(HandShape.hand_id.in_([int(hand_id) for hand_id in hand_ids]))
+        if condition is not None:
+            statement = statement.where(condition)
+
+        ids, blobs = [], []
+        with self.engine.connect() as connection:
+            for rows in connection.execution_options(stream_results=True).execute(statement).partitions(
+                    self.chunk_size):
+                ids += [row[0] for row in rows]
+                blobs += [row[1] for row in rows]
+
+        return np.array(ids, dtype=np.int64), _decode(blobs)
+
+    def update(self, rebuild=False):
+        """ Align hands without stored shape onto stored consensus, and update mean shapes
+
+        GPA of all hands is run when there is no stored consensus, or on rebuild
+        :param rebuild: if True, align all hands again
+        :return: number of aligned hands
+        """
+        with self.engine.begin() as connection:
+            consensus = None if rebuild else self._consensus(connection)
+            hand_ids, landmarks = self._read_landmarks(connection, missing_only=consensus is not None)
+
+            if consensus is None:
+                connection.execute(delete(HandShape))
+                connection.execute(delete(MeanShape))
+                if len(hand_ids) == 0:
+                    return 0
+                alignment = generalized_procrustes(landmarks, tolerance=self.tolerance,
+                                                   max_iterations=self.max_iterations)
+                shapes, sizes, consensus = alignment.shapes, alignment.sizes, alignment.consensus
+                connection.execute(insert(MeanShape).values(scope=CONSENSUS, key="", count=len(hand_ids),
+                                                            shape=consensus.tobytes()))
+            else:
+                shapes, sizes = preshapes(landmarks)
+                shapes = align(shapes, consensus)
+
+            valid = ~np.isnan(shapes).any(axis=1)
+            hand_ids, shapes, sizes = hand_ids[valid], shapes[valid], sizes[valid]
+            distances = procrustes_distance(shapes, consensus)
+            for start in range(0, len(hand_ids), self.chunk_size):
+                stop = start + self.chunk_size
+                connection.execute(insert(HandShape), [
+                    dict(hand_id=int(hand_id), size=float(size), distance=float(distance), shape=shape.tobytes())
+                    for hand_id, size, distance, shape in zip(hand_ids[start:stop], sizes[start:stop],
+                                                              distances[start:stop], shapes[start:stop])])
+
+            # Shapes of hands deleted by ORM flushes or under enforced foreign keys are already deleted with them
+            deleted = connection.execute(delete(HandShape).where(HandShape.hand_id.notin_(select(Hand.id)))).rowcount
+            stored = connection.execute(select(func.count(HandShape.id))).scalar()
+            counted = connection.execute(select(MeanShape.count).where(MeanShape.scope == "all")).scalar()
+            if len(hand_ids) or deleted or stored != (counted or 0):
+                self._store_means(connection)
+
+        return len(hand_ids)
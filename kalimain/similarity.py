@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+""" Similarity search of hands
+
+Hands are compared through their profile: finger lengths D1-D5 divided by
+their sum (so that the image scale does not matter), and handedness scaled
+by a weight (so that hands of the other side come after all hands of the
+same side). Nearest profiles are found in a segmented index: a large static
+segment (KD-tree when scipy is installed, blocked brute force otherwise),
+plus a small segment of recently added hands. Removed hands are masked
+until segments are merged back into a new static segment.
+"""
+import numpy as np
+from sqlalchemy import select, cast, Float, and_
+
+from kalimain.database import Hand
+from kalimain.dataset import read_chunks
+
+DIGITS = ("D1", "D2", "D3", "D4", "D5")
+PROFILE_SIZE = len(DIGITS) + 1
+
+# Weight of handedness within profiles (finger ratios are within [0, 1])
+HANDEDNESS_WEIGHT = 1.0
+
+# Number of added hands above which segments are merged
+MAX_DELTA = 10000
+
+# Number of profiles per block of brute force search
+BLOCK_SIZE = 2 ** 18
+
+
+def hand_profiles(digits, left, handedness_weight=HANDEDNESS_WEIGHT):
+    """ Profiles of hands (vectorized)
+
+    :param digits: (N, 5) array of finger lengths D1-D5
+    :param left: (N,) boolean array (True for left hands)
+    :param handedness_weight: weight of handedness
+    :return: (N, 6) array
+    """
+    digits = np.asarray(digits, dtype=np.float64).reshape(-1, len(DIGITS))
+    profiles = np.empty((len(digits), PROFILE_SIZE))
+    profiles[:, :len(DIGITS)] = digits / digits.sum(axis=1, keepdims=True)
+    profiles[:, -1] = handedness_weight * np.asarray(left, dtype=np.float64).reshape(-1)
+
+    return profiles
+
+
+def hand_profile(hand, handedness_weight=HANDEDNESS_WEIGHT):
+    """ Profile of Hand instance
+
+    :param hand: Hand instance (or any object with D1-D5 and left attributes)
+    :param handedness_weight: weight of handedness
+    :return: (6,) array
+    """
+    return hand_profiles([[getattr(hand, digit) for digit in DIGITS]], [bool(hand.left)], handedness_weight)[0]
+
+
+def profiles_statement():
+    """ Select (hand id, D1, ..., D5, left) of hands with all finger lengths, ordered by id
+
+    :return:
+    """
+    digits = [getattr(Hand, digit) for digit in DIGITS]
+    return select(Hand.id, *digits, cast(Hand.left, Float)).where(and_(*[digit.isnot(None) for digit in digits])
+                                                                  ).order_by(Hand.id)
+
+
+class ProfileSegment:
+    """ Static set of profiles searched with KD-tree (scipy) or blocked brute force
+
+    """
+    def __init__(self, ids, profiles):
+        """
+
+        :param ids: (N,) array of hand ids, in increasing order
+        :param profiles: (N, 6) array of profiles
+        """
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.profiles = np.asarray(profiles, dtype=np.float64).reshape(-1, PROFILE_SIZE)
+        self.tree = None
+        self.squared_norms = None
+        try:
+            from scipy.spatial import cKDTree
+        except ImportError:
+            self.squared_norms = (self.profiles ** 2).sum(axis=1)
+        else:
+            if len(self.ids):
+                self.tree = cKDTree(self.profiles)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, hand_id):
+        """ Profile of hand (None if not in segment)
+
+        """
+        i = np.searchsorted(self.ids, hand_id)
+        if i < len(self.ids) and self.ids[i] == hand_id:
+            return self.profiles[i]
+
+    def query(self, profile, k):
+        """ k nearest profiles
+
+        :param profile: (6,) array
+        :param k: number of neighbours
+        :return: (distances, hand ids), sorted by distance
+        """
+        k = min(k, len(self.ids))
+        if k == 0:
+            return np.empty(0), np.empty(0, dtype=np.int64)
+
+        if self.tree is not None:
+            distances, index = self.tree.query(profile, k)
+            return np.atleast_1d(distances), self.ids[np.atleast_1d(index)]
+
+        # Squared distances by blocks, keeping the k best of every block
+        best_distances, best_index = [], []
+        for start in range(0, len(self.ids), BLOCK_SIZE):
+            block = slice(start, start + BLOCK_SIZE)
+            distances = self.squared_norms[block] - 2 * self.profiles[block] @ profile
+            nearest = np.argpartition(distances, k - 1)[:k] if len(distances) > k else np.arange(len(distances))
+            best_distances.append(distances[nearest])
+            best_index.append(nearest + start)
+        distances, index = np.concatenate(best_distances), np.concatenate(best_index)
+        order = np.argsort(distances)[:k]
+
+        return np.sqrt(np.maximum(distances[order] + profile @ profile, 0)), self.ids[index[order]]
+
+
+class SimilarityIndex:
+    """ Segmented nearest neighbour index of hand profiles
+
+    """
+    def __init__(self, handedness_weight=HANDEDNESS_WEIGHT, max_delta=MAX_DELTA):
+        """
+
+        :param handedness_weight: weight of handedness within profiles
+        :param max_delta: number of added hands above which segments are merged
+        """
+        self.handedness_weight = handedness_weight
+        self.max_delta = max_delta
+        self.segment = ProfileSegment([], [])
+        self.delta = dict()
+        self.removed = set()
+
+    def __len__(self):
+        return len(self.segment) - len(self.removed) + len(self.delta)
+
+    def __contains__(self, hand_id):
+        return hand_id in self.delta or (hand_id not in self.removed and self.segment.get(hand_id) is not None)
+
+    def add(self, hand_id, profile):
+        """ Add (or replace) profile of hand
+
+        :param hand_id:
+        :param profile: (6,) array (see hand_profile)
+        :return:
+        """
+        if self.segment.get(hand_id) is not None:
+            self.removed.add(hand_id)
+        self.delta[hand_id] = np.asarray(profile, dtype=np.float64)
+        if len(self.delta) > self.max_delta:
+            self.merge()
+
+    def build(self, ids, profiles):
+        """ Replace index content
+
+        :param ids: (N,) array of hand ids
+        :param profiles: (N, 6) array of profiles
+        :return:
+        """
+        order = np.argsort(ids, kind="stable")
+        self.segment = ProfileSegment(np.asarray(ids)[order], np.asarray(profiles).reshape(-1, PROFILE_SIZE)[order])
+        self.delta.clear()
+        self.removed.clear()
+
+    def load(self, connection, chunk_size=100000):
+        """ Build index from all stored hands with finger lengths
+
+        :param connection: SQLAlchemy connection
+        :param chunk_size: number of rows fetched at once
+        :return:
+        """
+        rows = read_chunks(connection, profiles_statement(), np.dtype(np.float64), chunk_size)
+        self.build(rows[:, 0].astype(np.int64), hand_profiles(rows[:, 1:-1], rows[:, -1] > 0, self.handedness_weight))
+
+    def merge(self):
+        """ Merge added and removed hands into a new static segment
+
+        :return:
+        """
+        keep = ~np.isin(self.segment.ids, np.fromiter(self.removed, dtype=np.int64, count=len(self.removed)))
+        ids = np.concatenate((self.segment.ids[keep], np.fromiter(self.delta, dtype=np.int64, count=len(self.delta))))
+        profiles = np.concatenate((self.segment.profiles[keep], np.array(list(self.delta.values())).reshape(
+            -1, PROFILE_SIZE)))
+        self.build(ids, profiles)
+
+    def nearest(self, profile, k=10, exclude=()):
+        """ k hands whose profiles are nearest to profile
+
+        :param profile: (6,) array (see hand_profile)
+        :param k: number of hands
+        :param exclude: ids of hands to leave out (e.g. the query hand)
+        :return: list of (distance, hand id) sorted by distance
+        """
+        profile = np.asarray(profile, dtype=np.float64)
+        exclude = set(exclude)
+        distances, ids = self.segment.query(profile, k + len(self.removed) + len(exclude))
+        result = [(float(distance), int(hand_id)) for distance, hand_id in zip(distances, ids)
+                  if hand_id not in self.removed and hand_id not in exclude]
+        if self.delta:
+            delta_ids = list(self.delta)
+            delta_distances = np.sqrt(((np.array(list(self.delta.values())) - profile) ** 2).sum(axis=1))
+            result += [(float(distance), hand_id) for distance, hand_id in zip(delta_distances, delta_ids)
+                       if hand_id not in exclude]
+
+        return sorted(result)[:k]
+
+    def profile(self, hand_id):
+        """ Profile of indexed hand (None if not indexed)
+
+        :param hand_id:
+        :return:
+        """
+        if hand_id in self.delta:
+            return self.delta[hand_id]
+        elif hand_id not in self.removed:
+            return self.segment.get(hand_id)
+
+    def remove(self, hand_id):
+        """ Remove hand from index
+
+        :param hand_id:
+        :return:
+        """
+        if self.delta.pop(hand_id, None) is None and self.segment.get(hand_id) is not None:
+            self.removed.add(hand_id)
+
+    def similar(self, hand_id, k=10):
+        """ k hands most similar to indexed hand
+
+        :param hand_id:
+        :param k: number of hands
+        :return: list of (distance, hand id) sorted by distance
+        """
+        profile = self.profile(hand_id)
+        if profile is None:
+            raise KeyError(hand_id)
+
+        return self.nearest(profile, k, exclude=(hand_id,))
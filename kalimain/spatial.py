@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+
+""" Spatial autocorrelation of hand features across caves
+
+Do caves with close Manning index (or finger lengths) lie close to each
+other? The mean of a feature per cave is taken from stored statistics (see
+kalimain.summary), and caves are linked by a sparse neighbour graph built
+from their coordinates: all caves within a distance band, or the k nearest
+caves (see kalimain.geo). The graph is kept as edge lists, so that spatial
+lags are weighted bincounts and every statistic is O(number of edges):
+
+- global Moran's I and Geary's C, with z-scores under normality and
+  optional permutation p-values;
+- local Moran's I (clusters and outliers) and Getis-Ord Gi* z-scores (hot
+  and cold spots) of every cave.
+"""
+import math
+from collections import namedtuple
+
+import numpy as np
+from sqlalchemy import select, and_
+
+import kalimain
+from kalimain.analytics import VARIABLES
+from kalimain.database import Cave, HandStat
+from kalimain.geo import close_pairs, nearest_pairs
+
+# Memory used by a chunk of permutations (bytes)
+MEMORY_BUDGET = 64 * 2 ** 20
+
+GlobalStatistic = namedtuple("GlobalStatistic", ["name", "value", "expected", "variance", "z_score", "p_value",
+                                                 "p_permutation"])
+SpatialAutocorrelation = namedtuple("SpatialAutocorrelation", ["variable", "cave_ids", "values", "counts",
+                                                               "neighbours", "moran", "geary", "local_moran",
+                                                               "hotspots"])
+
+
+class NeighbourGraph:
+    """ Sparse spatial weights, as lists of edges (first node, second node, weight)
+
+    """
+    def __init__(self, first, second, weights, size):
+        """
+
+        :param first: (E,) array of first nodes
+        :param second: (E,) array of second nodes
+        :param weights: (E,) array of weights
+        :param size: number of nodes
+        """
+        self.first = np.asarray(first, dtype=np.int64)
+        self.second = np.asarray(second, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.size = size
+
+    def __len__(self):
+        return len(self.first)
+
+    @classmethod
+    def distance_band(cls, latitudes, longitudes, distance, inverse=False):
+        """ Graph of locations within distance of each other
+
+        :param latitudes: array of latitudes in degrees
+        :param longitudes: array of longitudes in degrees
+        :param distance: distance band in km
+        :param inverse: if True, weights are inverse distances (binary weights otherwise)
+        :return: NeighbourGraph
+        """
+        first, second, distances = close_pairs(latitudes, longitudes, distance)
+
+        return cls(first, second, cls._weights(distances, inverse), len(latitudes))
+
+    @classmethod
+    def k_nearest(cls, latitudes, longitudes, k, inverse=False):
+        """ Graph of every location and its k nearest locations (not symmetric)
+
+        :param latitudes: array of latitudes in degrees
+        :param longitudes: array of longitudes in degrees
+        :param k: number of neighbours
+        :param inverse: if True, weights are inverse distances (binary weights otherwise)
+        :return: NeighbourGraph
+        """
+        first, second, distances = nearest_pairs(latitudes, longitudes, k)
+
+        return cls(first, second, cls._weights(distances, inverse), len(latitudes))
+
+    @staticmethod
+    def _weights(distances, inverse):
+        if inverse:
+            # Locations at the same place get the weight of locations 10 m apart
+            return 1 / np.maximum(distances, 0.01)
+        return np.ones(len(distances))
+
+    @property
+    def neighbours(self):
+        """ Number of neighbours of every node
+
+        """
+        return np.bincount(self.first, minlength=self.size)
+
+    @property
+    def s0(self):
+        return self.weights.sum()
+
+    @property
+    def s1(self):
+        """ 1/2 sum over (i, j) of (w_ij + w_ji)^2
+
+        """
+        keys = self.first * self.size + self.second
+        order = np.argsort(keys)
+        reverse_keys = self.second * self.size + self.first
+        index = np.minimum(np.searchsorted(keys[order], reverse_keys), len(keys) - 1)
+        found = keys[order][index] == reverse_keys
+        reverse = np.where(found, self.weights[order][index], 0)
+
+        # Pairs whose reverse edge is missing are counted once more, as (0 + w_ij)^2 for (j, i)
+        return 0.5 * (((self.weights + reverse) ** 2).sum() + (self.weights[~found] ** 2).sum())
+
+    @property
+    def s2(self):
+        """ sum over i of (row sum + column sum)^2
+
+        """
+        return ((np.bincount(self.first, self.weights, self.size) +
+                 np.bincount(self.second, self.weights, self.size)) ** 2).sum()
+
+    def binary(self, self_loops=False):
+        """ Graph with weights 1
+
+        :param self_loops: if True, every node is its own neighbour
+        :return: NeighbourGraph
+        """
+        if not self_loops:
+            return NeighbourGraph(self.first, self.second, np.ones(len(self)), self.size)
+
+        nodes = np.arange(self.size)
+        return NeighbourGraph(np.concatenate((self.first, nodes)), np.concatenate((self.second, nodes)),
+                              np.ones(len(self) + self.size), self.size)
+
+    def lag(self, values):
+        """ Spatial lag: weighted sum of the values of neighbours of every node
+
+        :param values: (N,) array, or (P, N) array of P series
+        :return: array of the same shape
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim == 1:
+            return np.bincount(self.first, self.weights * values[self.second], self.size)
+
+        return np.stack([np.bincount(self.first, self.weights * series[self.second], self.size) for series in values])
+
+    def row_standardized(self):
+        """ Graph whose weights of every node sum to 1 (nodes without neighbours keep none)
+
+        :return: NeighbourGraph
+        """
+        row_sums = np.bincount(self.first, self.weights, self.size)
+
+        return NeighbourGraph(self.first, self.second, self.weights / row_sums[self.first], self.size)
+
+
+def _p_value(z_score):
+    """ Two-sided p-value of z-score under normal distribution
+
+    """
+    return math.erfc(abs(z_score) / math.sqrt(2)) if not math.isnan(z_score) else float("nan")
+
+
+def _deviations(values):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) < 3:
+        raise ValueError("Spatial autocorrelation needs at least 3 locations")
+    return values - values.mean()
+
+
+def _permutations(deviations, graph, statistic, observed, expected, nb_permutations, seed, memory_budget):
+    """ Permutation p-value of statistic of edges (two-sided, around its expected value)
+
+    :param statistic: function of (P, E) values of first nodes and (P, E) values of second nodes -> (P,) array
+    """
+    rng = np.random.default_rng(seed)
+    size = max(1, memory_budget // (16 * max(len(graph), deviations.size)))
+    extreme = 0
+    for start in range(0, nb_permutations, size):
+        permuted = rng.permuted(np.broadcast_to(deviations, (min(size, nb_permutations - start), len(deviations))),
+                                axis=1)
+        values = statistic(permuted[:, graph.first], permuted[:, graph.second])
+        extreme += int((np.abs(values - expected) >= abs(observed - expected)).sum())
+
+    return (extreme + 1) / (nb_permutations + 1)
+
+
+def morans_i(values, graph, nb_permutations=0, seed=None, memory_budget=MEMORY_BUDGET):
+    """ Global Moran's I
+
+    :param values: (N,) array of values of nodes
+    :param graph: NeighbourGraph
+    :param nb_permutations: number of permutations of p_permutation (0 = None)
+    :param seed: random seed of permutations
+    :param memory_budget: memory used by a chunk of permutations (bytes)
+    :return: GlobalStatistic (z-score under normality)
+    """
+    deviations = _deviations(values)
+    n, s0, s1, s2 = len(deviations), graph.s0, graph.s1, graph.s2
+    squares = (deviations ** 2).sum()
+
+    def statistic(first, second):
+        return n / s0 * (graph.weights * first * second).sum(axis=-1) / squares
+
+    value = float(statistic(deviations[graph.first], deviations[graph.second]))
+    expected = -1 / (n - 1)
+    variance = float((n ** 2 * s1 - n * s2 + 3 * s0 ** 2) / ((n ** 2 - 1) * s0 ** 2) - expected ** 2)
+    z_score = (value - expected) / math.sqrt(variance) if variance > 0 else float("nan")
+    p_permutation = _permutations(deviations, graph, statistic, value, expected, nb_permutations, seed,
+                                  memory_budget) if nb_permutations else None
+
+    return GlobalStatistic("Moran's I", value, expected, variance, z_score, _p_value(z_score), p_permutation)
+
+
+def gearys_c(values, graph, nb_permutations=0, seed=None, memory_budget=MEMORY_BUDGET):
+    """ Global Geary's C
+
+    :param values: (N,) array of values of nodes
+    :param graph: NeighbourGraph
+    :return: GlobalStatistic (z-score under normality, see morans_i for other parameters)
+    """
+    deviations = _deviations(values)
+    n, s0, s1, s2 = len(deviations), graph.s0, graph.s1, graph.s2
+    squares = (deviations ** 2).sum()
+
+    def statistic(first, second):
+        return (n - 1) * (graph.weights * (first - second) ** 2).sum(axis=-1) / (2 * s0 * squares)
+
+    value = float(statistic(deviations[graph.first], deviations[graph.second]))
+    variance = float(((2 * s1 + s2) * (n - 1) - 4 * s0 ** 2) / (2 * (n + 1) * s0 ** 2))
+    z_score = (value - 1) / math.sqrt(variance) if variance > 0 else float("nan")
+    p_permutation = _permutations(deviations, graph, statistic, value, 1, nb_permutations, seed,
+                                  memory_budget) if nb_permutations else None
+
+    return GlobalStatistic("Geary's C", value, 1.0, variance, z_score, _p_value(z_score), p_permutation)
+
+
+def local_morans_i(values, graph):
+    """ Local Moran's I of every node
+
+    Positive values are nodes surrounded by similar values (clusters),
+    negative values nodes unlike their neighbours (outliers)
+    :param values: (N,) array of values of nodes
+    :param graph: NeighbourGraph (usually row standardized)
+    :return: (N,) array
+    """
+    deviations = _deviations(values)
+
+    return deviations * graph.lag(deviations) / (deviations ** 2).mean()
+
+
+def getis_ord(values, graph):
+    """ Getis-Ord Gi* z-score of every node
+
+    Computed with binary weights of neighbours and of the node itself:
+    large positive z-scores are hot spots, large negative ones cold spots
+    :param values: (N,) array of values of nodes
+    :param graph: NeighbourGraph
+    :return: (N,) array
+    """
+    values = np.asarray(values, dtype=np.float64)
+    _deviations(values)
+    graph = graph.binary(self_loops=True)
+    n, mean, std = len(values), values.mean(), values.std()
+    weights = np.bincount(graph.first, graph.weights, n)
+    squares = np.bincount(graph.first, graph.weights ** 2, n)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (graph.lag(values) - mean * weights) / (std * np.sqrt((n * squares - weights ** 2) / (n - 1)))
+
+
+class SpatialStatistics:
+    """ Spatial autocorrelation of the mean of a hand feature per cave
+
+    The neighbour graph is cached, and only rebuilt when caves (or their
+    coordinates) change
+    """
+    def __init__(self, engine=None, distance=None, k=8, inverse=False):
+        """
+
+        :param engine: SQLAlchemy engine (default: kalimain.ENGINE)
+        :param distance: distance band in km (None = k nearest caves)
+        :param k: number of nearest caves (when distance is None)
+        :param inverse: if True, weights are inverse distances (binary weights otherwise)
+        """
+        self.engine = engine if engine is not None else kalimain.ENGINE
+        self.distance = distance
+        self.k = k
+        self.inverse = inverse
+
+        # (cave ids, latitudes, longitudes) and neighbour graph
+        self._graph = None
+
+    def _read_caves(self, variable):
+        """ Id, coordinates, number of values and mean of variable of caves with coordinates and values
+
+        """
+        count, total = (getattr(HandStat, "%s_%s" % (variable, suffix)) for suffix in ("count", "sum"))
+        statement = select(Cave.id, Cave.latitude, Cave.longitude, count, total).join(
+            HandStat, and_(HandStat.scope == "cave", HandStat.scope_id == Cave.id)).where(
+            Cave.latitude.isnot(None), Cave.longitude.isnot(None), count > 0).order_by(Cave.id)
+        with self.engine.connect() as connection:
+            rows = np.array(connection.execute(statement).all(), dtype=np.float64).reshape(-1, 5)
+
+        return rows[:, 0].astype(np.int64), rows[:, 1], rows[:, 2], rows[:, 3].astype(np.int64), rows[:, 4] / rows[:, 3]
+
+    def graph(self, cave_ids, latitudes, longitudes):
+        """ Neighbour graph of caves (cached)
+
+        :param cave_ids: (N,) array of cave ids
+        :param latitudes: (N,) array of latitudes in degrees
+        :param longitudes: (N,) array of longitudes in degrees
+        :return: NeighbourGraph
+        """
+        if self._graph is not None and all(np.array_equal(cached, array) for cached, array in zip(
+                self._graph[0], (cave_ids, latitudes, longitudes))):
+            return self._graph[1]
+
+        if self.distance is not None:
+            graph = NeighbourGraph.distance_band(latitudes, longitudes, self.distance, self.inverse)
+        else:
+            graph = NeighbourGraph.k_nearest(latitudes, longitudes, self.k, self.inverse)
+        self._graph = ((cave_ids, latitudes, longitudes), graph)
+
+        return graph
+
+    def compute(self, variable="manning", nb_permutations=0, seed=None):
+        """ Global and local spatial autocorrelation of the mean of variable per cave
+
+        :param variable: Manning index or finger length (see kalimain.analytics.VARIABLES)
+        :param nb_permutations: number of permutations of global statistics p-values (0 = none)
+        :param seed: random seed of permutations
+        :return: SpatialAutocorrelation with arrays per cave (ids, mean values, number of values, number of
+                 neighbours, local Moran's I and Getis-Ord Gi* z-scores) and global Moran's I and Geary's C
+        """
+        if variable not in VARIABLES:
+            raise ValueError("Unknown variable '%s' (valid variables: %s)" % (variable, ", ".join(VARIABLES)))
+
+        cave_ids, latitudes, longitudes, counts, values = self._read_caves(variable)
+        graph = self.graph(cave_ids, latitudes, longitudes)
+        if len(graph) == 0:
+            raise ValueError("No pair of neighbour caves")
+        standardized = graph.row_standardized()
+
+        return SpatialAutocorrelation(variable, cave_ids, values, counts, graph.neighbours,
+                                      morans_i(values, standardized, nb_permutations, seed),
+                                      gearys_c(values, standardized, nb_permutations, seed),
+                                      local_morans_i(values, standardized), getis_ord(values, graph))
+
+    def invalidate(self):
+        """ Clear cached neighbour graph
+
+        :return:
+        """
+        self._graph = None
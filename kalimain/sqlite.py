@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+""" SQLite tuning
+
+Pragma profiles applied to every new connection of an SQLite engine.
+"default" is safe for interactive use (write-ahead log, synchronous commits
+at checkpoints only), "bulk" trades durability of the last transactions on
+power loss for insert speed and should only be used by batch imports.
+"""
+from sqlalchemy import event
+
+PRAGMA_PROFILES = dict(default=dict(journal_mode="WAL", synchronous="NORMAL", foreign_keys="ON",
+                                    temp_store="MEMORY", cache_size=-16000),
+                       bulk=dict(journal_mode="WAL", synchronous="OFF", foreign_keys="ON", temp_store="MEMORY",
+                                 cache_size=-256000, mmap_size=1 << 28))
+
+
+def apply_pragmas(dbapi_connection, profile="default"):
+    """ Apply pragma profile to DBAPI (sqlite3) connection
+
+    :param dbapi_connection: sqlite3 connection
+    :param profile: name of profile in PRAGMA_PROFILES, or dict of pragmas
+    :return:
+    """
+    pragmas = PRAGMA_PROFILES[profile] if isinstance(profile, str) else profile
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+    finally:
+        cursor.close()
+
+
+def tune_engine(engine, profile="default"):
+    """ Apply pragma profile to all connections of SQLite engine
+
+    Connections already in the pool are discarded, so that every connection
+    gets the profile. Engines of other databases are left unchanged
+    :param engine: SQLAlchemy engine
+    :param profile: name of profile in PRAGMA_PROFILES, or dict of pragmas
+    :return: engine
+    """
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", lambda dbapi_connection, _: apply_pragmas(dbapi_connection, profile))
+        engine.dispose()
+
+    return engine
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+""" Incrementally maintained hand statistics
+
+Number of hands, of left and right hands, and count, sum, sum of squares,
+min and max of every feature (D1-D5, Manning index) are stored per image,
+cave and project, and for all hands (see database.HandStat). Summaries are
+then single row lookups instead of scans of the hands table.
+
+Statistics are updated within every ORM flush inserting, updating or
+deleting hands. Bulk writes which bypass the ORM (executemany, bulk
+mappings) must call add_hands/remove_hands, or rebuild statistics. Check
+compares stored statistics with a full recomputation. Flushes deleting hands
+also delete the values derived from them (database.HAND_TABLES).
+"""
+import math
+from collections import namedtuple
+
+from sqlalchemy import select, func, cast, case, event, insert, update, delete, inspect, literal, not_, Integer
+from sqlalchemy.orm import Session
+
+from kalimain.database import Base, Hand, Image, Cave, HandStat, STAT_FEATURES, HAND_TABLES
+
+SCOPES = ("all", "project", "cave", "image")
+
+# Scope id of statistics of all hands
+ALL = 0
+
+FeatureSummary = namedtuple("FeatureSummary", ["count", "mean", "std", "min", "max"])
+ScopeSummary = namedtuple("ScopeSummary", ["scope", "scope_id", "hands", "left", "right", "features"])
+Mismatch = namedtuple("Mismatch", ["scope", "scope_id", "column", "stored", "expected"])
+
+# Relative tolerance of check on sums (sums are updated incrementally)
+CHECK_TOLERANCE = 1e-6
+
+_COUNTS = ("hands", "left", "right") + tuple("%s_%s" % (feature, suffix) for feature in STAT_FEATURES
+                                             for suffix in ("count", "sum", "squares"))
+_EXTREMES = tuple("%s_%s" % (feature, suffix) for feature in STAT_FEATURES for suffix in ("min", "max"))
+
+
+def _scope_key(scope):
+    return dict(all=literal(ALL), project=Cave.project_id, cave=Image.cave_id, image=Hand.image_id)[scope]
+
+
+def aggregate_statement(scope, condition=None):
+    """ Statistics of hands per scope id, computed from hands table
+
+    Columns are named as HandStat columns
+    :param scope: "all", "project", "cave" or "image"
+    :param condition: if not None, only aggregate hands matching condition
+    :return:
+    """
+    key = _scope_key(scope)
+    columns = [key.label("scope_id"), func.count(Hand.id).label("hands"),
+               func.coalesce(func.sum(cast(Hand.left, Integer)), 0).label("left"),
+               func.coalesce(func.sum(cast(Hand.right, Integer)), 0).label("right")]
+    for feature in STAT_FEATURES:
+        column = getattr(Hand, feature)
+        columns += [func.count(column).label(feature + "_count"),
+                    func.coalesce(func.sum(column), 0).label(feature + "_sum"),
+                    func.coalesce(func.sum(column * column), 0).label(feature + "_squares"),
+                    func.min(column).label(feature + "_min"), func.max(column).label(feature + "_max")]
+
+    statement = select(*columns).select_from(Hand)
+    if scope in ("cave", "project"):
+        statement = statement.join(Image, Hand.image_id == Image.id)
+    if scope == "project":
+        statement = statement.join(Cave, Image.cave_id == Cave.id)
+    if condition is not None:
+        statement = statement.where(condition)
+    if scope != "all":
+        statement = statement.where(key.isnot(None)).group_by(key)
+
+    return statement
+
+
+def _where(scope, scope_id):
+    return (HandStat.scope == scope) & (HandStat.scope_id == scope_id)
+
+
+def _add(connection, scope, row):
+    """ Add aggregated statistics of new hands to stored statistics of scope
+
+    """
+    values = {name: getattr(HandStat, name) + row[name] for name in _COUNTS}
+    for feature in STAT_FEATURES:
+        for suffix, is_better in (("min", lambda new, old: new < old), ("max", lambda new, old: new > old)):
+            column, new = getattr(HandStat, feature + "_" + suffix), row[feature + "_" + suffix]
+            if new is not None:
+                values[column.name] = case((column.is_(None), new), (is_better(literal(new), column), new),
+                                           else_=column)
+
+    if connection.execute(update(HandStat).where(_where(scope, row["scope_id"])).values(values)).rowcount == 0:
+        connection.execute(insert(HandStat).values(scope=scope, **row))
+
+
+def _remove(connection, scope, row, condition):
+    """ Remove aggregated statistics of hands (matching condition) from stored statistics of scope
+
+    Min and max are recomputed from the other hands of scope when one of the
+    removed hands was an extreme
+    """
+    values = {name: getattr(HandStat, name) - row[name] for name in _COUNTS}
+    where = _where(scope, row["scope_id"])
+    connection.execute(update(HandStat).where(where).values(values))
+
+    stored = connection.execute(select(HandStat).where(where)).mappings().first()
+    if stored is None:
+        return
+    if stored["hands"] <= 0:
+        connection.execute(delete(HandStat).where(where))
+    elif any(row[name] is not None and stored[name] is not None and
+             (row[name] <= stored[name] if name.endswith("_min") else row[name] >= stored[name])
+             for name in _EXTREMES):
+        remaining = (_scope_key(scope) == row["scope_id"]) & not_(condition)
+        extremes = connection.execute(aggregate_statement(scope, remaining)).mappings().first()
+        connection.execute(update(HandStat).where(where).values(
+            {name: extremes[name] if extremes is not None else None for name in _EXTREMES}))
+
+
+def add_hands(connection, condition):
+    """ Add hands matching condition to statistics (after insert)
+
+    :param connection: SQLAlchemy connection
+    :param condition: SQL condition on hands (e.g. Hand.id.between(first_id, last_id))
+    :return:
+    """
+    for scope in SCOPES:
+        for row in connection.execute(aggregate_statement(scope, condition)).mappings().all():
+            if row["hands"]:
+                _add(connection, scope, row)
+
+
+def remove_hands(connection, condition):
+    """ Remove hands matching condition from statistics (before delete)
+
+    :param connection: SQLAlchemy connection
+    :param condition: SQL condition on hands (e.g. Hand.id == hand_id)
+    :return:
+    """
+    for scope in SCOPES:
+        for row in connection.execute(aggregate_statement(scope, condition)).mappings().all():
+            if row["hands"]:
+                _remove(connection, scope, row, condition)
+
+
+def create_tables(engine, reset=False):
+    """ Create all tables if necessary, and statistics of hands stored without statistics
+
+    :param engine: SQLAlchemy engine
+    :param reset: if True, drop all tables first (all data are lost)
+    :return:
+    """
+    if reset:
+        Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        initialize(connection)
+
+
+def initialize(connection):
+    """ Build statistics of hands stored without statistics (e.g. database created before statistics)
+
+    :param connection: SQLAlchemy connection (within a transaction)
+    :return:
+    """
+    if connection.execute(select(HandStat.id).limit(1)).first() is None and \
+            connection.execute(select(Hand.id).limit(1)).first() is not None:
+        rebuild(connection)
+
+
+def rebuild(connection):
+    """ Recompute all statistics from hands table
+
+    :param connection: SQLAlchemy connection (within a transaction)
+    :return:
+    """
+    connection.execute(delete(HandStat))
+    for scope in SCOPES:
+        statistics = aggregate_statement(scope).subquery()
+        connection.execute(insert(HandStat).from_select(["scope"] + [column.name for column in statistics.c], select(
+            literal(scope), *statistics.c).where(statistics.c.hands > 0)))
+
+
+def _differs(stored, expected):
+    if stored is None or expected is None:
+        return stored is not expected
+    return not math.isclose(stored, expected, rel_tol=CHECK_TOLERANCE, abs_tol=CHECK_TOLERANCE)
+
+
+def check(connection):
+    """ Compare stored statistics with statistics recomputed from hands table
+
+    :param connection: SQLAlchemy connection
+    :return: list of Mismatch (empty if statistics are consistent)
+    """
+    mismatches = []
+    for scope in SCOPES:
+        stored = {row["scope_id"]: row for row in connection.execute(select(HandStat).where(
+            HandStat.scope == scope)).mappings()}
+        expected = {row["scope_id"]: row for row in connection.execute(aggregate_statement(scope)).mappings()
+                    if row["hands"]}
+        for scope_id in sorted(stored.keys() | expected.keys()):
+            if scope_id not in stored or scope_id not in expected:
+                mismatches.append(Mismatch(scope, scope_id, "hands", stored.get(scope_id, {}).get("hands"),
+                                           expected.get(scope_id, {}).get("hands")))
+                continue
+            mismatches += [Mismatch(scope, scope_id, name, stored[scope_id][name], expected[scope_id][name])
+                           for name in _COUNTS + _EXTREMES if _differs(stored[scope_id][name],
+                                                                        expected[scope_id][name])]
+
+    return mismatches
+
+
+def summary(connection, scope="all", scope_id=ALL):
+    """ Summary of hands of image, cave, project or of all hands (single row lookup)
+
+    :param connection: SQLAlchemy connection
+    :param scope: "all", "project", "cave" or "image"
+    :param scope_id: id of image, cave or project
+    :return: ScopeSummary (None if scope has no hand)
+    """
+    if scope not in SCOPES:
+        raise ValueError("Unknown scope '%s' (valid scopes: %s)" % (scope, ", ".join(SCOPES)))
+
+    row = connection.execute(select(HandStat).where(_where(scope, scope_id))).mappings().first()
+    if row is None:
+        return None
+
+    features = dict()
+    for feature in STAT_FEATURES:
+        count = row[feature + "_count"]
+        if count:
+            mean = row[feature + "_sum"] / count
+            std = max(row[feature + "_squares"] / count - mean ** 2, 0) ** 0.5
+            features[feature] = FeatureSummary(count, mean, std, row[feature + "_min"], row[feature + "_max"])
+        else:
+            features[feature] = FeatureSummary(0, None, None, None, None)
+
+    return ScopeSummary(scope, scope_id, row["hands"], row["left"], row["right"], features)
+
+
+###################
+# ORM event hooks
+# Statistics are updated once per flush, for all hands inserted, updated or
+# deleted by that flush: old values are removed before the flush and new
+# values added after it, with a few grouped statements
+
+# Maximum number of hand ids per statement
+_ID_CHUNK = 500
+
+
+def _chunks(hand_ids):
+    for i in range(0, len(hand_ids), _ID_CHUNK):
+        yield hand_ids[i:i + _ID_CHUNK]
+
+
+def _is_modified(hand):
+    state = inspect(hand)
+    return any(state.attrs[name].history.has_changes() for name in ("image_id", "left", "right") + STAT_FEATURES)
+
+
+@event.listens_for(Session, "before_flush")
+def _before_flush(session, flush_context, instances):
+    modified = [obj for obj in session.dirty if isinstance(obj, Hand) and _is_modified(obj)]
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, Hand)]
+    session.info["modified_hands"] = modified
+    if modified or deleted:
+        connection = session.connection()
+        for hand_ids in _chunks([hand.id for hand in modified] + deleted):
+            remove_hands(connection, Hand.id.in_(hand_ids))
+        for hand_ids in _chunks(deleted):
+            for table in HAND_TABLES:
+                connection.execute(delete(table).where(table.hand_id.in_(hand_ids)))
+
+
+@event.listens_for(Session, "after_flush")
+def _after_flush(session, flush_context):
+    hand_ids = [obj.id for obj in session.new if isinstance(obj, Hand)]
+    hand_ids += [hand.id for hand in session.info.pop("modified_hands", [])]
+    if hand_ids:
+        connection = session.connection()
+        for chunk in _chunks(hand_ids):
+            add_hands(connection, Hand.id.in_(chunk))
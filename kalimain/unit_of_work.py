@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+""" Session scoping of user operations
+
+Each user operation (add, delete or select an object, poll geocoding
+results, etc.) runs in its own short-lived session, so that the identity map
+never outlives the operation and memory use does not grow with the length
+of an annotation session. Objects handed over to the view are detached read
+models (see kalimain.readmodel), not ORM instances.
+"""
+import kalimain
+
+
+class UnitOfWork:
+    """ Session scope of user operations
+
+    Use as a context manager: nested blocks share the same session, and the
+    outermost block commits (or rolls back on error) and closes it. Callbacks
+    registered with after_commit (e.g. notifications of observers, updates of
+    in-memory indexes) only run once the outermost block has committed.
+    """
+
+    def __init__(self, session_factory=None, expire_on_commit=False):
+        """
+
+        :param session_factory: callable returning a new session (default: kalimain.SESSION)
+        :param expire_on_commit: if True, instances are expired on commit and re-loaded on next access
+        (SQLAlchemy default). Not needed with short-lived sessions
+        """
+        self.session_factory = session_factory if session_factory is not None else kalimain.SESSION
+        self.expire_on_commit = expire_on_commit
+        self._session = None
+        self._depth = 0
+        self._callbacks = []
+
+    def __enter__(self):
+        if self._depth == 0:
+            self._session = self.session_factory(expire_on_commit=self.expire_on_commit)
+        self._depth += 1
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._depth -= 1
+        if self._depth == 0:
+            session, self._session = self._session, None
+            callbacks, self._callbacks = self._callbacks, []
+            try:
+                if exc_type is None:
+                    session.commit()
+                else:
+                    session.rollback()
+                    callbacks = []
+            finally:
+                session.close()
+            for callback, args in callbacks:
+                callback(*args)
+
+    def after_commit(self, callback, *args):
+        """ Call callback(*args) once current operation is committed
+
+        Callback is called at once outside of any unit of work, and dropped
+        if the operation is rolled back
+        :param callback:
+        :param args:
+        :return:
+        """
+        if self._session is None:
+            callback(*args)
+        else:
+            self._callbacks.append((callback, args))
+
+    @property
+    def active(self):
+        return self._session is not None
+
+    @property
+    def session(self):
+        """ Session of current operation
+
+        :return:
+        """
+        if self._session is None:
+            raise RuntimeError("Session can only be used within a unit of work")
+        return self._session
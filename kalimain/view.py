@@ -60,6 +60,7 @@ class MainView(SubView):
     add_cave_button = None
     delete_cave_button = None
     add_image_button = None
+    add_folder_button = None
     delete_image_button = None
     image_enhance_scale = []
 
@@ -112,8 +113,10 @@ class MainView(SubView):
 
     def _create_image_control_panel_buttons(self):
         self.add_image_button = KPanelButton(self.image_control_panel, text="Add image")
+        self.add_folder_button = KPanelButton(self.image_control_panel, text="Add folder")
         self.delete_image_button = KPanelButton(self.image_control_panel, text="Delete")
         self.add_image_button.pack(side="top", expand="no", fill="x", padx=2, pady=1)
+        self.add_folder_button.pack(side="top", expand="no", fill="x", padx=2, pady=1)
         self.delete_image_button.pack(side="top", expand="no", fill="x", padx=2, pady=1)
 
     def _create_image_enhance_controls(self):
@@ -217,6 +220,10 @@ class MainView(SubView):
         """
         text = "D1 = %.2f px\nD2 = %.2f px\nD3 = %.2f px\nD4 = %.2f px\nD5 = %.2f px\n\nMANNING = %.2f" % \
                tuple([info[key] for key in ["d1", "d2", "d3", "d4", "d5", "manning"]])
+        if info.get("similar"):
+            text += "\n\nMost similar hands:\n" + "\n".join(
+                "%s / %s / %s (distance %.3f)" % (hand.project, hand.cave, hand.image, hand.distance)
+                for hand in info["similar"])
         messagebox.showinfo("Hand info", message=text)
 
     def draw_line(self, line, color=None):
@@ -288,9 +295,139 @@ class DataDisplayView(SubView):
     """ Display data tab
 
     """
+    control_bar = None
+    variable_box = None
+    group_box = None
+    cluster_box = None
+    table = None
+    histogram = None
+
+    # Distribution of each table row
+    distributions = dict()
+
+    # Control bar choices
+    variables = ("manning", "D1", "D2", "D3", "D4", "D5")
+    groupings = ("all", "project", "cave", "country", "continent")
+    cluster_features = ("none", "profile", "shape", "both")
+
+    # Design
+    histogram_height = 250
+    bar_color = "sky blue"
+    cluster_colors = ("sky blue", "orange", "yellow green", "orchid", "gold", "salmon", "turquoise", "tan")
+    axis_color = "black"
+    margin = 40
+
+    ###################
+    # Protected GUI creation methods
+    def _create_control_bar(self):
+        self.control_bar = KFrame(self.root)
+        self.control_bar.pack(side="top", expand="no", fill="x", padx=2, pady=2)
+        tk.Label(self.control_bar, text="Variable").pack(side="left", padx=2)
+        self.variable_box = ttk.Combobox(self.control_bar, values=self.variables, state="readonly", width=10)
+        self.variable_box.current(0)
+        self.variable_box.pack(side="left", padx=2)
+        tk.Label(self.control_bar, text="Group by").pack(side="left", padx=2)
+        self.group_box = ttk.Combobox(self.control_bar, values=self.groupings, state="readonly", width=10)
+        self.group_box.current(0)
+        self.group_box.pack(side="left", padx=2)
+        tk.Label(self.control_bar, text="Clusters").pack(side="left", padx=2)
+        self.cluster_box = ttk.Combobox(self.control_bar, values=self.cluster_features, state="readonly", width=10)
+        self.cluster_box.current(0)
+        self.cluster_box.pack(side="left", padx=2)
+        Separator(self.root, orient=tk.HORIZONTAL).pack(side="top", fill="x")
+
+    def _create_histogram(self):
+        self.histogram = tk.Canvas(self.root, height=self.histogram_height, bg="white")
+        self.histogram.pack(side="bottom", expand="no", fill="x")
+        Separator(self.root, orient=tk.HORIZONTAL).pack(side="bottom", fill="x")
+
+    def _create_table(self):
+        self.table = ttk.Treeview(self.root, show="headings")
+        self.table.pack(side="top", expand="yes", fill="both")
 
     def create_gui(self):
-        pass
+        self._create_control_bar()
+        self._create_histogram()
+        self._create_table()
+
+    #########
+    # Methods
+    def display_statistics(self, statistics):
+        """ Fill table with summaries and quantiles of groups
+
+        :param statistics: kalimain.analytics.Statistics
+        :return:
+        """
+        quantile_columns = ["Q%g" % (100 * quantile) for quantile in statistics.quantiles]
+        columns = ["group", "hands", "left", "mean", "std", "min", "max"] + quantile_columns
+        self.table.delete(*self.table.get_children())
+        self.table.config(columns=columns)
+        for column in columns:
+            self.table.heading(column, text=column)
+            self.table.column(column, width=80, anchor="e" if column != "group" else "w")
+
+        distributions = {distribution.group: distribution for distribution in statistics.distributions}
+        self.distributions.clear()
+        for summary in statistics.summaries:
+            distribution = distributions.get(summary.group)
+            quantiles = distribution.quantiles if distribution is not None else [None] * len(quantile_columns)
+            values = [summary.label if summary.label is not None else "-", summary.hands, summary.left] + \
+                     ["%.3f" % value if value is not None else "-" for value in
+                      [summary.mean, summary.std, summary.min, summary.max] + list(quantiles)]
+            item = self.table.insert("", "end", values=values)
+            self.distributions[item] = distribution
+
+        self.histogram.delete("all")
+        if self.table.get_children():
+            self.table.selection_set(self.table.get_children()[0])
+
+    def draw_histogram(self, distribution, cluster_counts=None):
+        """ Draw histogram of distribution, with bars stacked by cluster if cluster counts are given
+
+        :param distribution: kalimain.analytics.Distribution (None = clear histogram)
+        :param cluster_counts: (bins, clusters) array of counts (see kalimain.clustering.ClusterHistogram)
+        :return:
+        """
+        self.histogram.delete("all")
+        if distribution is None:
+            return
+
+        if cluster_counts is None:
+            cluster_counts = [[count] for count in distribution.bin_counts]
+        width, height = self.histogram.winfo_width(), self.histogram.winfo_height()
+        bar_width = (width - 2 * self.margin) / len(cluster_counts)
+        scale = (height - 2 * self.margin) / max(max(sum(counts) for counts in cluster_counts), 1)
+        bottom = height - self.margin
+        for i, counts in enumerate(cluster_counts):
+            x, top = self.margin + i * bar_width, bottom
+            for cluster, count in enumerate(counts):
+                if count:
+                    color = self.cluster_colors[cluster % len(self.cluster_colors)] if len(counts) > 1 else \
+                        self.bar_color
+                    self.histogram.create_rectangle(x, top - count * scale, x + bar_width, top, fill=color)
+                    top -= count * scale
+        self.histogram.create_line(self.margin, bottom, width - self.margin, bottom, fill=self.axis_color)
+        for x, value in ((self.margin, distribution.bin_edges[0]), (width - self.margin, distribution.bin_edges[-1])):
+            self.histogram.create_text(x, bottom + 12, text="%.3f" % value, fill=self.axis_color)
+        self.histogram.create_text(width // 2, self.margin // 2, fill=self.axis_color,
+                                   text="%s (n = %d)" % (distribution.label, distribution.count))
+
+    @property
+    def by(self):
+        return self.group_box.get() if self.group_box.get() != "all" else None
+
+    @property
+    def clusters(self):
+        return self.cluster_box.get() if self.cluster_box.get() != "none" else None
+
+    @property
+    def selected_distribution(self):
+        selection = self.table.selection()
+        return self.distributions.get(selection[0]) if selection else None
+
+    @property
+    def variable(self):
+        return self.variable_box.get()
 
 
 class KView(Framework, ObservableView):
@@ -322,7 +459,7 @@ class KView(Framework, ObservableView):
 
     def _create_menu(self):
         menu_definitions = (
-            'File- &New project/Ctrl+N, &Open project/Ctrl+O, sep, '
+            'File- &New project/Ctrl+N, &Open project/Ctrl+O, sep, &Import caves/Ctrl+I, sep, '
             'Exit/Alt+F4',
             'Help- About/F1'
         )
@@ -10,13 +10,12 @@ __copyright__ = 'Copyright 2019, Benjamin Pillot'
 __email__ = 'benjaminpillot@riseup.net'
 
 
-from sqlalchemy import Table
-
 import kalimain
+from kalimain.export import Exporter
+from kalimain.jobs import PrintProgress
 from kalimain.model import KModel
-from utils.toolset.sqlcsv import SqlCsv
 
-test = KModel()
+test = KModel(reset=True)
 test.project_model.add_project(name="projet_1")
 test.project_model.add_project(name="projet_2", description="Une autre description histoire de voir")
 test.project_model.add_project(name="projet_3", description="Une description pour voir")
@@ -29,7 +28,7 @@ test.cave_model.set_object(1)
 test.image_model.add_image("/home/benjamin/Documents/kalimain/sample/IK-bouquetPL_red - copie.tif", name="image_2")
 
 
-sqlobj = SqlCsv(kalimain.ENGINE, test.session)
-sqlobj.to_csv("images", "/home/benjamin/Documents/kalimain/test_images.csv", map_foreign_key_tables=True)
-
-# sqlobj.inspector.get_foreign_keys("caves")
+exporter = Exporter(kalimain.ENGINE)
+exporter.progress_notifier.add_observer(PrintProgress("rows"))
+exporter.export_table("images", "/home/benjamin/Documents/kalimain/test_images.csv", denormalize=True)
+exporter.export_hands("/home/benjamin/Documents/kalimain/test_hands.csv", project_id=2)
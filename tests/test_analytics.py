@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+""" Tests of cached analytics against changes made outside of the model
+
+"""
+import pytest
+from sqlalchemy import create_engine, insert, update
+
+from kalimain import summary
+from kalimain.analytics import Analytics
+from kalimain.database import Base, Project, Cave, Image, Hand
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine("sqlite:///%s" % (tmp_path / "kalimain.db"))
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        summary.initialize(connection)
+        connection.execute(insert(Project).values(id=1, name="project"))
+        connection.execute(insert(Cave), [dict(id=1, name="a", country="France", project_id=1),
+                                          dict(id=2, name="b", country="Spain", project_id=1)])
+        connection.execute(insert(Image), [dict(id=1, cave_id=1), dict(id=2, cave_id=2)])
+    add_hands(engine, [(1, 1, 0.9), (2, 1, 1.0), (3, 2, 1.1)])
+    return engine
+
+
+def add_hands(engine, hands):
+    """ Bulk insert (hand id, image id, Manning index) rows, as landmark import does
+
+    """
+    with engine.begin() as connection:
+        connection.execute(insert(Hand), [dict(id=hand_id, image_id=image_id, left=True, right=False, manning=manning)
+                                          for hand_id, image_id, manning in hands])
+        summary.add_hands(connection, Hand.id.in_([hand[0] for hand in hands]))
+
+
+def counts(analytics, by):
+    return {result.label: result.count for result in analytics.summaries("manning", by)}
+
+
+def test_bulk_insert_of_hands(engine):
+    analytics = Analytics(engine)
+    assert counts(analytics, None) == {"all": 3}
+    assert counts(analytics, "country") == {"France": 2, "Spain": 1}
+
+    add_hands(engine, [(4, 2, 1.2), (5, 2, 1.3)])
+    assert counts(analytics, None) == {"all": 5}
+    assert counts(analytics, "country") == {"France": 2, "Spain": 3}
+
+
+def test_geocoding_of_caves(engine):
+    analytics = Analytics(engine)
+    assert counts(analytics, "continent") == {None: 3}
+
+    with engine.begin() as connection:
+        connection.execute(update(Cave).values(continent="Europe"))
+    assert counts(analytics, "continent") == {"Europe": 3}
+
+
+def test_image_invalidation_keeps_other_groups(engine):
+    analytics = Analytics(engine)
+    france, spain = analytics.distributions("manning", "country")
+
+    add_hands(engine, [(4, 2, 1.2)])
+    analytics.invalidate_image(2)
+    other_france, other_spain = analytics.distributions("manning", "country")
+    assert other_france is france
+    assert other_spain.count == 2
+
+
+def test_stored_statistics(engine):
+    analytics = Analytics(engine)
+    for by, keys in (("cave", (1, 2)), ("project", (1,)), ("country", ("France", "Spain"))):
+        statistics = analytics.stored_statistics("manning", by, keys)
+        for result in analytics.summaries("manning", by):
+            count, total, squares, minimum, maximum = statistics[result.group]
+            assert (count, minimum, maximum) == (result.count, result.min, result.max)
+            assert total / count == pytest.approx(result.mean)
+
+    assert analytics.stored_statistics("manning", "cave", (3,)) == dict()
+
+
+def test_comparison_recomputed_when_spread_changes(engine):
+    from kalimain.resampling import GroupComparisons
+
+    comparisons = GroupComparisons(Analytics(engine), nb_resamples=200, seed=1, processes=0)
+    add_hands(engine, [(4, 2, 1.3)])
+    comparison = comparisons.compare("manning", "country", "France", "Spain")
+    assert comparisons.compare("manning", "country", "France", "Spain") is comparison
+
+    # Same count and mean, other spread
+    with engine.begin() as connection:
+        connection.execute(update(Hand).where(Hand.id == 1).values(manning=0.8))
+        connection.execute(update(Hand).where(Hand.id == 2).values(manning=1.1))
+        summary.rebuild(connection)
+    assert comparisons.compare("manning", "country", "France", "Spain") is not comparison
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+""" Tests of headless commands
+
+"""
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+from sqlalchemy import create_engine
+
+from kalimain.api import Kalimain
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def url(tmp_path):
+    return "sqlite:///%s" % (tmp_path / "kalimain.db")
+
+
+def test_statistics_commands_do_not_import_model(url):
+    # Model layer (Tk free, but slow to import) is not needed by database commands
+    code = ("import sys\n"
+            "from kalimain.cli import main\n"
+            "for command in (['stats'], ['stats', '--by', 'cave'], ['summary']):\n"
+            "    main(['--database', %r] + command)\n"
+            "print(sorted(name for name in ('kalimain.model', 'kalimain.geocoding', 'kalimain.ingest')\n"
+            "             if name in sys.modules))\n" % url)
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+
+    assert result.stdout.splitlines()[-1] == "[]"
+
+
+def test_import_caves_leaves_no_background_thread(url, tmp_path, monkeypatch):
+    # Rate limited geocoder: caves are left to the application backfill, which is not started headless
+    monkeypatch.setattr("kalimain.geocoding.boundaries_directory", str(tmp_path / "none"))
+    filename = tmp_path / "caves.csv"
+    filename.write_text("name,latitude,longitude\na,10,10\nb,20,20\nc,20,20.0001\n")
+
+    api = Kalimain(create_engine(url))
+    report = api.import_caves(str(filename), "project")
+
+    assert (report.read, report.duplicates, report.geocoded) == (3, 1, 0)
+    assert [cave.name for cave in report.caves] == ["a", "b"]
+    assert api.get_project("project").caves == tuple(report.caves)
+    assert api.counts() == dict(projects=1, caves=2, images=0, hands=0)
+    assert threading.active_count() == 1
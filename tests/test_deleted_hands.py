@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+""" Tests of values derived from hands, deleted along with their hand
+
+Foreign keys are not enforced by the engine of these tests: rows are deleted
+by the flush deleting the hand (see kalimain.summary)
+"""
+import pytest
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.orm import Session
+
+from kalimain.database import Base, Hand, HandShape, HandCluster, HandPigment, HandMeasure
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine("sqlite:///%s" % (tmp_path / "kalimain.db"))
+    Base.metadata.create_all(engine)
+    return engine
+
+
+@pytest.mark.parametrize("table, values", [(HandShape, dict(size=1.0)),
+                                           (HandCluster, dict(name="profile", cluster=3)),
+                                           (HandPigment, dict(area=10, delta_e=1.0)),
+                                           (HandMeasure, dict(name="area", version=1, value=1.0))])
+def test_rows_deleted_with_hand(engine, table, values):
+    with engine.begin() as connection:
+        connection.execute(insert(Hand), [dict(id=1), dict(id=2)])
+        connection.execute(insert(table), [dict(values, hand_id=1), dict(values, hand_id=2)])
+
+    with Session(engine) as session:
+        session.delete(session.get(Hand, 2))
+        session.commit()
+
+        assert session.execute(select(table.hand_id)).scalars().all() == [1]
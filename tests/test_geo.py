@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+""" Tests of spatial index and pair searches against brute force
+
+"""
+import numpy as np
+import pytest
+
+from kalimain.geo import GeoIndex, haversine, close_pairs, nearest_pairs
+
+
+def brute_force_distances(latitudes, longitudes):
+    return haversine(latitudes[:, None], longitudes[:, None], latitudes[None, :], longitudes[None, :])
+
+
+@pytest.mark.parametrize("min_latitude, max_latitude, distance", [(-60, 60, 500), (89, 90, 10), (-90, -89.5, 10)])
+def test_close_pairs(min_latitude, max_latitude, distance):
+    rng = np.random.default_rng(0)
+    latitudes, longitudes = rng.uniform(min_latitude, max_latitude, 1000), rng.uniform(-180, 180, 1000)
+    distances = brute_force_distances(latitudes, longitudes)
+
+    first, second, pair_distances = close_pairs(latitudes, longitudes, distance)
+    expected = set(zip(*np.nonzero((distances <= distance) & ~np.eye(len(latitudes), dtype=bool))))
+    assert expected and set(zip(first.tolist(), second.tolist())) == expected
+    assert np.allclose(pair_distances, distances[first, second])
+
+
+def test_nearest_pairs_near_pole():
+    rng = np.random.default_rng(1)
+    latitudes, longitudes = rng.uniform(88, 90, 200), rng.uniform(-180, 180, 200)
+    distances = brute_force_distances(latitudes, longitudes)
+    np.fill_diagonal(distances, np.inf)
+
+    first, second, pair_distances = nearest_pairs(latitudes, longitudes, 3)
+    assert np.array_equal(first, np.repeat(np.arange(200), 3))
+    assert np.allclose(pair_distances.reshape(-1, 3), np.sort(distances, axis=1)[:, :3])
+
+
+def test_index_within_near_pole():
+    rng = np.random.default_rng(2)
+    latitudes, longitudes = rng.uniform(89, 90, 300), rng.uniform(-180, 180, 300)
+    index = GeoIndex()
+    for item, (latitude, longitude) in enumerate(zip(latitudes, longitudes)):
+        index.add(item, latitude, longitude)
+
+    distances = haversine(89.5, 170, latitudes, longitudes)
+    assert [item for _, item in index.within(89.5, 170, 50)] == np.argsort(distances)[
+        :int((distances <= 50).sum())].tolist()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+""" Tests of background reverse geocoding queue, with a local stand-in geocoder
+
+"""
+import threading
+import time
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from kalimain.database import Base, Cave, Location
+from kalimain.geocoding import Geocoder, GeocodingQueue
+
+
+class FakeGeocoder(Geocoder):
+    """ Geocoder recording calls, failing on given coordinates
+
+    """
+    def __init__(self, fail=()):
+        self.calls = []
+        self.fail = set(fail)
+        self.lock = threading.Lock()
+
+    def reverse(self, latitude, longitude):
+        with self.lock:
+            self.calls.append((time.monotonic(), latitude, longitude))
+        if (latitude, longitude) in self.fail:
+            raise RuntimeError("geocoder bug")
+        return dict(display_name="Somewhere, Country %d" % round(latitude),
+                    address=dict(country="Country %d" % round(latitude), country_code="fr"))
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://", connect_args=dict(check_same_thread=False), poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(engine)()
+    yield session
+    session.close()
+
+
+def add_caves(session, *coordinates, **kwargs):
+    caves = [Cave(latitude=latitude, longitude=longitude, **kwargs) for latitude, longitude in coordinates]
+    session.add_all(caves)
+    session.commit()
+    return caves
+
+
+def wait(queue, session, timeout=5):
+    """ Poll queue until all requests are answered
+
+    """
+    updated, errors = [], []
+    deadline = time.monotonic() + timeout
+    while queue.pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+        cave_ids, poll_errors = queue.poll(session)
+        updated += cave_ids
+        errors += poll_errors
+    assert not queue.pending
+    return updated, errors
+
+
+def test_rate_limit(session):
+    geocoder = FakeGeocoder()
+    queue = GeocodingQueue(geocoder, min_delay=0.05)
+    caves = add_caves(session, (10, 10), (20, 20), (30, 30))
+    queue.submit_many(session, caves)
+    wait(queue, session)
+    queue.close()
+
+    times = [call[0] for call in geocoder.calls]
+    assert len(times) == 3
+    assert all(later - earlier >= 0.045 for earlier, later in zip(times, times[1:]))
+
+
+def test_nearby_requests_are_coalesced(session):
+    geocoder = FakeGeocoder()
+    queue = GeocodingQueue(geocoder, min_delay=0, precision=3)
+    caves = add_caves(session, (45.12341, 5.12341), (45.12344, 5.12339), (46, 6))
+    queue.submit_many(session, caves)
+    updated, errors = wait(queue, session)
+    queue.close()
+
+    assert len(geocoder.calls) == 2
+    assert sorted(updated) == sorted(cave.id for cave in caves)
+    assert not errors
+    assert all(cave.country == "Country %d" % round(cave.latitude) for cave in session.query(Cave))
+
+
+def test_results_are_cached(session):
+    geocoder = FakeGeocoder()
+    queue = GeocodingQueue(geocoder, min_delay=0)
+    queue.submit_many(session, add_caves(session, (10, 10)))
+    wait(queue, session)
+    queue.close()
+    assert [key for key, in session.query(Location.key)] == [queue.key(10, 10)]
+
+    # New queue (e.g. next session of the application) answers from the cache, without any request
+    other_geocoder = FakeGeocoder()
+    other_queue = GeocodingQueue(other_geocoder, min_delay=0)
+    cave, = add_caves(session, (10.0001, 9.9999))
+    assert other_queue.submit(session, cave)
+    assert cave.country == "Country 10"
+    assert not other_geocoder.calls and not other_queue.pending
+
+
+def test_backfill(session):
+    geocoder = FakeGeocoder()
+    queue = GeocodingQueue(geocoder, min_delay=0)
+    geocoded, = add_caves(session, (10, 10), address="Already geocoded")
+    offline = add_caves(session, (20, 20), (30, 30))
+    queue.backfill(session)
+    updated, _ = wait(queue, session)
+    queue.close()
+
+    assert sorted(updated) == sorted(cave.id for cave in offline)
+    assert sorted(call[1] for call in geocoder.calls) == [20, 30]
+    assert session.get(Cave, geocoded.id).address == "Already geocoded"
+
+
+def test_worker_survives_geocoder_errors(session):
+    geocoder = FakeGeocoder(fail={(10, 10)})
+    queue = GeocodingQueue(geocoder, min_delay=0)
+    failed, = add_caves(session, (10, 10))
+    queue.submit(session, failed)
+    _, errors = wait(queue, session)
+    assert len(errors) == 1 and isinstance(errors[0], RuntimeError)
+
+    # Thread is still running: later requests are answered
+    cave, = add_caves(session, (20, 20))
+    queue.submit(session, cave)
+    updated, errors = wait(queue, session)
+    queue.close()
+
+    assert updated == [cave.id] and not errors
+    assert session.get(Cave, failed.id).address is None
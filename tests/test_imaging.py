@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+""" Tests of hamming distance search among perceptual hashes
+
+"""
+from kalimain.imaging import HammingIndex
+
+
+def test_search():
+    index = HammingIndex()
+    index.add(0, "zero")
+    index.add(0b111, "three")
+    index.add(2 ** 64 - 1, "ones")
+
+    assert index.search(0b1, 1) == [(1, "zero")]
+    assert index.search(0b1, 2) == [(1, "zero"), (2, "three")]
+    assert index.search(0b11110000, 1) == []
+
+
+def test_add_replaces_key():
+    index = HammingIndex()
+    index.add(0, "image")
+    index.add(2 ** 64 - 1, "image")
+
+    assert len(index) == 1
+    assert index.search(0, 0) == []
+    assert index.search(2 ** 64 - 1, 0) == [(0, "image")]
+    index.remove("image")
+    assert not any(index.tables)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+""" Tests of bulk import of hand landmarks
+
+"""
+import numpy as np
+import pytest
+from sqlalchemy import create_engine, insert, select, func
+from sqlalchemy.orm import Session
+
+from kalimain import summary
+from kalimain.database import Base, Project, Cave, Image, Hand, HPoint, HandStat
+from kalimain.features import NB_LANDMARKS
+from kalimain.importer import import_landmarks, main
+
+# Landmarks of a right hand
+TEMPLATE = np.array([[0, 60], [20, 100], [30, 60], [45, 120], [55, 60], [65, 125], [75, 60], [85, 115], [95, 60],
+                     [110, 90], [115, 50], [60, 0]], dtype=float)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine("sqlite:///%s" % (tmp_path / "kalimain.db"))
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Project).values(id=1, name="project"))
+        connection.execute(insert(Cave).values(id=1, name="cave", project_id=1))
+        connection.execute(insert(Image).values(id=1, cave_id=1, name="image"))
+    return engine
+
+
+def write_landmarks(filename, rows):
+    header = ["image_id"] + ["%s%d" % (axis, i) for i in range(1, NB_LANDMARKS + 1) for axis in "xy"]
+    filename.write_text("\n".join(",".join(str(value) for value in row) for row in [header] + rows) + "\n")
+    return str(filename)
+
+
+def test_import_landmarks(engine, tmp_path):
+    filename = write_landmarks(tmp_path / "landmarks.csv", [[1] + (TEMPLATE * 3).ravel().tolist(),
+                                                            [1] + (TEMPLATE * 2.5).ravel().tolist(),
+                                                            ["one"] + TEMPLATE.ravel().tolist(),
+                                                            [2] + TEMPLATE.ravel().tolist()])
+    report = import_landmarks(engine, filename)
+    assert (report.read, report.inserted, report.invalid, report.unmatched, report.rounded) == (4, 2, 1, 1, 1)
+
+    # Coordinates are stored as integers, and features computed from stored points
+    with engine.connect() as connection:
+        points = connection.execute(select(HPoint.x, HPoint.y).where(HPoint.hand_id == 2).order_by(HPoint.id)).all()
+        assert all(isinstance(value, int) for point in points for value in point)
+        assert np.array_equal(points, np.rint(TEMPLATE * 2.5))
+        assert summary.check(connection) == []
+
+
+def test_ids_of_deleted_hands_are_not_reused(engine, tmp_path):
+    filename = write_landmarks(tmp_path / "landmarks.csv", [[1] + TEMPLATE.ravel().tolist()] * 3)
+    import_landmarks(engine, filename)
+    with Session(engine) as session:
+        session.delete(session.get(Hand, 3))
+        session.commit()
+
+    import_landmarks(engine, filename)
+    with engine.connect() as connection:
+        assert connection.execute(select(Hand.id).order_by(Hand.id)).scalars().all() == [1, 2, 4, 5, 6]
+
+
+def test_main_builds_missing_statistics(engine, tmp_path, monkeypatch):
+    # Database with hands but no statistics yet
+    with engine.begin() as connection:
+        connection.execute(insert(Hand).values(id=1, image_id=1, left=True, right=False, manning=1.0))
+    monkeypatch.setattr("kalimain.ENGINE", engine)
+
+    main([write_landmarks(tmp_path / "landmarks.csv", [[1] + TEMPLATE.ravel().tolist()])])
+    with engine.connect() as connection:
+        assert connection.execute(select(HandStat.hands).where(HandStat.scope == "all")).scalar() == 2
+        assert connection.execute(select(func.count(Hand.id))).scalar() == 2
+        assert summary.check(connection) == []
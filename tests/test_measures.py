@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+""" Tests of lazily computed hand measures
+
+"""
+import numpy as np
+import pytest
+from sqlalchemy import create_engine, insert
+
+from kalimain.database import Base, Hand, HPoint
+from kalimain.features import NB_LANDMARKS
+from kalimain.measures import MeasureStore, Measure
+
+
+class Counted:
+    """ Measure function recording the number of hands it is computed for
+
+    """
+    def __init__(self, offset=0):
+        self.offset = offset
+        self.nb_hands = 0
+
+    def __call__(self, landmarks):
+        self.nb_hands += len(landmarks)
+        return landmarks[:, 0, 0] + self.offset
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine("sqlite:///%s" % (tmp_path / "kalimain.db"))
+    Base.metadata.create_all(engine)
+    add_hands(engine, range(1, 11))
+    return engine
+
+
+def add_hands(engine, hand_ids):
+    with engine.begin() as connection:
+        connection.execute(insert(Hand), [dict(id=hand_id) for hand_id in hand_ids])
+        connection.execute(insert(HPoint), [dict(hand_id=hand_id, x=hand_id, y=i) for hand_id in hand_ids
+                                            for i in range(NB_LANDMARKS)])
+
+
+def test_only_missing_values_are_computed(engine):
+    first, second = Counted(), Counted()
+    registry = dict(first=Measure("first", 1, first, NB_LANDMARKS, ""),
+                    second=Measure("second", 1, second, NB_LANDMARKS, ""))
+    store = MeasureStore(engine, registry, chunk_size=3)
+    assert store.update() == dict(first=10, second=10)
+    assert store.update() == dict(first=0, second=0)
+
+    # New version of one measure: other measure is not computed again
+    bumped = Counted(offset=100)
+    registry["second"] = Measure("second", 2, bumped, NB_LANDMARKS, "")
+    assert store.update() == dict(first=0, second=10)
+    assert (first.nb_hands, bumped.nb_hands) == (10, 10)
+
+    # New hands: both measures are computed for new hands only
+    add_hands(engine, (11, 12))
+    assert store.update() == dict(first=2, second=2)
+    assert (first.nb_hands, bumped.nb_hands) == (12, 12)
+
+    table = store.table()
+    assert table.hand_ids.tolist() == list(range(1, 13))
+    assert np.array_equal(table.values, np.column_stack((np.arange(1, 13), np.arange(101, 113))))
+
+
+def test_values_of_deleted_hands(engine):
+    from sqlalchemy.orm import Session
+
+    registry = dict(first=Measure("first", 1, Counted(), NB_LANDMARKS, ""))
+    store = MeasureStore(engine, registry)
+    store.update()
+
+    # Foreign keys are not enforced by this engine: values are deleted along with their hand by the flush
+    with Session(engine) as session:
+        session.delete(session.get(Hand, 10))
+        session.commit()
+    assert 10 not in store.table().hand_ids.tolist()
+
+    # Id of deleted hand is not reused
+    with Session(engine) as session:
+        hand = Hand([HPoint(x=99 + i % 2, y=i * i) for i in range(NB_LANDMARKS)])
+        session.add(hand)
+        session.commit()
+        hand_id = hand.id
+    table = store.table()
+    assert hand_id == 11
+    assert table.values[table.hand_ids == hand_id, 0].tolist() == [99]
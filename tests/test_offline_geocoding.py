@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+""" Tests of offline reverse geocoding from local boundary files
+
+"""
+import os
+import shutil
+
+import shapely
+
+from kalimain.geocoding import BoundaryIndex, OfflineGeocoder, NominatimGeocoder, default_geocoder
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+COUNTRIES = os.path.join(DATA, "countries.geojson")
+REGIONS = os.path.join(DATA, "regions.geojson")
+
+
+def test_boundary_lookup():
+    index = BoundaryIndex(COUNTRIES)
+    # Features without geometry are skipped
+    assert [properties["NAME"] for properties in index.properties] == ["Westland", "Eastland"]
+
+    # First boundary is kept for points on a shared border
+    points = shapely.points([5, 15, 10, 25], [45, 45, 45, 45])
+    assert index.lookup(points).tolist() == [0, 1, 0, -1]
+
+
+def test_reverse():
+    geocoder = OfflineGeocoder(COUNTRIES, REGIONS)
+    assert geocoder.reverse(42, 5) == dict(display_name="South Westland, Westland", address=dict(
+        country="Westland", country_code="wl", continent="Europe", state="South Westland"))
+    # Invalid country codes (e.g. Natural Earth's -99) are dropped
+    assert geocoder.reverse(48, 15) == dict(display_name="Eastland", address=dict(country="Eastland",
+                                                                                  continent="Asia"))
+
+
+def test_reverse_many():
+    geocoder = OfflineGeocoder(COUNTRIES)
+    locations = geocoder.reverse_many([42, 48, 45, 0], [5, 15, -10, 0])
+    assert [location["address"]["country"] if location is not None else None for location in locations] == [
+        "Westland", "Eastland", None, None]
+    assert "state" not in locations[0]["address"]
+
+
+def test_points_outside_all_boundaries():
+    geocoder = OfflineGeocoder(COUNTRIES, REGIONS)
+    assert geocoder.reverse(60, 5) is None
+    assert geocoder.reverse_many([-30, 60], [100, -100]) == [None, None]
+
+
+def test_default_geocoder(tmp_path, monkeypatch):
+    monkeypatch.setattr("kalimain.geocoding.boundaries_directory", str(tmp_path))
+    assert isinstance(default_geocoder(), NominatimGeocoder)
+
+    shutil.copy(COUNTRIES, tmp_path)
+    geocoder = default_geocoder()
+    assert isinstance(geocoder, OfflineGeocoder) and geocoder.regions is None
+    assert geocoder.reverse(42, 5)["address"]["country"] == "Westland"
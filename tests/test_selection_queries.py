@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+""" Query count regression tests of object selection
+
+Selecting a project, cave or image must issue a constant number of queries,
+whatever the number of caves, images, hands and points it holds.
+"""
+import pytest
+from sqlalchemy import create_engine, event, insert
+
+from kalimain.database import Project, Cave, Image, Hand, HPoint
+from kalimain.features import NB_LANDMARKS
+from kalimain.geocoding import Geocoder, GeocodingQueue
+from kalimain.model import KModel
+
+
+class NoGeocoder(Geocoder):
+
+    def reverse(self, latitude, longitude):
+        return None
+
+
+@pytest.fixture
+def new_model(tmp_path, monkeypatch):
+    """ Factory of models, each one on its own temporary SQLite database
+
+    """
+    # No geocoding service is reached by the models
+    monkeypatch.setattr("kalimain.model.GeocodingQueue", lambda: GeocodingQueue(NoGeocoder()))
+
+    def factory(name):
+        return KModel(create_engine("sqlite:///%s" % (tmp_path / ("%s.db" % name))))
+
+    return factory
+
+
+def add_rows(engine, size):
+    """ Insert project 1, with size caves of size images of size hands each
+
+    """
+    with engine.begin() as connection:
+        connection.execute(insert(Project).values(id=1, name="project"))
+        connection.execute(insert(Cave), [dict(id=cave_id, name="cave %d" % cave_id, latitude=cave_id,
+                                               longitude=cave_id, project_id=1) for cave_id in range(1, size + 1)])
+        images = [dict(id=(cave_id - 1) * size + i + 1, name="image", cave_id=cave_id, width=100, height=100)
+                  for cave_id in range(1, size + 1) for i in range(size)]
+        connection.execute(insert(Image), images)
+        hands = [dict(id=(image["id"] - 1) * size + i + 1, image_id=image["id"], left=True, right=False)
+                 for image in images for i in range(size)]
+        connection.execute(insert(Hand), hands)
+        connection.execute(insert(HPoint), [dict(hand_id=hand["id"], x=i, y=i) for hand in hands
+                                            for i in range(NB_LANDMARKS)])
+
+
+def count_queries(engine, function, *args):
+    """ Number of statements executed by function
+
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        function(*args)
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+    return len(statements)
+
+
+def selection_query_counts(new_model, selection, check):
+    counts = []
+    for size in (1, 5, 20):
+        model = new_model("%s_%d" % (selection, size))
+        add_rows(model.engine, size)
+        sub_model = getattr(model, "%s_model" % selection)
+        counts.append(count_queries(model.engine, sub_model.set_object, 1))
+        # Read model is complete: nothing is left to lazy load by the view
+        check(sub_model.current_object, size)
+
+    return counts
+
+
+def test_image_selection(new_model):
+    def check(image, size):
+        assert len(image.hands) == size
+        assert all(len(hand.hpoints) == NB_LANDMARKS for hand in image.hands)
+
+    counts = selection_query_counts(new_model, "image", check)
+    assert counts[0] == counts[1] == counts[2]
+
+
+def test_cave_selection(new_model):
+    def check(cave, size):
+        assert len(cave.images) == size
+
+    counts = selection_query_counts(new_model, "cave", check)
+    assert counts[0] == counts[1] == counts[2]
+
+
+def test_project_selection(new_model):
+    def check(project, size):
+        assert len(project.caves) == size
+
+    counts = selection_query_counts(new_model, "project", check)
+    assert counts[0] == counts[1] == counts[2]
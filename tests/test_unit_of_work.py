@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+""" Tests of notifications of observers after commit of the outermost unit of work
+
+"""
+import pytest
+from sqlalchemy import create_engine
+
+from kalimain.database import Cave, Project
+from kalimain.geocoding import Geocoder, GeocodingQueue
+from kalimain.model import KModel
+from kalimain.observer import Observer
+
+
+class NoGeocoder(Geocoder):
+
+    def reverse(self, latitude, longitude):
+        return None
+
+
+class Recorder(Observer):
+    """ Record notified arguments, with whether a unit of work was still open
+
+    """
+    def __init__(self, unit_of_work):
+        self.unit_of_work = unit_of_work
+        self.calls = []
+
+    def update(self, observable, arg):
+        self.calls.append((arg, self.unit_of_work.active))
+
+
+@pytest.fixture
+def model(tmp_path, monkeypatch):
+    monkeypatch.setattr("kalimain.model.GeocodingQueue", lambda: GeocodingQueue(NoGeocoder()))
+    return KModel(create_engine("sqlite:///%s" % (tmp_path / "kalimain.db")))
+
+
+def test_notification_after_outermost_commit(model):
+    recorder = Recorder(model.unit_of_work)
+    model.project_model.add_object_notifier.add_observer(recorder)
+
+    with model.unit_of_work:
+        view = model.project_model.add_object(Project(name="project"))
+        assert not recorder.calls
+
+    assert recorder.calls == [(view, False)]
+
+
+def test_no_notification_on_rollback(model):
+    recorder = Recorder(model.unit_of_work)
+    model.project_model.add_object_notifier.add_observer(recorder)
+
+    with pytest.raises(RuntimeError):
+        with model.unit_of_work:
+            model.project_model.add_object(Project(name="project"))
+            raise RuntimeError
+
+    assert not recorder.calls
+    assert not model.project_model.projects
+
+
+def test_cave_index_updated_after_commit(model):
+    model.project_model.add_project("project")
+    model.project_model.set_object(model.project_model.current_project.id)
+    model.cave_model.add_cave(10, 10, name="cave")
+    cave_id, = model.cave_model.duplicates(10, 10)
+
+    with pytest.raises(RuntimeError):
+        with model.unit_of_work:
+            model.cave_model.delete_object(cave_id)
+            raise RuntimeError
+
+    # Delete was rolled back: cave is still in database and index
+    assert model.cave_model.duplicates(10, 10) == [cave_id]
+    with model.unit_of_work:
+        assert model.session.get(Cave, cave_id) is not None
+
+    model.cave_model.delete_object(cave_id)
+    assert not model.cave_model.duplicates(10, 10)
+
+
+def test_imported_caves_committed_with_unit_of_work(model, tmp_path):
+    model.project_model.add_project("project")
+    model.project_model.set_object(model.project_model.current_project.id)
+    filename = tmp_path / "caves.csv"
+    filename.write_text("name,latitude,longitude\na,10,10\nb,20,20\n")
+
+    with pytest.raises(RuntimeError):
+        with model.unit_of_work:
+            model.cave_model.import_caves(str(filename))
+            raise RuntimeError
+
+    # Import was rolled back along with the unit of work
+    assert not model.cave_model.duplicates(10, 10)
+    with model.unit_of_work:
+        assert model.session.query(Cave).count() == 0
+
+    report = model.cave_model.import_caves(str(filename))
+    assert model.cave_model.duplicates(10, 10) == [report.caves[0].id]